@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# ARP proxy shared by the controller apps (answers ARP from a learned cache)
+
+import time
+
+from ryu.lib.packet import packet, ethernet, ether_types, arp
+
+class ArpProxy(object):
+    """IP->MAC cache with aging that answers ARP requests from the controller.
+
+    Registered as a Ryu context, so every app that lists it in _CONTEXTS gets
+    the same instance. All apps see the same packet-in message object, so the
+    first app to hand a message to the proxy handles it and the others skip it.
+    """
+
+    # Priority of the flow that punts ARP requests to the controller. It sits
+    # above the L2 forwarding flows (priority 1) but below the firewall (100).
+    ARP_PRIORITY = 10
+
+    def __init__(self):
+        self.ip_to_mac = {}      # ip -> (mac, learned_at)
+        self.static_entries = {} # ip -> mac, never aged (e.g. the load-balancer VIP)
+        self.cache_timeout = 300  # seconds
+        # Unknown targets are flooded at most once per switch per interval,
+        # so a flood that comes back in on another port is not re-flooded.
+        self.flood_suppress_interval = 1.0  # seconds
+        self.recent_floods = {}  # (dpid, src_ip, dst_ip) -> flooded_at
+        self.stats = {'requests': 0, 'replies_sent': 0, 'floods': 0, 'suppressed': 0}
+        self._last_msg = None
+        self._last_result = False
+
+    def add_static(self, ip, mac):
+        """Answer ARP for ip with mac regardless of what hosts reply"""
+        self.static_entries[ip] = mac
+
+    def lookup(self, ip):
+        """Return the MAC for ip, or None if unknown or aged out"""
+        if ip in self.static_entries:
+            return self.static_entries[ip]
+        entry = self.ip_to_mac.get(ip)
+        if entry is None:
+            return None
+        mac, learned_at = entry
+        if time.time() - learned_at > self.cache_timeout:
+            del self.ip_to_mac[ip]
+            return None
+        return mac
+
+    def learn(self, ip, mac):
+        if ip in self.static_entries or ip == '0.0.0.0':
+            return
+        self.ip_to_mac[ip] = (mac, time.time())
+
+    def expire(self):
+        """Drop aged cache entries and stale flood-suppression records"""
+        now = time.time()
+        for ip, (_, learned_at) in list(self.ip_to_mac.items()):
+            if now - learned_at > self.cache_timeout:
+                del self.ip_to_mac[ip]
+        for key, flooded_at in list(self.recent_floods.items()):
+            if now - flooded_at > self.flood_suppress_interval:
+                del self.recent_floods[key]
+
+    def punt_flow(self, datapath):
+        """(priority, match, actions) of the flow sending ARP requests (and only requests) to the controller"""
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        match = parser.OFPMatch(eth_type=ether_types.ETH_TYPE_ARP, arp_op=arp.ARP_REQUEST)
+        actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER, ofproto.OFPCML_NO_BUFFER)]
+        return self.ARP_PRIORITY, match, actions
+
+    def handle_packet_in(self, msg, pkt, in_port):
+        """Handle an ARP packet-in.
+
+        Returns True if the packet was ARP and has been dealt with (answered,
+        flooded or suppressed), False if the caller should forward it as usual.
+        """
+        if msg is self._last_msg:
+            return self._last_result
+        self._last_msg = msg
+        self._last_result = self._handle(msg, pkt, in_port)
+        return self._last_result
+
+    def _handle(self, msg, pkt, in_port):
+        arp_pkt = pkt.get_protocol(arp.arp)
+        if arp_pkt is None:
+            return False
+
+        self.learn(arp_pkt.src_ip, arp_pkt.src_mac)
+        if arp_pkt.opcode != arp.ARP_REQUEST:
+            # Replies are forwarded by the normal L2 path
+            return False
+        if arp_pkt.src_ip == arp_pkt.dst_ip:
+            # Gratuitous ARP: the cache has been refreshed, nothing to answer
+            return True
+
+        self.stats['requests'] += 1
+        datapath = msg.datapath
+        target_mac = self.lookup(arp_pkt.dst_ip)
+        if target_mac is not None:
+            self.send_reply(datapath, in_port, arp_pkt, target_mac)
+            return True
+
+        # Unknown target: flood once per switch, drop repeats of the same request
+        self.expire()
+        key = (datapath.id, arp_pkt.src_ip, arp_pkt.dst_ip)
+        if key in self.recent_floods:
+            self.stats['suppressed'] += 1
+            return True
+        self.recent_floods[key] = time.time()
+        self.stats['floods'] += 1
+
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        data = None
+        if msg.buffer_id == ofproto.OFP_NO_BUFFER:
+            data = msg.data
+        actions = [parser.OFPActionOutput(ofproto.OFPP_FLOOD)]
+        out = parser.OFPPacketOut(datapath=datapath, buffer_id=msg.buffer_id,
+                                  in_port=in_port, actions=actions, data=data)
+        datapath.send_msg(out)
+        return True
+
+    def send_reply(self, datapath, port, request, target_mac):
+        """Answer request on behalf of its target"""
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+
+        reply = packet.Packet()
+        reply.add_protocol(ethernet.ethernet(ethertype=ether_types.ETH_TYPE_ARP,
+                                             dst=request.src_mac, src=target_mac))
+        reply.add_protocol(arp.arp(opcode=arp.ARP_REPLY,
+                                   src_mac=target_mac, src_ip=request.dst_ip,
+                                   dst_mac=request.src_mac, dst_ip=request.src_ip))
+        reply.serialize()
+
+        actions = [parser.OFPActionOutput(port)]
+        out = parser.OFPPacketOut(datapath=datapath, buffer_id=ofproto.OFP_NO_BUFFER,
+                                  in_port=ofproto.OFPP_CONTROLLER, actions=actions,
+                                  data=reply.data)
+        datapath.send_msg(out)
+        self.stats['replies_sent'] += 1
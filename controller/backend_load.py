@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# Load tracking and selection for load-balancer backends (EWMA of switch counters)
+
+import random
+
+class BackendLoadTracker(object):
+    """Smoothed per-backend load built from periodic port/flow stats replies.
+
+    Active flows are the number of load-balancer flows pointing at each
+    backend, summed over the switches and EWMA-smoothed once per poll round.
+    Backends picked since the last round are counted as pending, so a burst
+    of new clients between two polls does not all land on the same backend.
+
+    Bytes are what the switch port facing each backend sent in a poll round.
+    Balancing on sent bytes alone is unstable: it is offered load, not
+    backlog, and any bias in the estimate piles up on the smaller backends.
+    The bandwidth load therefore also carries the bytes a backend was sent
+    beyond its capacity share, which drain as soon as it gets less than its
+    share (so the term stays bounded while the total is below capacity), and
+    an in-flight estimate for new assignments that decays every round as
+    their bytes show up in the counters. Shares follow the capacity weights,
+    which must be set to the backends' relative capacities.
+    """
+
+    def __init__(self, num_backends, alpha=0.3):
+        self.alpha = alpha
+        self.flows = [0.0] * num_backends       # EWMA of active flows
+        self.pending = [0] * num_backends       # assignments since the last poll round
+        self.bytes = [0.0] * num_backends       # EWMA of bytes sent per poll round
+        self.excess = [0.0] * num_backends      # bytes sent beyond the capacity share, not drained yet
+        self.in_flight = [0.0] * num_backends   # assignments not yet seen in the byte counters
+        self.round_bytes = 0.0                  # EWMA of bytes per round, all backends
+        self.round_assignments = 0.0            # EWMA of assignments per round
+        self.assigned = 0                       # assignments in the current round
+
+    def update_flow_counts(self, active_flows):
+        """Feed one poll round: the number of flows steering traffic to each backend"""
+        for index, count in enumerate(active_flows):
+            self.flows[index] += self.alpha * (count - self.flows[index])
+        self.pending = [0] * len(self.flows)
+
+    def update_bytes(self, sent, weights):
+        """Feed one poll round: bytes sent towards each backend (None if unknown or inactive)"""
+        total = sum(value for value in sent if value is not None)
+        total_weight = sum(weight for value, weight in zip(sent, weights) if value is not None)
+        for index, value in enumerate(sent):
+            if value is None:
+                continue
+            self.bytes[index] += self.alpha * (value - self.bytes[index])
+            share = total * weights[index] / total_weight
+            self.excess[index] = max(0.0, self.excess[index] + value - share)
+            self.in_flight[index] *= 1.0 - self.alpha
+        self.round_bytes += self.alpha * (total - self.round_bytes)
+        self.round_assignments += self.alpha * (self.assigned - self.round_assignments)
+        self.assigned = 0
+
+    def record_assignment(self, index):
+        self.pending[index] += 1
+        self.in_flight[index] += 1
+        self.assigned += 1
+
+    def load(self, index, weight=1, algorithm='least_connections'):
+        """Load of a backend, normalised by its capacity weight"""
+        if algorithm == 'least_bandwidth':
+            bytes_per_assignment = self.round_bytes / max(self.round_assignments, 1.0)
+            value = (self.bytes[index] + self.excess[index] +
+                     self.in_flight[index] * bytes_per_assignment)
+        else:
+            value = self.flows[index] + self.pending[index]
+        return value / weight
+
+    def choose(self, candidates, weights=None, two_choices=True, rng=random, algorithm='least_connections'):
+        """Pick the least loaded backend index out of candidates.
+
+        With two_choices the decision compares two random candidates (O(1),
+        and avoids herding onto the backend that only looks idle because its
+        counters are stale); otherwise all candidates are scanned.
+        """
+        if not candidates:
+            return None
+        if weights is None:
+            weights = [1] * len(self.flows)
+        if two_choices and len(candidates) > 2:
+            pool = rng.sample(candidates, 2)
+        else:
+            pool = candidates
+        best = min(pool, key=lambda i: (self.load(i, weights[i], algorithm), rng.random()))
+        self.record_assignment(best)
+        return best
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# Compact TCP connection tracking for the firewall (conntrack-lite)
+
+import socket
+import struct
+import time
+from array import array
+
+# Connection states
+EMPTY = 0
+SYN_SENT = 1
+SYN_RECV = 2
+ESTABLISHED = 3
+FIN_WAIT = 4
+CLOSED = 5
+DELETED = 255  # tombstone left behind by a removed entry
+
+STATE_NAMES = {SYN_SENT: 'SYN_SENT', SYN_RECV: 'SYN_RECV', ESTABLISHED: 'ESTABLISHED',
+               FIN_WAIT: 'FIN_WAIT', CLOSED: 'CLOSED'}
+
+# TCP flag bits (as in ryu.lib.packet.tcp)
+TCP_FIN = 0x001
+TCP_SYN = 0x002
+TCP_RST = 0x004
+TCP_ACK = 0x010
+
+# Per-slot flag bits
+_ORIG_IS_LOW = 0x01  # the connection initiator is the lower (ip, port) endpoint
+_FIN_ORIG = 0x02     # initiator has sent FIN
+_FIN_REPLY = 0x04    # responder has sent FIN
+
+# Packed key: low ip, high ip, low port, high port, protocol (13 bytes)
+_KEY = struct.Struct('!4s4sHHB')
+KEY_SIZE = _KEY.size
+
+def pack_key(src_ip, dst_ip, src_port, dst_port, proto=6):
+    """Pack a 5-tuple into a direction-independent key.
+
+    Returns (key, src_is_low) where src_is_low tells which side of the key
+    the packet's source is on.
+    """
+    src = socket.inet_aton(src_ip)
+    dst = socket.inet_aton(dst_ip)
+    if (src, src_port) <= (dst, dst_port):
+        return _KEY.pack(src, dst, src_port, dst_port, proto), True
+    return _KEY.pack(dst, src, dst_port, src_port, proto), False
+
+class ConnTrack(object):
+    """Open-addressing hash table of TCP connections backed by flat arrays.
+
+    Each slot costs KEY_SIZE bytes of key, one state byte, one flag byte and a
+    4-byte expiry (seconds since the table was created), i.e. 19 bytes. The
+    table grows by doubling at max_load, so steady-state cost stays well under
+    64 bytes per tracked connection. Linear probing; removed entries leave
+    tombstones that are cleaned up on the next resize.
+    """
+
+    # Seconds an entry stays valid after its last packet, per state. Established
+    # connections are forwarded by switch flows, so the controller only sees them
+    # again after those flows idle out - keep them as long as Linux conntrack does.
+    TIMEOUTS = {SYN_SENT: 30, SYN_RECV: 30, ESTABLISHED: 432000, FIN_WAIT: 60, CLOSED: 10}
+
+    def __init__(self, capacity=1024, max_load=0.7, timeouts=None):
+        size = 8
+        while size < capacity:
+            size *= 2
+        self.max_load = max_load
+        self.timeouts = dict(self.TIMEOUTS)
+        if timeouts:
+            self.timeouts.update(timeouts)
+        self.epoch = time.time()
+        self.count = 0        # live entries
+        self.tombstones = 0
+        self._allocate(size)
+
+    def _allocate(self, size):
+        self.size = size
+        self.mask = size - 1
+        self.keys = bytearray(size * KEY_SIZE)
+        self.states = bytearray(size)
+        self.flags = bytearray(size)
+        self.expires = array('I', bytes(4 * size))
+
+    def __len__(self):
+        return self.count
+
+    def memory_bytes(self):
+        """Bytes used by the table storage"""
+        return len(self.keys) + len(self.states) + len(self.flags) + \
+            self.expires.itemsize * len(self.expires)
+
+    def _now(self, now):
+        if now is None:
+            now = time.time()
+        return int(now - self.epoch)
+
+    def _find(self, key):
+        """Return (slot, found); slot is where key lives or should be inserted"""
+        slot = hash(key) & self.mask
+        first_free = -1
+        keys = self.keys
+        states = self.states
+        while True:
+            state = states[slot]
+            if state == EMPTY:
+                return (first_free if first_free >= 0 else slot), False
+            if state == DELETED:
+                if first_free < 0:
+                    first_free = slot
+            else:
+                offset = slot * KEY_SIZE
+                if keys[offset:offset + KEY_SIZE] == key:
+                    return slot, True
+            slot = (slot + 1) & self.mask
+
+    def _resize(self, size):
+        old_keys, old_states, old_flags, old_expires = self.keys, self.states, self.flags, self.expires
+        old_size = self.size
+        self._allocate(size)
+        self.tombstones = 0
+        for slot in range(old_size):
+            state = old_states[slot]
+            if state == EMPTY or state == DELETED:
+                continue
+            key = bytes(old_keys[slot * KEY_SIZE:(slot + 1) * KEY_SIZE])
+            new_slot, _ = self._find(key)
+            self._store(new_slot, key, state, old_flags[slot], old_expires[slot])
+
+    def _store(self, slot, key, state, flags, expires):
+        offset = slot * KEY_SIZE
+        self.keys[offset:offset + KEY_SIZE] = key
+        self.states[slot] = state
+        self.flags[slot] = flags
+        self.expires[slot] = expires
+
+    def _remove(self, slot):
+        self.states[slot] = DELETED
+        self.count -= 1
+        self.tombstones += 1
+
+    def _insert(self, key, state, flags, now):
+        if (self.count + self.tombstones + 1) > self.size * self.max_load:
+            # Grow if live entries are the problem, otherwise just purge tombstones
+            grow = (self.count + 1) > self.size * self.max_load / 2
+            self._resize(self.size * 2 if grow else self.size)
+        slot, _ = self._find(key)
+        if self.states[slot] == DELETED:
+            self.tombstones -= 1
+        self._store(slot, key, state, flags, now + self.timeouts[state])
+        self.count += 1
+
+    def lookup(self, src_ip, dst_ip, src_port, dst_port, proto=6, now=None):
+        """Return the state of a connection, or None if untracked/expired"""
+        key, _ = pack_key(src_ip, dst_ip, src_port, dst_port, proto)
+        slot, found = self._find(key)
+        if not found:
+            return None
+        if self.expires[slot] < self._now(now):
+            self._remove(slot)
+            return None
+        return self.states[slot]
+
+    def update(self, src_ip, dst_ip, src_port, dst_port, tcp_flags, proto=6, now=None):
+        """Advance the connection state for one TCP packet.
+
+        Returns (state, established) where established is True only for the
+        packet that completes the three-way handshake. state is None if the
+        packet does not belong to a tracked connection and does not start one.
+        """
+        now = self._now(now)
+        key, src_is_low = pack_key(src_ip, dst_ip, src_port, dst_port, proto)
+        slot, found = self._find(key)
+        if found and self.expires[slot] < now:
+            self._remove(slot)
+            found = False
+
+        syn = tcp_flags & TCP_SYN
+        ack = tcp_flags & TCP_ACK
+        if not found:
+            if syn and not ack:
+                self._insert(key, SYN_SENT, _ORIG_IS_LOW if src_is_low else 0, now)
+                return SYN_SENT, False
+            return None, False
+
+        state = self.states[slot]
+        flags = self.flags[slot]
+        from_orig = bool(flags & _ORIG_IS_LOW) == src_is_low
+        established = False
+
+        if tcp_flags & TCP_RST:
+            state = CLOSED
+        elif state == SYN_SENT:
+            if syn and ack and not from_orig:
+                state = SYN_RECV
+        elif state == SYN_RECV:
+            if ack and not syn and from_orig:
+                state = ESTABLISHED
+                established = True
+        elif state in (ESTABLISHED, FIN_WAIT):
+            if tcp_flags & TCP_FIN:
+                flags |= _FIN_ORIG if from_orig else _FIN_REPLY
+                state = CLOSED if (flags & _FIN_ORIG and flags & _FIN_REPLY) else FIN_WAIT
+        elif state == CLOSED and syn and not ack:
+            # Port reuse: a fresh SYN restarts the connection
+            state = SYN_SENT
+            flags = _ORIG_IS_LOW if src_is_low else 0
+
+        self.states[slot] = state
+        self.flags[slot] = flags
+        self.expires[slot] = now + self.timeouts[state]
+        return state, established
+
+    def snapshot(self):
+        """Picklable copy of the table (slots are rehashed on restore)"""
+        return {'epoch': self.epoch, 'keys': bytes(self.keys), 'states': bytes(self.states),
+                'flags': bytes(self.flags), 'expires': self.expires.tobytes()}
+
+    def restore(self, snapshot):
+        """Replace the table contents with a snapshot taken by snapshot()"""
+        states = snapshot['states']
+        expires = array('I')
+        expires.frombytes(snapshot['expires'])
+        # Expiry times are relative to the epoch of the table that was saved
+        shift = int(snapshot['epoch'] - self.epoch)
+        live = [slot for slot in range(len(states)) if states[slot] not in (EMPTY, DELETED)]
+        size = 8
+        while size * self.max_load < 2 * max(len(live), 1):
+            size *= 2
+        self._allocate(size)
+        self.count = 0
+        self.tombstones = 0
+        keys = snapshot['keys']
+        for slot in live:
+            key = keys[slot * KEY_SIZE:(slot + 1) * KEY_SIZE]
+            new_slot, _ = self._find(key)
+            self._store(new_slot, key, states[slot], snapshot['flags'][slot], max(expires[slot] + shift, 0))
+            self.count += 1
+
+    def expire(self, now=None):
+        """Remove every timed-out entry; returns the number removed"""
+        return self.expire_slots(now, 0, self.size)[0]
+
+    def expire_slots(self, now=None, start=0, count=1024):
+        """Remove timed-out entries in count slots from start.
+
+        Returns (removed, next_start). A sweep may be split into several calls
+        with the table changing in between; entries moved by a resize are
+        caught by the next sweep.
+        """
+        now = self._now(now)
+        removed = 0
+        states = self.states
+        expires = self.expires
+        end = min(start + count, self.size)
+        for slot in range(start, end):
+            state = states[slot]
+            if state != EMPTY and state != DELETED and expires[slot] < now:
+                self._remove(slot)
+                removed += 1
+        return removed, end
@@ -6,14 +6,41 @@ from ryu.controller import ofp_event
 from ryu.controller.handler import CONFIG_DISPATCHER, MAIN_DISPATCHER, set_ev_cls
 from ryu.ofproto import ofproto_v1_3
 from ryu.lib.packet import packet, ethernet, ether_types, ipv4, tcp, udp
+from ryu.lib import hub
+import time
+
+from arp_proxy import ArpProxy
+from conntrack import ConnTrack, ESTABLISHED, STATE_NAMES
+from flow_reconcile import FlowReconciler
+from flow_table import FlowTableManager
+from flow_templates import MessageTemplates, build_actions
+from flow_timeouts import AdaptiveTimeouts
+from meter_pool import MeterPool
+from rule_classifier import RuleClassifier, rule_match_fields
+from rule_optimizer import optimize_rules
+from state_snapshot import StateSnapshot, snapshot_path
+from state_table import IPv4Table, MacTable
+from work_queue import WorkQueue
+import sharding
 
 class L2SwitchWithFirewall(app_manager.RyuApp):
     OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
+    _CONTEXTS = {'arp_proxy': ArpProxy, 'reconciler': FlowReconciler,
+                 'timeouts': AdaptiveTimeouts, 'flow_table': FlowTableManager,
+                 'work_queue': WorkQueue, 'meters': MeterPool}
     
     def __init__(self, *args, **kwargs):
         super(L2SwitchWithFirewall, self).__init__(*args, **kwargs)
-        self.mac_to_port = {}
-        # Firewall rules definition
+        self.mac_to_port = {}  # dpid -> MacTable
+        self.arp_proxy = kwargs['arp_proxy']
+        self.reconciler = kwargs['reconciler']
+        self.timeouts = kwargs['timeouts']
+        # Logging, DoS accounting and conntrack sweeps run after the packet-in is answered
+        self.work = kwargs['work_queue']
+        self.meters = kwargs['meters']
+        self.templates = MessageTemplates(self.logger)  # pre-serialized packet-in responses
+        # Firewall rules definition, first match wins. src_ip/dst_ip accept CIDR
+        # prefixes ('10.0.1.0/24'), ports a single port, a (low, high) tuple or '1000-2000'
         self.firewall_rules = [
             # Block all traffic from h1 to h2 (IP-based - more reliable than MAC)
             {'name': 'h1→h2-IP', 'src_ip': '10.0.0.1', 'dst_ip': '10.0.0.2', 'action': 'block'},
@@ -25,8 +52,60 @@ class L2SwitchWithFirewall(app_manager.RyuApp):
             {'name': 'dns-h1→h3', 'src_mac': '00:00:00:00:00:01', 'dst_mac': '00:00:00:00:00:03', 
              'udp_dst_port': 53, 'action': 'block'}
         ]
-        self.connection_track = {}  # Track connections for DoS protection
-        self.connection_limit = 50  # Max connections per source
+        # Host addresses (mininet/topology.py), so IP and MAC rules on the same
+        # hosts are reported as overlapping (both are kept: a host can change its MAC)
+        self.host_bindings = {'10.0.0.1': '00:00:00:00:00:01',
+                              '10.0.0.2': '00:00:00:00:00:02',
+                              '10.0.0.3': '00:00:00:00:00:03'}
+        # The optimized rule set is installed proactively and used for packet-ins
+        self.optimized_rules, report = optimize_rules(self.firewall_rules, self.host_bindings)
+        self.logger.info("Firewall rule set: %d rules -> %d (%d shadowed, %d redundant, %d merged), "
+                         "%d -> %d flow entries", report['rules_in'], report['rules_out'],
+                         len(report['shadowed']), len(report['redundant']), report['merged'],
+                         report['flows_in'], report['flows_out'])
+        for rule, other in report['overlaps']:
+            self.logger.info("Firewall rule %s overlaps %s for the configured host addresses",
+                             rule, other)
+        self.rule_classifier = RuleClassifier(self.optimized_rules)
+        # Forwarding flows for traffic an allow rule admitted go above every rule
+        # flow, on all the fields the rules look at
+        self.allowed_flow_priority = max([rule['priority'] for rule in self.optimized_rules] + [100]) + 1
+        # A source blocked by DoS protection is dropped above everything, its
+        # established connections and rule-allowed flows included
+        self.dos_block_priority = self.allowed_flow_priority + 1
+        # New TCP connections (SYNs) per source in the current connection_window, for
+        # DoS protection. Two tables take turns, even windows in one and odd in the
+        # other; each is stamped with the window it counts and emptied by the first
+        # count of a newer one. Shared by all workers when the controller runs sharded
+        # (the stamp is then kept in the shared table).
+        self.connection_window = 10  # seconds
+        self.connection_tracks = [sharding.shared_table('fw_connection_track_%d' % i, IPv4Table)
+                                  for i in range(2)]
+        self.connection_track_windows = [0, 0]  # window stamps of process-local tables
+        self.connection_limit = 50  # Max new connections per source per window
+        # What happens to a source over the limit: 'meter' rate-limits its TCP in
+        # the switch (new connections and established ones), 'drop' blocks it for
+        # 5 minutes. Metering needs stateful_tcp and falls back to 'drop' on
+        # switches without meters or with none left.
+        self.dos_action = 'meter'
+        self.dos_rate_limit = {'rate': 100, 'burst': 20, 'unit': 'pktps'}  # or 'kbps'
+        self.dos_meter_idle_timeout = 60  # seconds without SYNs before the limit is lifted
+        
+        # Stateful TCP filtering: TCP is punted to the controller until the
+        # three-way handshake completes, then bidirectional allow flows are
+        # installed for that connection. Packets that neither open nor belong
+        # to a tracked connection are dropped.
+        self.stateful_tcp = True
+        self.conntrack = ConnTrack()
+        self.conntrack_sweep_interval = 60  # seconds
+        self.conntrack_sweep_chunk = 4096  # slots expired between yields to the hub
+        self.last_conntrack_sweep = time.time()
+        
+        # Warm restart: reload the last snapshot, then keep snapshotting
+        self.snapshot_interval = 10  # seconds
+        self.snapshot = StateSnapshot(snapshot_path('firewall_vnf'))
+        self.restore_state(self.snapshot.load())
+        self.snapshot_thread = hub.spawn(self._snapshot_loop)
         self.logger.info("Firewall VNF initialized")
     
     @set_ev_cls(ofp_event.EventOFPSwitchFeatures, CONFIG_DISPATCHER)
@@ -34,145 +113,234 @@ class L2SwitchWithFirewall(app_manager.RyuApp):
         datapath = ev.msg.datapath
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
+        if sharding.reject_foreign_datapath(datapath, self.logger):
+            return
         
         # Install proactive firewall rules BEFORE table-miss
         self.logger.info("Installing proactive firewall rules on switch %s", datapath.id)
         
-        # Rule 1: Block h1→h2 (IP-based)
-        match = parser.OFPMatch(
-            eth_type=ether_types.ETH_TYPE_IP,
-            ipv4_src='10.0.0.1',
-            ipv4_dst='10.0.0.2'
-        )
-        self.add_flow(datapath, 100, match, [], hard_timeout=0)  # Priority 100, permanent
-        self.logger.info("🔥 Installed firewall rule: Block 10.0.0.1 → 10.0.0.2")
-        
-        # Rule 2: Block h1→h2 (MAC-based backup)
-        match = parser.OFPMatch(
-            eth_src='00:00:00:00:00:01',
-            eth_dst='00:00:00:00:00:02'
-        )
-        self.add_flow(datapath, 100, match, [], hard_timeout=0)
-        self.logger.info("🔥 Installed firewall rule: Block 00:00:00:00:00:01 → 00:00:00:00:00:02")
+        # Blocked traffic is dropped. Traffic allowed by a rule that shadows later
+        # block rules comes to the controller, which installs an exact forwarding
+        # flow above the rules for it (allowed_flow_priority)
+        for rule in self.optimized_rules:
+            if rule['action'] == 'block':
+                actions = []
+            else:
+                actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER, ofproto.OFPCML_NO_BUFFER)]
+            for fields in rule_match_fields(rule):
+                self.reconciler.ensure_flow(datapath, ev.msg, rule['priority'], parser.OFPMatch(**fields), actions)
+            self.logger.info("🔥 Installed firewall rule %s (%s)", rule['name'], rule['action'])
+        
+        # Send TCP to the controller (above the L2 flows) until a connection is established
+        if self.stateful_tcp:
+            match = parser.OFPMatch(eth_type=ether_types.ETH_TYPE_IP, ip_proto=6)
+            actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER, ofproto.OFPCML_NO_BUFFER)]
+            self.reconciler.ensure_flow(datapath, ev.msg, 5, match, actions)
+            self.logger.info("Stateful TCP tracking enabled on switch %s", datapath.id)
         
         # Install the table-miss flow entry (priority 0 - lowest)
         match = parser.OFPMatch()
         actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER, ofproto.OFPCML_NO_BUFFER)]
-        self.add_flow(datapath, 0, match, actions)
+        self.reconciler.ensure_flow(datapath, ev.msg, 0, match, actions)
         self.logger.info("Firewall table-miss flow installed on switch %s", datapath.id)
-    
-    def add_flow(self, datapath, priority, match, actions, buffer_id=None, idle_timeout=0, hard_timeout=0):
-        ofproto = datapath.ofproto
-        parser = datapath.ofproto_parser
-        
-        inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS, actions)]
         
-        if buffer_id:
-            mod = parser.OFPFlowMod(datapath=datapath, buffer_id=buffer_id,
-                                    priority=priority, match=match,
-                                    instructions=inst, idle_timeout=idle_timeout,
-                                    hard_timeout=hard_timeout)
-        else:
-            mod = parser.OFPFlowMod(datapath=datapath, priority=priority,
-                                    match=match, instructions=inst,
-                                    idle_timeout=idle_timeout, 
-                                    hard_timeout=hard_timeout)
-        datapath.send_msg(mod)
+        # ARP requests are answered by the controller instead of being flooded
+        self.reconciler.ensure_flow(datapath, ev.msg, *self.arp_proxy.punt_flow(datapath))
+    
+    def snapshot_state(self):
+        state = {'mac_to_port': self.mac_to_port, 'conntrack': self.conntrack.snapshot()}
+        if isinstance(self.connection_tracks[0], IPv4Table):
+            # Shared tables already live outside the process
+            state['connection_track_windows'] = self.connection_track_windows
+            state['connection_tracks'] = self.connection_tracks
+        return state
+    
+    def restore_state(self, state):
+        if not state:
+            return
+        self.mac_to_port = {dpid: MacTable(ports) for dpid, ports in state.get('mac_to_port', {}).items()}
+        if 'conntrack' in state:
+            self.conntrack.restore(state['conntrack'])
+        # DoS counters keep their window stamps: stale ones are emptied on first use
+        if isinstance(self.connection_tracks[0], IPv4Table) and 'connection_track_windows' in state:
+            self.connection_track_windows = list(state['connection_track_windows'])
+            for table, saved in zip(self.connection_tracks, state['connection_tracks']):
+                table.update(saved)
+        self.logger.info("Restored firewall state: %d switches, %d tracked connections",
+                         len(self.mac_to_port), len(self.conntrack))
+    
+    def _snapshot_loop(self):
+        while True:
+            hub.sleep(self.snapshot_interval)
+            # Serializing copies the state on the hub; the file IO runs in a native thread
+            self.work.run_blocking(self.snapshot.write, self.snapshot.serialize(self.snapshot_state()))
+    
+    def stop(self):
+        self.snapshot.save(self.snapshot_state())
+        super(L2SwitchWithFirewall, self).stop()
     
     def check_firewall_rules(self, datapath, parser, pkt, in_port, eth_src, eth_dst):
-        # Check if packet matches any firewall rule
+        """First firewall rule matching the packet, or None"""
         ip_pkt = pkt.get_protocol(ipv4.ipv4)
         tcp_pkt = pkt.get_protocol(tcp.tcp)
         udp_pkt = pkt.get_protocol(udp.udp)
         
-        for rule in self.firewall_rules:
-            # Skip rule if src_mac is specified and doesn't match
-            if 'src_mac' in rule and rule['src_mac'] != eth_src:
-                continue
-                
-            # Skip rule if dst_mac is specified and doesn't match
-            if 'dst_mac' in rule and rule['dst_mac'] != eth_dst:
-                continue
-            
-            # Skip rule if ip_proto is specified and packet is not IP
-            if ('ip_proto' in rule or 'src_ip' in rule or 'dst_ip' in rule) and not ip_pkt:
-                continue
-                
-            # Skip rule if src_ip is specified and doesn't match
-            if 'src_ip' in rule and rule['src_ip'] != ip_pkt.src:
-                continue
-                
-            # Skip rule if dst_ip is specified and doesn't match
-            if 'dst_ip' in rule and rule['dst_ip'] != ip_pkt.dst:
-                continue
-            
-            # TCP specific checks
-            if 'tcp_src_port' in rule or 'tcp_dst_port' in rule:
-                if not tcp_pkt:
-                    continue
-                if 'tcp_src_port' in rule and rule['tcp_src_port'] != tcp_pkt.src_port:
-                    continue
-                if 'tcp_dst_port' in rule and rule['tcp_dst_port'] != tcp_pkt.dst_port:
-                    continue
-            
-            # UDP specific checks
-            if 'udp_src_port' in rule or 'udp_dst_port' in rule:
-                if not udp_pkt:
-                    continue
-                if 'udp_src_port' in rule and rule['udp_src_port'] != udp_pkt.src_port:
-                    continue
-                if 'udp_dst_port' in rule and rule['udp_dst_port'] != udp_pkt.dst_port:
-                    continue
-            
-            # If we get here, all specified conditions match
-            if rule['action'] == 'block':
-                self.logger.info("Firewall: blocked traffic by rule %s: %s → %s", 
-                                rule['name'], eth_src, eth_dst)
-                
-                # Create a match for this rule
-                match_fields = {}
-                match_fields['eth_src'] = eth_src
-                match_fields['eth_dst'] = eth_dst
-                
-                if ip_pkt:
-                    match_fields['eth_type'] = ether_types.ETH_TYPE_IP
-                    match_fields['ipv4_src'] = ip_pkt.src
-                    match_fields['ipv4_dst'] = ip_pkt.dst
-                    
-                    if tcp_pkt and ('tcp_src_port' in rule or 'tcp_dst_port' in rule):
-                        match_fields['ip_proto'] = 6  # TCP
-                        if 'tcp_src_port' in rule:
-                            match_fields['tcp_src'] = tcp_pkt.src_port
-                        if 'tcp_dst_port' in rule:
-                            match_fields['tcp_dst'] = tcp_pkt.dst_port
-                    
-                    if udp_pkt and ('udp_src_port' in rule or 'udp_dst_port' in rule):
-                        match_fields['ip_proto'] = 17  # UDP
-                        if 'udp_src_port' in rule:
-                            match_fields['udp_src'] = udp_pkt.src_port
-                        if 'udp_dst_port' in rule:
-                            match_fields['udp_dst'] = udp_pkt.dst_port
-                
-                # Install a flow to block this traffic
-                match = parser.OFPMatch(**match_fields)
-                self.add_flow(datapath, 100, match, [], hard_timeout=3600)  # Priority 100, 1 hour timeout
-                return True
-        
-        # DoS protection - track connections per source
-        if ip_pkt and tcp_pkt:
-            src_ip = ip_pkt.src
-            if src_ip not in self.connection_track:
-                self.connection_track[src_ip] = 1
+        l4_pkt = tcp_pkt or udp_pkt
+        sport, dport = (l4_pkt.src_port, l4_pkt.dst_port) if l4_pkt else (0, 0)
+        if ip_pkt:
+            rule = self.rule_classifier.classify(eth_src, eth_dst, ip_pkt.src, ip_pkt.dst,
+                                                 ip_pkt.proto, sport, dport)
+        else:
+            rule = self.rule_classifier.classify(eth_src, eth_dst)
+        
+        if rule and rule['action'] == 'block':
+            # The rule's proactive drop flow is on the switch; packets reach the
+            # controller only while it is being installed, so just drop them
+            self.work.log(self.logger.info, "Firewall: blocked traffic by rule %s: %s → %s",
+                          rule['name'], eth_src, eth_dst)
+            return rule
+        
+        # DoS protection - count new connection attempts (SYN without ACK) per source
+        # and window. Counted off the fast path (the shared table may take a lock) and
+        # never shed; a source over the limit is limited at the switch once the count is in.
+        if ip_pkt and tcp_pkt and tcp_pkt.bits & tcp.TCP_SYN and not tcp_pkt.bits & tcp.TCP_ACK:
+            self.work.submit(self.count_connection, datapath, ip_pkt.src, shed=False)
+        
+        return rule
+    
+    def count_connection(self, datapath, src_ip):
+        """Count a new connection from src_ip and limit or block the source over the limit"""
+        window = int(time.time() // self.connection_window)
+        count = self.update_connection_table(self.count_in_window, window, src_ip)
+        if count > self.connection_limit:
+            if self.dos_action == 'meter' and self.stateful_tcp and self.rate_limit_source(datapath, src_ip):
+                return
+            self.logger.warning("DoS protection: blocking excess connections from %s", src_ip)
+            match = {'eth_type': ether_types.ETH_TYPE_IP, 'ipv4_src': src_ip}
+            self.templates.add_flow(datapath, self.dos_block_priority, match, [], hard_timeout=300)  # Block for 5 minutes
+    
+    def count_in_window(self, window, src_ip):
+        # Only the window's own table is emptied, and only if it holds an older
+        # window: the other table may still be counted in by workers whose clock
+        # is a little behind
+        table = self.connection_tracks[window % 2]
+        if isinstance(table, sharding.SharedTable):
+            table.clear_if_older(window)
+        elif self.connection_track_windows[window % 2] < window:
+            table.clear()
+            self.connection_track_windows[window % 2] = window
+        return table.increment(src_ip)
+    
+    def update_connection_table(self, fn, *args):
+        # A shared table's flock waits for the other workers: keep it off the hub
+        if isinstance(self.connection_tracks[0], sharding.SharedTable):
+            return self.work.run_blocking(fn, *args)
+        return fn(*args)
+    
+    def sweep_conntrack(self, now):
+        """Expire timed-out connections a chunk of slots at a time, yielding in between"""
+        start = 0
+        while start < self.conntrack.size:
+            _, start = self.conntrack.expire_slots(now, start, self.conntrack_sweep_chunk)
+            hub.sleep(0)
+    
+    def rate_limit_source(self, datapath, src_ip):
+        """Send src_ip's new connections through a meter; False if no meter is available"""
+        parser = datapath.ofproto_parser
+        if self.meters.meter_for(datapath.id, src_ip) is not None:
+            # Already limited: the metered flow is on the switch until it idles out
+            # and the meter is reclaimed
+            return True
+        meter_id = self.meters.limit(datapath, src_ip, **self.dos_rate_limit)
+        if meter_id is None:
+            return False
+        self.logger.warning("DoS protection: rate limiting %s to %d %s (meter %d)", src_ip,
+                            self.dos_rate_limit['rate'], self.dos_rate_limit['unit'], meter_id)
+        # Above the TCP punt: the switch drops the source's SYNs beyond the rate
+        match = parser.OFPMatch(eth_type=ether_types.ETH_TYPE_IP, ip_proto=6, ipv4_src=src_ip)
+        actions = [parser.OFPActionOutput(datapath.ofproto.OFPP_CONTROLLER,
+                                          datapath.ofproto.OFPCML_NO_BUFFER)]
+        self.meters.add_flow(datapath, meter_id, 6, match, actions,
+                             idle_timeout=self.dos_meter_idle_timeout)
+        return True
+    
+    def allowed_flow_match(self, eth_src, eth_dst, ethertype, ip_pkt=None, sport=None, dport=None):
+        """Match on every field the firewall rules look at, so a flow admitted by an
+        allow rule covers no traffic a rule treats differently"""
+        match = {'eth_src': eth_src, 'eth_dst': eth_dst, 'eth_type': ethertype}
+        if ip_pkt:
+            match.update(ipv4_src=ip_pkt.src, ipv4_dst=ip_pkt.dst, ip_proto=ip_pkt.proto)
+            if ip_pkt.proto == 6:
+                match.update(tcp_src=sport, tcp_dst=dport)
+            elif ip_pkt.proto == 17:
+                match.update(udp_src=sport, udp_dst=dport)
+        return match
+    
+    def add_connection_flow(self, datapath, src_ip, match, actions, priority=30):
+        """Allow flow for one direction of a connection, through src_ip's meter if it has one"""
+        idle_timeout = self.timeouts.install(datapath, 'conntrack', priority, match)
+        meter_id = self.meters.meter_for(datapath.id, src_ip)
+        if meter_id is None:
+            self.templates.add_flow(datapath, priority, match, actions, idle_timeout=idle_timeout,
+                                    flags=datapath.ofproto.OFPFF_SEND_FLOW_REM)
+        else:
+            parser = datapath.ofproto_parser
+            self.meters.add_flow(datapath, meter_id, priority, parser.OFPMatch(**match),
+                                 build_actions(parser, actions), idle_timeout=idle_timeout)
+    
+    def handle_tcp_state(self, msg, in_port, ip_pkt, tcp_pkt, eth_src, eth_dst, allowed_by=None):
+        """Forward a TCP packet only if it opens or belongs to a tracked connection"""
+        datapath = msg.datapath
+        ofproto = datapath.ofproto
+        dpid = datapath.id
+        
+        now = time.time()
+        if now - self.last_conntrack_sweep > self.conntrack_sweep_interval:
+            self.last_conntrack_sweep = now
+            self.work.submit(self.sweep_conntrack, now, shed=False)
+        
+        state, established = self.conntrack.update(ip_pkt.src, ip_pkt.dst, tcp_pkt.src_port,
+                                                   tcp_pkt.dst_port, tcp_pkt.bits, now=now)
+        if state is None:
+            self.work.log(self.logger.info, "Firewall: dropped TCP %s:%s → %s:%s (no tracked connection)",
+                          ip_pkt.src, tcp_pkt.src_port, ip_pkt.dst, tcp_pkt.dst_port)
+            return
+        
+        out_port = self.mac_to_port[dpid].get(eth_dst, ofproto.OFPP_FLOOD)
+        actions = [('output', out_port)]
+        
+        # Handshake complete: let the rest of the connection bypass the controller
+        # in both directions. The switch idles the flows out; a later packet is
+        # punted again and re-admitted while the connection is still tracked.
+        if (established or state == ESTABLISHED) and out_port != ofproto.OFPP_FLOOD:
+            self.work.log(self.logger.info, "Firewall: connection %s:%s ↔ %s:%s %s, installing allow flows",
+                          ip_pkt.src, tcp_pkt.src_port, ip_pkt.dst, tcp_pkt.dst_port,
+                          STATE_NAMES[state])
+            match = {'eth_type': ether_types.ETH_TYPE_IP, 'ip_proto': 6,
+                     'ipv4_src': ip_pkt.src, 'ipv4_dst': ip_pkt.dst,
+                     'tcp_src': tcp_pkt.src_port, 'tcp_dst': tcp_pkt.dst_port}
+            if allowed_by:
+                # An allow rule's flow punts this traffic: go above it
+                match.update(eth_src=eth_src, eth_dst=eth_dst)
+                self.add_connection_flow(datapath, ip_pkt.src, match, actions, self.allowed_flow_priority)
+            else:
+                self.add_connection_flow(datapath, ip_pkt.src, match, actions)
+            reverse_match = {'eth_type': ether_types.ETH_TYPE_IP, 'ip_proto': 6,
+                             'ipv4_src': ip_pkt.dst, 'ipv4_dst': ip_pkt.src,
+                             'tcp_src': tcp_pkt.dst_port, 'tcp_dst': tcp_pkt.src_port}
+            reverse_rule = self.rule_classifier.classify(eth_dst, eth_src, ip_pkt.dst, ip_pkt.src, 6,
+                                                         tcp_pkt.dst_port, tcp_pkt.src_port)
+            if reverse_rule and reverse_rule['action'] == 'allow':
+                reverse_match.update(eth_src=eth_dst, eth_dst=eth_src)
+                self.add_connection_flow(datapath, ip_pkt.dst, reverse_match, [('output', in_port)],
+                                         self.allowed_flow_priority)
             else:
-                self.connection_track[src_ip] += 1
-                
-            if self.connection_track[src_ip] > self.connection_limit:
-                self.logger.warning("DoS protection: blocking excess connections from %s", src_ip)
-                match = parser.OFPMatch(eth_type=ether_types.ETH_TYPE_IP, ipv4_src=src_ip)
-                self.add_flow(datapath, 90, match, [], hard_timeout=300)  # Block for 5 minutes
-                return True
+                self.add_connection_flow(datapath, ip_pkt.dst, reverse_match, [('output', in_port)])
         
-        return False  # Not blocked
+        data = None
+        if msg.buffer_id == ofproto.OFP_NO_BUFFER:
+            data = msg.data
+        self.templates.packet_out(datapath, msg.buffer_id, in_port, actions, data)
     
     @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
     def _packet_in_handler(self, ev):
@@ -193,16 +361,30 @@ class L2SwitchWithFirewall(app_manager.RyuApp):
         src = eth.src
         dpid = datapath.id
         
-        self.logger.info("Firewall packet in switch %s: src=%s dst=%s in_port=%s", dpid, src, dst, in_port)
+        self.work.log(self.logger.info, "Firewall packet in switch %s: src=%s dst=%s in_port=%s",
+                      dpid, src, dst, in_port)
         
         # Check firewall rules
-        if self.check_firewall_rules(datapath, parser, pkt, in_port, src, dst):
+        rule = self.check_firewall_rules(datapath, parser, pkt, in_port, src, dst)
+        if rule and rule['action'] == 'block':
             return  # Packet blocked, no need to process further
         
         # Learn MAC address to avoid FLOOD next time
-        self.mac_to_port.setdefault(dpid, {})
+        if dpid not in self.mac_to_port:
+            self.mac_to_port[dpid] = MacTable()
         self.mac_to_port[dpid][src] = in_port
         
+        # Answer ARP from the controller's cache instead of flooding it
+        if eth.ethertype == ether_types.ETH_TYPE_ARP and self.arp_proxy.handle_packet_in(msg, pkt, in_port):
+            return
+        
+        # TCP goes through connection tracking instead of the plain L2 path
+        ip_pkt = pkt.get_protocol(ipv4.ipv4)
+        tcp_pkt = pkt.get_protocol(tcp.tcp)
+        if self.stateful_tcp and ip_pkt and tcp_pkt:
+            self.handle_tcp_state(msg, in_port, ip_pkt, tcp_pkt, src, dst, rule)
+            return
+        
         # If the destination is known, forward to the specific port
         # Otherwise, flood to all ports
         if dst in self.mac_to_port[dpid]:
@@ -210,26 +392,35 @@ class L2SwitchWithFirewall(app_manager.RyuApp):
         else:
             out_port = ofproto.OFPP_FLOOD
         
-        actions = [parser.OFPActionOutput(out_port)]
+        actions = [('output', out_port)]
         
         # Install a flow to avoid packet_in next time
         if out_port != ofproto.OFPP_FLOOD:
-            match = parser.OFPMatch(in_port=in_port, eth_dst=dst)
+            priority = 1
+            match = {'in_port': in_port, 'eth_dst': dst}
+            if rule:
+                # Admitted by an allow rule whose flow punts: forward just this traffic above it
+                l4_pkt = pkt.get_protocol(udp.udp) or tcp_pkt
+                priority = self.allowed_flow_priority
+                match = dict(in_port=in_port, **self.allowed_flow_match(
+                    src, dst, eth.ethertype, ip_pkt,
+                    l4_pkt.src_port if l4_pkt else None, l4_pkt.dst_port if l4_pkt else None))
             # Verify if we have a valid buffer_id, if yes avoid sending both flow_mod & packet_out
+            idle_timeout = self.timeouts.install(datapath, 'l2', priority, match)
             if msg.buffer_id != ofproto.OFP_NO_BUFFER:
-                self.add_flow(datapath, 1, match, actions, msg.buffer_id, idle_timeout=300)
+                self.templates.add_flow(datapath, priority, match, actions, msg.buffer_id,
+                                        idle_timeout=idle_timeout, flags=ofproto.OFPFF_SEND_FLOW_REM)
                 return
             else:
-                self.add_flow(datapath, 1, match, actions, idle_timeout=300)
+                self.templates.add_flow(datapath, priority, match, actions, idle_timeout=idle_timeout,
+                                        flags=ofproto.OFPFF_SEND_FLOW_REM)
         
         # Forward the packet
         data = None
         if msg.buffer_id == ofproto.OFP_NO_BUFFER:
             data = msg.data
             
-        out = parser.OFPPacketOut(datapath=datapath, buffer_id=msg.buffer_id,
-                                  in_port=in_port, actions=actions, data=data)
-        datapath.send_msg(out)
+        self.templates.packet_out(datapath, msg.buffer_id, in_port, actions, data)
 
         
         # Check controller logs
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# Flow-table reconciliation for proactive flows on switch (re)connect
+
+from ryu.base import app_manager
+from ryu.controller import ofp_event
+from ryu.controller.handler import CONFIG_DISPATCHER, MAIN_DISPATCHER, set_ev_cls
+from ryu.ofproto import ofproto_v1_3
+from ryu.lib import hub
+
+# Cookie of every flow installed through ensure_flow(); flows tagged with it
+# that no app asks for any more are deleted on reconnect
+PROACTIVE_COOKIE = 0x5052 << 48
+COOKIE_TAG_MASK = 0xFFFF << 48
+
+def instructions_key(instructions):
+    """Wire encoding of a list of instructions, used to compare flows"""
+    buf = bytearray()
+    for inst in instructions:
+        # Switches may report an empty apply-actions (drop) as no instruction at all
+        if getattr(inst, 'actions', None) == []:
+            continue
+        inst.serialize(buf, len(buf))
+    return bytes(buf)
+
+def match_key(match):
+    return tuple(sorted((k, str(v)) for k, v in match.items()))
+
+class FlowReconciler(app_manager.RyuApp):
+    """Install the apps' proactive flows, sending only what the switch lacks.
+
+    Shared by the apps as a Ryu context. On every switch connection the apps
+    hand their proactive flows to ensure_flow() instead of adding them
+    blindly. The reconciler reads the switch's flow table once per connection
+    (flow stats) and sends a FlowMod only for flows that are missing or whose
+    instructions/timeouts differ. A switch that kept its table across a
+    controller restart therefore gets no FlowMods at all. If the stats reply
+    does not arrive within reply_timeout the pending flows are sent anyway.
+
+    Proactive flows carry PROACTIVE_COOKIE. reply_timeout after the stats
+    reply, when every app has had its say, flows with that cookie that no app
+    asked for on this connection (e.g. a firewall rule removed from the
+    configuration) are deleted. Other apps' reactive flows are left alone.
+    """
+
+    OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
+
+    def __init__(self, *args, **kwargs):
+        super(FlowReconciler, self).__init__(*args, **kwargs)
+        self.reply_timeout = 2.0  # seconds
+        self.connections = {}     # dpid -> per-connection reconciliation state
+        self.stats = {'flows_checked': 0, 'flow_mods_sent': 0, 'flow_mods_skipped': 0,
+                      'flows_deleted': 0}
+
+    def ensure_flow(self, datapath, features_msg, priority, match, actions,
+                    idle_timeout=0, hard_timeout=0):
+        """Make sure a flow exists on datapath (for the connection of features_msg)"""
+        conn = self.connections.get(datapath.id)
+        if conn is None or conn['features'] is not features_msg:
+            conn = self._start(datapath, features_msg)
+
+        parser = datapath.ofproto_parser
+        inst = [parser.OFPInstructionActions(datapath.ofproto.OFPIT_APPLY_ACTIONS, actions)]
+        key = (priority, match_key(match))
+        value = (instructions_key(inst), idle_timeout, hard_timeout)
+        if key in conn['desired'] and conn['desired'][key][0] == value:
+            return  # Already requested by another app on this connection
+        conn['desired'][key] = (value, priority, match, inst, idle_timeout, hard_timeout)
+
+        if conn['existing'] is None:
+            conn['pending'].append(key)
+        else:
+            self._reconcile(datapath, conn, [key])
+
+    def _start(self, datapath, features_msg):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        req = parser.OFPFlowStatsRequest(datapath, 0, ofproto.OFPTT_ALL, ofproto.OFPP_ANY,
+                                         ofproto.OFPG_ANY, 0, 0, parser.OFPMatch())
+        datapath.set_xid(req)
+        conn = {'features': features_msg, 'datapath': datapath, 'xid': req.xid,
+                'desired': {}, 'pending': [], 'existing': None, 'reply': {}, 'proactive': {}}
+        self.connections[datapath.id] = conn
+        datapath.send_msg(req)
+        hub.spawn(self._timeout, conn)
+        return conn
+
+    def _timeout(self, conn):
+        hub.sleep(self.reply_timeout)
+        if conn['existing'] is None and self.connections.get(conn['datapath'].id) is conn:
+            self.logger.warning("No flow stats from switch %s, installing proactive flows blindly",
+                                conn['datapath'].id)
+            conn['existing'] = {}
+            self._reconcile(conn['datapath'], conn, conn['pending'])
+            conn['pending'] = []
+
+    # The reply can arrive before the handshake has moved the switch to MAIN
+    @set_ev_cls(ofp_event.EventOFPFlowStatsReply, [CONFIG_DISPATCHER, MAIN_DISPATCHER])
+    def _flow_stats_reply_handler(self, ev):
+        msg = ev.msg
+        conn = self.connections.get(msg.datapath.id)
+        if conn is None or msg.xid != conn['xid'] or conn['existing'] is not None:
+            return
+        for stat in msg.body:
+            key = (stat.priority, match_key(stat.match))
+            if stat.cookie & COOKIE_TAG_MASK == PROACTIVE_COOKIE:
+                conn['reply'][key] = (instructions_key(stat.instructions), stat.idle_timeout,
+                                      stat.hard_timeout)
+                conn['proactive'][key] = stat.match
+            else:
+                # Same flow without our cookie: re-add it so it can be cleaned up later
+                conn['reply'][key] = None
+        if msg.flags & msg.datapath.ofproto.OFPMPF_REPLY_MORE:
+            return
+
+        conn['existing'] = conn.pop('reply')
+        self.logger.info("Switch %s has %d flows, reconciling %d proactive flows",
+                         msg.datapath.id, len(conn['existing']), len(conn['pending']))
+        self._reconcile(msg.datapath, conn, conn['pending'])
+        conn['pending'] = []
+        hub.spawn(self._remove_stale, conn)
+
+    def _remove_stale(self, conn):
+        hub.sleep(self.reply_timeout)
+        if self.connections.get(conn['datapath'].id) is not conn:
+            return
+        datapath = conn['datapath']
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        stale = [key for key in conn['proactive'] if key not in conn['desired']]
+        for key in stale:
+            mod = parser.OFPFlowMod(datapath=datapath, command=ofproto.OFPFC_DELETE_STRICT,
+                                    cookie=PROACTIVE_COOKIE, cookie_mask=COOKIE_TAG_MASK,
+                                    priority=key[0], match=conn['proactive'][key],
+                                    out_port=ofproto.OFPP_ANY, out_group=ofproto.OFPG_ANY)
+            datapath.send_msg(mod)
+            conn['existing'].pop(key, None)
+            self.stats['flows_deleted'] += 1
+        if stale:
+            self.logger.info("Switch %s: deleted %d proactive flows no app installs any more",
+                             datapath.id, len(stale))
+
+    def _reconcile(self, datapath, conn, keys):
+        parser = datapath.ofproto_parser
+        for key in keys:
+            value, priority, match, inst, idle_timeout, hard_timeout = conn['desired'][key]
+            self.stats['flows_checked'] += 1
+            if conn['existing'].get(key) == value:
+                self.stats['flow_mods_skipped'] += 1
+                continue
+            # Missing or stale: an add with the same priority and match replaces it
+            mod = parser.OFPFlowMod(datapath=datapath, cookie=PROACTIVE_COOKIE, priority=priority,
+                                    match=match, instructions=inst, idle_timeout=idle_timeout,
+                                    hard_timeout=hard_timeout)
+            datapath.send_msg(mod)
+            conn['existing'][key] = value
+            self.stats['flow_mods_sent'] += 1
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# Flow-table capacity tracking and least-recently-hit eviction
+
+import time
+
+from ryu.base import app_manager
+from ryu.controller import ofp_event
+from ryu.controller.handler import MAIN_DISPATCHER, DEAD_DISPATCHER, set_ev_cls
+from ryu.ofproto import ofproto_v1_3
+from ryu.lib import hub
+
+from flow_reconcile import match_key
+
+def is_drop(stat):
+    """Flow without any output action (firewall and DoS blocks)"""
+    return not any(getattr(inst, 'actions', None) for inst in stat.instructions)
+
+class FlowTableManager(app_manager.RyuApp):
+    """Keep switch flow tables below capacity by evicting idle reactive flows.
+
+    Shared by the apps as a Ryu context. Table capacity comes from the
+    switch's table features (max_entries); a switch that does not report it
+    gets the occupancy at its first OFPFMFC_TABLE_FULL error as capacity.
+    Occupancy is polled with table stats. Above track_watermark the flow
+    counters are polled too, and a flow whose packet count went up since the
+    last poll counts as hit at that poll. Above high_watermark, or on a
+    table-full error, the least recently hit flows (fewest bytes first among
+    equals) are deleted down to low_watermark. Only reactive flows with an
+    output action are evicted: permanent (proactive) flows and drop flows,
+    i.e. firewall and DoS blocks, are protected.
+
+    Packet-ins are counted per switch; those arriving while its table is
+    full are traffic that fell back to the slow path.
+    """
+
+    OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
+
+    def __init__(self, *args, **kwargs):
+        super(FlowTableManager, self).__init__(*args, **kwargs)
+        self.poll_interval = 10      # seconds
+        self.track_watermark = 0.7   # poll flow counters above this occupancy
+        self.high_watermark = 0.9    # start evicting
+        self.low_watermark = 0.8     # evict down to
+        self.table_id = 0
+        self.datapaths = {}
+        self.tables = {}             # dpid -> occupancy and flow hit state
+        self.metrics = {}            # dpid -> counters
+        self.monitor_thread = hub.spawn(self._monitor)
+
+    @set_ev_cls(ofp_event.EventOFPStateChange, [MAIN_DISPATCHER, DEAD_DISPATCHER])
+    def _state_change_handler(self, ev):
+        datapath = ev.datapath
+        if ev.state == MAIN_DISPATCHER:
+            self.datapaths[datapath.id] = datapath
+            self.tables[datapath.id] = {'max_entries': None, 'active': 0, 'full': False,
+                                        'lookups': 0, 'matched': 0, 'flows': {},
+                                        'flow_xid': None, 'reply': {}, 'reported': (0, 0)}
+            self.metrics.setdefault(datapath.id, {'packet_ins': 0, 'slow_path_packet_ins': 0,
+                                                  'table_full_errors': 0, 'evictions': 0,
+                                                  'occupancy': 0.0, 'miss_ratio': 0.0})
+            req = datapath.ofproto_parser.OFPTableFeaturesStatsRequest(datapath, 0)
+            datapath.send_msg(req)
+        elif ev.state == DEAD_DISPATCHER and datapath.id in self.datapaths:
+            del self.datapaths[datapath.id]
+            del self.tables[datapath.id]
+
+    def occupancy(self, dpid):
+        table = self.tables.get(dpid)
+        if not table or not table['max_entries']:
+            return 0.0
+        return table['active'] / float(table['max_entries'])
+
+    def _monitor(self):
+        while True:
+            hub.sleep(self.poll_interval)
+            for dpid, datapath in list(self.datapaths.items()):
+                self.report(dpid)
+                parser = datapath.ofproto_parser
+                datapath.send_msg(parser.OFPTableStatsRequest(datapath, 0))
+                if self.tables[dpid]['full'] or self.occupancy(dpid) >= self.track_watermark:
+                    self.request_flow_stats(datapath)
+
+    def report(self, dpid):
+        metrics = self.metrics[dpid]
+        table = self.tables[dpid]
+        packet_ins = metrics['packet_ins'] - table['reported'][0]
+        slow_path = metrics['slow_path_packet_ins'] - table['reported'][1]
+        table['reported'] = (metrics['packet_ins'], metrics['slow_path_packet_ins'])
+        if slow_path:
+            self.logger.warning("Switch %s table full (%d/%s entries): %d of %d packet-ins in the "
+                                "last %ds fell back to the slow path", dpid, table['active'],
+                                table['max_entries'], slow_path, packet_ins, self.poll_interval)
+
+    def request_flow_stats(self, datapath):
+        table = self.tables[datapath.id]
+        if table['flow_xid'] is not None:
+            return  # A request is still outstanding
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        req = parser.OFPFlowStatsRequest(datapath, 0, self.table_id, ofproto.OFPP_ANY,
+                                         ofproto.OFPG_ANY, 0, 0, parser.OFPMatch())
+        datapath.set_xid(req)
+        table['flow_xid'] = req.xid
+        table['reply'] = {}
+        datapath.send_msg(req)
+
+    @set_ev_cls(ofp_event.EventOFPTableFeaturesStatsReply, MAIN_DISPATCHER)
+    def _table_features_reply_handler(self, ev):
+        table = self.tables.get(ev.msg.datapath.id)
+        for features in ev.msg.body:
+            if table is not None and features.table_id == self.table_id and features.max_entries:
+                table['max_entries'] = features.max_entries
+                self.logger.info("Switch %s table %d holds up to %d flows",
+                                 ev.msg.datapath.id, self.table_id, features.max_entries)
+
+    @set_ev_cls(ofp_event.EventOFPTableStatsReply, MAIN_DISPATCHER)
+    def _table_stats_reply_handler(self, ev):
+        dpid = ev.msg.datapath.id
+        table = self.tables.get(dpid)
+        if table is None:
+            return
+        for stat in ev.msg.body:
+            if stat.table_id != self.table_id:
+                continue
+            lookups = stat.lookup_count - table['lookups']
+            matched = stat.matched_count - table['matched']
+            table.update(active=stat.active_count, lookups=stat.lookup_count,
+                         matched=stat.matched_count)
+            metrics = self.metrics[dpid]
+            metrics['occupancy'] = self.occupancy(dpid)
+            if lookups > 0:
+                metrics['miss_ratio'] = 1.0 - matched / float(lookups)
+        if table['full'] and self.occupancy(dpid) < self.high_watermark:
+            table['full'] = False
+
+    @set_ev_cls(ofp_event.EventOFPFlowStatsReply, MAIN_DISPATCHER)
+    def _flow_stats_reply_handler(self, ev):
+        msg = ev.msg
+        table = self.tables.get(msg.datapath.id)
+        if table is None or msg.xid != table['flow_xid']:
+            return
+        for stat in msg.body:
+            table['reply'][(stat.priority, match_key(stat.match))] = stat
+        if msg.flags & msg.datapath.ofproto.OFPMPF_REPLY_MORE:
+            return
+
+        # A flow is hit at this poll if its packet count went up since the last one
+        now = time.time()
+        flows = {}
+        for key, stat in table.pop('reply').items():
+            previous = table['flows'].get(key)
+            if previous is None or stat.packet_count > previous[0]:
+                flows[key] = (stat.packet_count, now, stat)
+            else:
+                flows[key] = (stat.packet_count, previous[1], stat)
+        table.update(flows=flows, reply={}, flow_xid=None, active=len(flows))
+        if table['full'] and not table['max_entries']:
+            table['max_entries'] = len(flows)
+        if table['full'] or self.occupancy(msg.datapath.id) >= self.high_watermark:
+            self.evict(msg.datapath)
+
+    def evict(self, datapath):
+        table = self.tables[datapath.id]
+        if not table['max_entries']:
+            return
+        excess = table['active'] - int(self.low_watermark * table['max_entries'])
+        candidates = [(last_hit, stat.byte_count, key, stat)
+                      for key, (_, last_hit, stat) in table['flows'].items()
+                      if (stat.idle_timeout or stat.hard_timeout) and not is_drop(stat)]
+        candidates.sort(key=lambda c: c[:2])
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        for _, _, key, stat in candidates[:max(excess, 0)]:
+            mod = parser.OFPFlowMod(datapath=datapath, table_id=stat.table_id,
+                                    command=ofproto.OFPFC_DELETE_STRICT, priority=stat.priority,
+                                    match=stat.match, out_port=ofproto.OFPP_ANY,
+                                    out_group=ofproto.OFPG_ANY)
+            datapath.send_msg(mod)
+            del table['flows'][key]
+            table['active'] -= 1
+            self.metrics[datapath.id]['evictions'] += 1
+        if excess > 0:
+            self.logger.info("Switch %s: evicted %d least recently hit flows (%d/%d entries)",
+                             datapath.id, min(excess, len(candidates)), table['active'],
+                             table['max_entries'])
+
+    @set_ev_cls(ofp_event.EventOFPErrorMsg, MAIN_DISPATCHER)
+    def _error_msg_handler(self, ev):
+        msg = ev.msg
+        datapath = msg.datapath
+        ofproto = datapath.ofproto
+        table = self.tables.get(datapath.id)
+        if (table is None or msg.type != ofproto.OFPET_FLOW_MOD_FAILED or
+                msg.code != ofproto.OFPFMFC_TABLE_FULL):
+            return
+        self.metrics[datapath.id]['table_full_errors'] += 1
+        if not table['full']:
+            self.logger.warning("Switch %s flow table full, FlowMods are failing", datapath.id)
+        table['full'] = True
+        if table['active'] and (not table['max_entries'] or table['max_entries'] > table['active']):
+            # The switch did not report its capacity, or fills up before reaching it
+            table['max_entries'] = table['active']
+        self.request_flow_stats(datapath)
+
+    @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
+    def _packet_in_handler(self, ev):
+        dpid = ev.msg.datapath.id
+        if dpid not in self.tables:
+            return
+        self.metrics[dpid]['packet_ins'] += 1
+        if self.tables[dpid]['full']:
+            self.metrics[dpid]['slow_path_packet_ins'] += 1
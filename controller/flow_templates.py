@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# Pre-serialized FlowMod and PacketOut messages for the packet-in fast path
+
+import socket
+import struct
+
+XID = struct.Struct('!I')
+LENGTH = struct.Struct('!H')
+FLOW_MOD_TIMEOUTS = struct.Struct('!HH')   # idle_timeout, hard_timeout at offset 26
+BUFFER_ID = struct.Struct('!I')            # at offset 32 in a FlowMod, 8 in a PacketOut
+IN_PORT = struct.Struct('!I')              # at offset 12 in a PacketOut
+OXM_HEADER = struct.Struct('!I')
+TLV = struct.Struct('!HH')                 # type and length of matches, instructions, actions
+
+FLOW_MOD_MATCH = 48     # ofp_header + the fixed ofp_flow_mod fields
+PACKET_OUT_ACTIONS = 24
+
+INT_FIELDS = {1: struct.Struct('!B').pack, 2: struct.Struct('!H').pack,
+              4: struct.Struct('!I').pack, 8: struct.Struct('!Q').pack}
+
+def encode_mac(mac):
+    return bytes.fromhex(mac.replace(':', ''))
+
+def value_encoder(sample, size, masked):
+    """Function turning a field value as the apps write it into its wire bytes"""
+    if masked:
+        encode = value_encoder(sample[0], size // 2, False)
+        return lambda value: encode(value[0]) + encode(value[1])
+    if not isinstance(sample, str):
+        return INT_FIELDS[size]
+    return encode_mac if size == 6 else socket.inet_aton
+
+def build_actions(parser, actions):
+    """Ryu actions for ('output', port) and (field, value) set-field pairs"""
+    return [parser.OFPActionOutput(value) if kind == 'output'
+            else parser.OFPActionSetField(**{kind: value}) for kind, value in actions]
+
+class MessageTemplate(object):
+    """A message serialized once by Ryu, with slots for the fields that vary.
+
+    Slots are found by walking the serialized match (OXM fields) and action
+    list, so the bytes sent are exactly what Ryu would produce. fill() writes
+    values, in match order then action order, into the one reusable buffer.
+    """
+
+    def __init__(self, msg, match, actions, actions_offset=None):
+        msg.set_xid(0)
+        msg.serialize()
+        self.buf = bytearray(msg.buf)
+        ofproto = msg.datapath.ofproto
+        self.oxm_name = ofproto.oxm_to_user_header
+
+        fields = {}
+        if actions_offset is None:
+            # ofp_match: type, length (without padding), OXM fields, padded to 8 bytes
+            match_length = TLV.unpack_from(self.buf, FLOW_MOD_MATCH)[1]
+            fields = dict(self._fields(FLOW_MOD_MATCH + 4, FLOW_MOD_MATCH + match_length))
+            instruction = FLOW_MOD_MATCH + (match_length + 7) // 8 * 8
+            actions_offset = instruction + 8
+            actions_end = instruction + TLV.unpack_from(self.buf, instruction)[1]
+        else:
+            actions_end = len(self.buf)
+
+        action_slots = []
+        offset = actions_offset
+        while offset < actions_end:
+            kind, length = TLV.unpack_from(self.buf, offset)
+            if kind == ofproto.OFPAT_OUTPUT:
+                action_slots.append((offset + 4, offset + 8, False))
+            elif kind == ofproto.OFPAT_SET_FIELD:
+                action_slots.append(self._fields(offset + 4, offset + length)[0][1])
+            offset += length
+
+        # Encoders follow the types of the values the template was built with
+        values = list(match.values()) + [value for _, value in actions]
+        self.slots = [(start, end, value_encoder(value, end - start, masked))
+                      for (start, end, masked), value in
+                      zip([fields[name] for name in match] + action_slots, values)]
+        # The slots must reproduce Ryu's own bytes for the values it serialized
+        serialized = bytes(self.buf)
+        self.fill(values, 0)
+        if bytes(self.buf) != serialized:
+            raise ValueError("Cannot template %s with match %s" % (type(msg).__name__, match))
+
+    def _fields(self, offset, end):
+        """(name, (start, end, masked)) of each OXM field between offset and end"""
+        found = []
+        while offset < end:
+            header = OXM_HEADER.unpack_from(self.buf, offset)[0]
+            start = offset + 4
+            offset = start + (header & 0xff)
+            found.append((self.oxm_name(header >> 9), (start, offset, bool(header & 0x100))))
+        return found
+
+    def fill(self, values, xid):
+        buf = self.buf
+        XID.pack_into(buf, 4, xid)
+        for (start, end, encode), value in zip(self.slots, values):
+            buf[start:end] = encode(value)
+        return buf
+
+class MessageTemplates(object):
+    """FlowMod and PacketOut construction from per-shape templates.
+
+    The packet-in handlers build structurally identical messages every time:
+    the same match fields, actions and flags, only the addresses, ports,
+    buffer_id and timeouts differ. The first message of each shape (priority,
+    match field names, action kinds, flags) is built and serialized by Ryu;
+    later ones patch their values into its buffer and go to the switch
+    without any Ryu message objects. Matches are dicts of OFPMatch keyword
+    arguments, actions ('output', port) or (field, value) to set.
+
+    The send queue keeps what it is given until the socket writes it, so
+    each message is handed over as a copy of the reusable buffer. Filling
+    and copying never yield, so the apps' green threads can share templates.
+
+    A shape whose template fails its self-check is remembered (False in the
+    template dicts) and always sent as Ryu message objects instead.
+    """
+
+    def __init__(self, logger=None):
+        self.logger = logger
+        self.flow_mods = {}
+        self.packet_outs = {}
+
+    def _template(self, msg, match, actions, actions_offset=None):
+        """Template for msg's shape, or False if it cannot be templated"""
+        try:
+            return MessageTemplate(msg, match, actions, actions_offset)
+        except ValueError as e:
+            if self.logger:
+                self.logger.warning("%s; sending this shape as Ryu message objects", e)
+            return False
+
+    def _flow_mod(self, datapath, priority, match, actions, buffer_id=None, idle_timeout=0,
+                  hard_timeout=0, flags=0):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS, build_actions(parser, actions))]
+        return parser.OFPFlowMod(datapath=datapath, buffer_id=buffer_id if buffer_id else ofproto.OFP_NO_BUFFER,
+                                 priority=priority, match=parser.OFPMatch(**match), instructions=inst,
+                                 idle_timeout=idle_timeout, hard_timeout=hard_timeout, flags=flags)
+
+    def next_xid(self, datapath):
+        # As Datapath.set_xid() does for message objects
+        datapath.xid = (datapath.xid + 1) & datapath.ofproto.MAX_XID
+        return datapath.xid
+
+    def add_flow(self, datapath, priority, match, actions, buffer_id=None, idle_timeout=0, hard_timeout=0, flags=0):
+        key = (priority, tuple(match), tuple(kind for kind, _ in actions), flags)
+        template = self.flow_mods.get(key)
+        if template is None:
+            mod = self._flow_mod(datapath, priority, match, actions, flags=flags)
+            template = self.flow_mods[key] = self._template(mod, match, actions)
+        if template is False:
+            datapath.send_msg(self._flow_mod(datapath, priority, match, actions, buffer_id,
+                                             idle_timeout, hard_timeout, flags))
+            return
+
+        buf = template.fill(list(match.values()) + [value for _, value in actions],
+                            self.next_xid(datapath))
+        FLOW_MOD_TIMEOUTS.pack_into(buf, 26, idle_timeout, hard_timeout)
+        BUFFER_ID.pack_into(buf, 32, buffer_id if buffer_id else datapath.ofproto.OFP_NO_BUFFER)
+        datapath.send(bytes(buf))
+
+    def packet_out(self, datapath, buffer_id, in_port, actions, data=None):
+        key = tuple(kind for kind, _ in actions)
+        template = self.packet_outs.get(key)
+        parser = datapath.ofproto_parser
+        if template is None:
+            out = parser.OFPPacketOut(datapath=datapath, buffer_id=datapath.ofproto.OFP_NO_BUFFER,
+                                      in_port=0, actions=build_actions(parser, actions))
+            template = self.packet_outs[key] = self._template(out, {}, actions, PACKET_OUT_ACTIONS)
+        if template is False:
+            datapath.send_msg(parser.OFPPacketOut(datapath=datapath, buffer_id=buffer_id, in_port=in_port,
+                                                  actions=build_actions(parser, actions), data=data))
+            return
+
+        buf = template.fill([value for _, value in actions], self.next_xid(datapath))
+        BUFFER_ID.pack_into(buf, 8, buffer_id)
+        IN_PORT.pack_into(buf, 12, in_port)
+        if data:
+            LENGTH.pack_into(buf, 2, len(buf) + len(data))
+            datapath.send(bytes(buf) + data)
+        else:
+            LENGTH.pack_into(buf, 2, len(buf))
+            datapath.send(bytes(buf))
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# Adaptive idle timeouts for reactive flows, learned from flow-removed feedback
+
+import struct
+import time
+from collections import deque
+
+from ryu.base import app_manager
+from ryu.controller import ofp_event
+from ryu.controller.handler import MAIN_DISPATCHER, DEAD_DISPATCHER, set_ev_cls
+from ryu.ofproto import ofproto_v1_3
+from ryu.lib import hub
+
+from flow_reconcile import match_key
+
+INFINITE = float('inf')
+FLOW_MOD_COMMAND = struct.Struct('!B')   # at offset 25 in a FlowMod
+FLOW_MOD_PRIORITY = struct.Struct('!H')  # at offset 30
+MATCH_LENGTH = struct.Struct('!H')       # at offset 50
+FLOW_MOD_MATCH = 48
+
+class AdaptiveTimeouts(app_manager.RyuApp):
+    """Choose idle timeouts per flow class to trade table space against packet-ins.
+
+    Shared by the apps as a Ryu context. Reactive flows are installed with
+    the timeout returned by install() and OFPFF_SEND_FLOW_REM set. When a
+    flow idles out, the removal is remembered; if a packet-in makes an app
+    install the same flow again, the flow had been idle for the timeout
+    plus the time since its removal - one idle-gap sample for its class.
+    Flows that do not come back within `horizon` count as infinite gaps.
+    Flows the switch rejects (e.g. table full) are forgotten again.
+
+    Cost is one unit per packet-in plus a weight per entry-second spent in
+    the table. The weight is occupancy_weight scaled by load / (1 - load),
+    load being the fullest switch's share of table_budget reactive flows:
+    table space is nearly free on an empty table and expensive near the
+    budget. At the budget new flows get the shortest timeout.
+
+    A returning flow is reinstalled with the shortest timeout covering its
+    last gap when holding the entry that long costs less than the packet-in
+    it saves. Other flows get their class timeout: every retune_interval
+    seconds, the candidate with the lowest cost over the class's recent
+    samples. Gaps shorter than the timeout in use are never observed, so
+    class timeouts are lowered one step per retune and raised freely.
+    """
+
+    OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
+
+    CANDIDATES = (2, 5, 10, 20, 30, 60, 120, 300)  # seconds
+
+    def __init__(self, *args, **kwargs):
+        super(AdaptiveTimeouts, self).__init__(*args, **kwargs)
+        self.initial_timeout = 10      # seconds, until a class has samples
+        self.table_budget = 1000       # reactive flows per switch
+        self.occupancy_weight = 0.01   # packet-ins per entry-second at half the budget
+        self.horizon = 600             # seconds a removed flow may take to come back
+        self.min_samples = 20
+        self.retune_interval = 10      # seconds
+
+        self.weight = 0.0    # current cost of an entry-second, in packet-ins
+        self.timeouts = {}   # flow class -> current idle timeout
+        self.samples = {}    # flow class -> recent idle gaps
+        self.installed = {}  # dpid -> {flow key: flow class}
+        self.removed = {}    # (dpid, flow key) -> (flow class, removed at, idle timeout)
+        self.stats = {'installs': 0, 'reinstalls': 0, 'idle_removals': 0, 'rejected': 0}
+        self.retune_thread = hub.spawn(self._retune_loop)
+
+    def install(self, datapath, flow_class, priority, match):
+        """Record a reactive flow about to be installed; returns its idle timeout"""
+        key = (priority, match_key(match))
+        now = time.time()
+        table = self.installed.setdefault(datapath.id, {})
+        table[key] = flow_class
+        self.stats['installs'] += 1
+        if len(table) >= self.table_budget:
+            return self.CANDIDATES[0]
+
+        timeout = self.timeouts.get(flow_class, self.initial_timeout)
+        removed = self.removed.pop((datapath.id, key), None)
+        if removed is not None:
+            cls, removed_at, idle = removed
+            gap = idle + now - removed_at
+            self._sample(cls, gap)
+            self.stats['reinstalls'] += 1
+            # Worth holding this flow across a gap like its last one?
+            if gap * self.weight < 1:
+                timeout = max(timeout, next((t for t in self.CANDIDATES if t >= gap), self.CANDIDATES[-1]))
+        return timeout
+
+    def _sample(self, flow_class, gap):
+        self.samples.setdefault(flow_class, deque(maxlen=512)).append(gap)
+
+    @set_ev_cls(ofp_event.EventOFPFlowRemoved, MAIN_DISPATCHER)
+    def _flow_removed_handler(self, ev):
+        msg = ev.msg
+        ofproto = msg.datapath.ofproto
+        key = (msg.priority, match_key(msg.match))
+        flow_class = self.installed.get(msg.datapath.id, {}).pop(key, None)
+        if flow_class is None or msg.reason != ofproto.OFPRR_IDLE_TIMEOUT:
+            return
+        self.stats['idle_removals'] += 1
+        self.removed[(msg.datapath.id, key)] = (flow_class, time.time(), msg.idle_timeout)
+
+    @set_ev_cls(ofp_event.EventOFPErrorMsg, MAIN_DISPATCHER)
+    def _error_msg_handler(self, ev):
+        msg = ev.msg
+        datapath = msg.datapath
+        ofproto = datapath.ofproto
+        table = self.installed.get(datapath.id)
+        if not table or msg.type != ofproto.OFPET_FLOW_MOD_FAILED:
+            return
+        # The error carries the rejected flow mod; forget the flow if the
+        # whole match came back, or it would count as load until restart
+        data = msg.data
+        if (len(data) < FLOW_MOD_MATCH + 4 or
+                FLOW_MOD_COMMAND.unpack_from(data, 25)[0] != ofproto.OFPFC_ADD or
+                len(data) < FLOW_MOD_MATCH + MATCH_LENGTH.unpack_from(data, 50)[0]):
+            return
+        match = datapath.ofproto_parser.OFPMatch.parser(data, FLOW_MOD_MATCH)
+        key = (FLOW_MOD_PRIORITY.unpack_from(data, 30)[0], match_key(match))
+        if table.pop(key, None) is not None:
+            self.stats['rejected'] += 1
+
+    @set_ev_cls(ofp_event.EventOFPStateChange, DEAD_DISPATCHER)
+    def _state_change_handler(self, ev):
+        # A disconnected switch sends no removals for the flows it loses
+        if ev.datapath.id is not None:
+            self.installed.pop(ev.datapath.id, None)
+
+    def table_load(self):
+        """Reactive flows on the fullest switch, as a fraction of the budget"""
+        if not self.installed:
+            return 0.0
+        return max(len(table) for table in self.installed.values()) / float(self.table_budget)
+
+    def cost(self, gaps, timeout, occupancy_weight):
+        packet_ins = 0
+        occupancy = 0.0
+        for gap in gaps:
+            if gap <= timeout:
+                occupancy += gap
+            else:
+                occupancy += timeout
+                if gap != INFINITE:
+                    packet_ins += 1
+        return packet_ins + occupancy_weight * occupancy
+
+    def retune(self):
+        now = time.time()
+        for key, (flow_class, removed_at, _) in list(self.removed.items()):
+            if now - removed_at > self.horizon:
+                del self.removed[key]
+                self._sample(flow_class, INFINITE)
+
+        load = min(self.table_load(), 0.95)
+        self.weight = self.occupancy_weight * load / (1.0 - load)
+        for flow_class, gaps in self.samples.items():
+            if len(gaps) < self.min_samples:
+                continue
+            current = self.timeouts.get(flow_class, self.initial_timeout)
+            best = min(self.CANDIDATES, key=lambda t: self.cost(gaps, t, self.weight))
+            if best < current:
+                # Lower one step at a time: shorter gaps are not observable yet
+                best = max([t for t in self.CANDIDATES if t < current] or [best])
+            if best != current:
+                self.logger.info("Idle timeout for %s flows: %ds -> %ds", flow_class, current, best)
+                self.timeouts[flow_class] = best
+
+    def _retune_loop(self):
+        while True:
+            hub.sleep(self.retune_interval)
+            self.retune()
@@ -3,40 +3,108 @@
 
 from ryu.base import app_manager
 from ryu.controller import ofp_event
-from ryu.controller.handler import CONFIG_DISPATCHER, MAIN_DISPATCHER, set_ev_cls
+from ryu.controller.handler import CONFIG_DISPATCHER, MAIN_DISPATCHER, DEAD_DISPATCHER, set_ev_cls
 from ryu.ofproto import ofproto_v1_3
+from ryu.lib import hub
 from ryu.lib.packet import packet, ethernet, ether_types, ipv4, tcp, udp
+import bisect
+import collections
+import ipaddress
 import random
 import time
 
+from arp_proxy import ArpProxy
+from backend_load import BackendLoadTracker
+from flow_reconcile import FlowReconciler
+from flow_table import FlowTableManager
+from flow_templates import MessageTemplates
+from flow_timeouts import AdaptiveTimeouts
+from rule_classifier import ip_to_int, prefix_mask
+from state_snapshot import StateSnapshot, snapshot_path
+from state_table import IPv4Table, MacTable
+from work_queue import WorkQueue
+import sharding
+
 class LoadBalancerVNF(app_manager.RyuApp):
     OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
+    _CONTEXTS = {'arp_proxy': ArpProxy, 'reconciler': FlowReconciler,
+                 'timeouts': AdaptiveTimeouts, 'flow_table': FlowTableManager,
+                 'work_queue': WorkQueue}
     
     def __init__(self, *args, **kwargs):
         super(LoadBalancerVNF, self).__init__(*args, **kwargs)
-        self.mac_to_port = {}
+        self.mac_to_port = {}  # dpid -> MacTable
+        self.arp_proxy = kwargs['arp_proxy']
+        self.reconciler = kwargs['reconciler']
+        self.timeouts = kwargs['timeouts']
+        # Health checks, traffic statistics and logging run after the packet-in is answered
+        self.work = kwargs['work_queue']
+        self.templates = MessageTemplates(self.logger)  # pre-serialized packet-in responses
         
         # Virtual service configuration
         self.virtual_ip = '10.0.0.100'
         self.virtual_mac = '00:00:00:00:00:64'  # 64 decimal = 100 hex
         
+        # The VIP is configured on every backend, so only the controller may
+        # answer ARP for it - otherwise clients see conflicting replies
+        self.arp_proxy.add_static(self.virtual_ip, self.virtual_mac)
+        
         # Backend servers
         self.servers = [
             {'ip': '10.0.0.2', 'mac': '00:00:00:00:00:02', 'weight': 1, 'active': True},
             {'ip': '10.0.0.3', 'mac': '00:00:00:00:00:03', 'weight': 1, 'active': True}
         ]
+        # Active backends and weights for select_server, rebuilt only when health changes
+        self.server_weights = []
+        self.active_servers = []
+        self.active_cumulative_weights = []
+        self.update_active_servers()
         
-        # Session persistence table (client_ip -> server_index)
-        self.client_to_server = {}
+        # Session persistence table (client_ip or client prefix -> server_index),
+        # shared by all workers when the controller runs sharded
+        self.client_to_server = sharding.shared_table('lb_sessions', IPv4Table)
+        
+        # Granularity of the flows installed for VIP traffic:
+        #   '5tuple' - one flow pair per TCP/UDP connection (per client and protocol otherwise)
+        #   'client' - one flow pair per client IP, covering every IP protocol
+        #   'prefix' - one forward flow per client prefix (client_prefix_len), reverse per client
+        #              under a per-prefix return flow that catches the others' replies
+        self.flow_granularity = 'client'
+        self.client_prefix_len = 24
         
         # Load balancing statistics
         self.stats = {i: {'connections': 0, 'packets': 0, 'bytes': 0, 'last_seen': time.time()} 
                       for i in range(len(self.servers))}
         
+        # Backend selection: 'weighted_random' (static weights), 'least_connections'
+        # or 'least_bandwidth'. The load-aware algorithms use EWMA-smoothed switch
+        # counters polled every stats_interval seconds (flow counts, and the bytes
+        # sent on the port each backend is attached to); with two_choices they
+        # compare two random backends instead of scanning all of them.
+        # least_bandwidth needs the weights set to the backends' capacities.
+        self.lb_algorithm = 'least_connections'
+        self.two_choices = True
+        self.stats_interval = 5  # seconds
+        self.load_tracker = BackendLoadTracker(len(self.servers))
+        self.datapaths = {}
+        self.backend_flows = {}  # dpid -> active flow count per backend, from its last reply
+        self.stats_round = set()  # (dpid, xid) of this poll round's requests not answered yet
+        self.stats_round_open = False
+        self.flow_stats_reply = {}  # dpid -> flow stats collected from a multipart reply
+        self.port_tx_bytes = {}  # (dpid, port) -> tx_bytes at the last port stats reply
+        self.round_sent_bytes = {}  # backend index -> bytes sent to it this poll round
+        self.monitor_thread = hub.spawn(self._monitor)
+        
         # Health check parameters
         self.health_check_interval = 30  # seconds
         self.last_health_check = time.time()
         
+        # Warm restart: reload the last snapshot, then keep snapshotting
+        self.snapshot_interval = 10  # seconds
+        self.snapshot = StateSnapshot(snapshot_path('load_balancer_vnf'))
+        self.restore_state(self.snapshot.load())
+        self.snapshot_thread = hub.spawn(self._snapshot_loop)
+        
         self.logger.info("Load Balancer VNF initialized with VIP: %s", self.virtual_ip)
     
     @set_ev_cls(ofp_event.EventOFPSwitchFeatures, CONFIG_DISPATCHER)
@@ -44,68 +112,281 @@ class LoadBalancerVNF(app_manager.RyuApp):
         datapath = ev.msg.datapath
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
+        if sharding.reject_foreign_datapath(datapath, self.logger):
+            return
         
         # Install the table-miss flow entry
         match = parser.OFPMatch()
         actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER, ofproto.OFPCML_NO_BUFFER)]
-        self.add_flow(datapath, 0, match, actions)
+        self.reconciler.ensure_flow(datapath, ev.msg, 0, match, actions)
         self.logger.info("Load balancer switch features handler for switch %s", datapath.id)
-    
-    def add_flow(self, datapath, priority, match, actions, buffer_id=None, idle_timeout=0, hard_timeout=0):
-        ofproto = datapath.ofproto
-        parser = datapath.ofproto_parser
         
-        inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS, actions)]
+        # ARP requests (including those for the VIP) are answered by the controller
+        self.reconciler.ensure_flow(datapath, ev.msg, *self.arp_proxy.punt_flow(datapath))
+    
+    def snapshot_state(self):
+        state = {'mac_to_port': self.mac_to_port, 'servers': self.servers, 'stats': self.stats,
+                 'load_tracker': vars(self.load_tracker)}
+        if isinstance(self.client_to_server, IPv4Table):
+            # Shared tables already live outside the process
+            state['client_to_server'] = self.client_to_server
+        return state
+    
+    def restore_state(self, state):
+        if not state:
+            return
+        self.mac_to_port = {dpid: MacTable(ports) for dpid, ports in state.get('mac_to_port', {}).items()}
+        if isinstance(self.client_to_server, IPv4Table):
+            self.client_to_server.update(state.get('client_to_server', {}))
+        # Per-backend state is only valid for the same backend list
+        if [server['ip'] for server in state.get('servers', [])] == [server['ip'] for server in self.servers]:
+            self.stats = state['stats']
+            vars(self.load_tracker).update(state['load_tracker'])
+        self.logger.info("Restored load balancer state: %d switches, %d client sessions",
+                         len(self.mac_to_port), len(self.client_to_server))
+    
+    def _snapshot_loop(self):
+        while True:
+            hub.sleep(self.snapshot_interval)
+            # Serializing copies the state on the hub; the file IO runs in a native thread
+            self.work.run_blocking(self.snapshot.write, self.snapshot.serialize(self.snapshot_state()))
+    
+    def stop(self):
+        self.snapshot.save(self.snapshot_state())
+        super(LoadBalancerVNF, self).stop()
+    
+    def persistence_key(self, client_ip):
+        """Key used for session persistence (address as an int) - the client prefix in per-prefix mode"""
+        key = ip_to_int(client_ip)
+        if self.flow_granularity == 'prefix':
+            key &= prefix_mask(self.client_prefix_len)
+        return key
+    
+    def build_forward_match(self, ip_pkt, protocol, src_port, dst_port):
+        """Match fields for client -> VIP traffic at the configured granularity"""
+        if self.flow_granularity == 'prefix':
+            network = ipaddress.ip_network('%s/%d' % (ip_pkt.src, self.client_prefix_len), strict=False)
+            return {'eth_type': ether_types.ETH_TYPE_IP,
+                    'ipv4_src': (str(network.network_address), str(network.netmask)),
+                    'ipv4_dst': self.virtual_ip}
+        if self.flow_granularity == 'client':
+            return {'eth_type': ether_types.ETH_TYPE_IP,
+                    'ipv4_src': ip_pkt.src, 'ipv4_dst': self.virtual_ip}
         
-        if buffer_id:
-            mod = parser.OFPFlowMod(datapath=datapath, buffer_id=buffer_id,
-                                    priority=priority, match=match,
-                                    instructions=inst, idle_timeout=idle_timeout,
-                                    hard_timeout=hard_timeout)
+        # Per-5-tuple; protocols without ports (e.g. ICMP) get a per-client, per-protocol flow
+        if protocol == 'tcp':
+            return {'eth_type': ether_types.ETH_TYPE_IP, 'ip_proto': 6,
+                    'ipv4_src': ip_pkt.src, 'ipv4_dst': self.virtual_ip,
+                    'tcp_src': src_port, 'tcp_dst': dst_port}
+        if protocol == 'udp':
+            return {'eth_type': ether_types.ETH_TYPE_IP, 'ip_proto': 17,
+                    'ipv4_src': ip_pkt.src, 'ipv4_dst': self.virtual_ip,
+                    'udp_src': src_port, 'udp_dst': dst_port}
+        return {'eth_type': ether_types.ETH_TYPE_IP, 'ip_proto': ip_pkt.proto,
+                'ipv4_src': ip_pkt.src, 'ipv4_dst': self.virtual_ip}
+    
+    def install_reverse_flow(self, datapath, client_ip, client_port, protocol=None, src_port=None, dst_port=None):
+        """Install the VIP -> client return flow (backend replies come from the VIP)"""
+        if self.flow_granularity == '5tuple' and protocol == 'tcp':
+            match = {'eth_type': ether_types.ETH_TYPE_IP, 'ip_proto': 6,
+                     'ipv4_src': self.virtual_ip, 'ipv4_dst': client_ip,
+                     'tcp_src': dst_port, 'tcp_dst': src_port}
+        elif self.flow_granularity == '5tuple' and protocol == 'udp':
+            match = {'eth_type': ether_types.ETH_TYPE_IP, 'ip_proto': 17,
+                     'ipv4_src': self.virtual_ip, 'ipv4_dst': client_ip,
+                     'udp_src': dst_port, 'udp_dst': src_port}
         else:
-            mod = parser.OFPFlowMod(datapath=datapath, priority=priority,
-                                    match=match, instructions=inst,
-                                    idle_timeout=idle_timeout, 
-                                    hard_timeout=hard_timeout)
-        datapath.send_msg(mod)
+            # Per-client return path; shared by every backend and protocol
+            match = {'eth_type': ether_types.ETH_TYPE_IP,
+                     'ipv4_src': self.virtual_ip, 'ipv4_dst': client_ip}
+        
+        actions = [('eth_src', self.virtual_mac), ('output', client_port)]
+        self.templates.add_flow(datapath, 20, match, actions,
+                                idle_timeout=self.timeouts.install(datapath, 'lb', 20, match),
+                                flags=datapath.ofproto.OFPFF_SEND_FLOW_REM)
+    
+    def install_prefix_return_flow(self, datapath, prefix):
+        """Catch backend replies to every client of an aggregated prefix (per-prefix mode).
+        
+        Installed with the forward flow, below the per-client return flows and
+        above L2 forwarding, so no reply leaves without the VIP rewrite: it is
+        rewritten and sent to the controller, which adds the client's own
+        return flow (the output port differs per client).
+        """
+        match = {'eth_type': ether_types.ETH_TYPE_IP,
+                 'ipv4_src': self.virtual_ip, 'ipv4_dst': prefix}
+        actions = [('eth_src', self.virtual_mac), ('output', datapath.ofproto.OFPP_CONTROLLER)]
+        self.templates.add_flow(datapath, 19, match, actions,
+                                idle_timeout=self.timeouts.install(datapath, 'lb', 19, match),
+                                flags=datapath.ofproto.OFPFF_SEND_FLOW_REM)
+    
+    def update_active_servers(self):
+        """Rebuild the active server list and weights after a health change"""
+        self.server_weights = [server['weight'] for server in self.servers]
+        self.active_servers = [i for i, server in enumerate(self.servers) if server['active']]
+        self.active_cumulative_weights = []
+        total = 0
+        for i in self.active_servers:
+            total += self.server_weights[i]
+            self.active_cumulative_weights.append(total)
+    
+    def set_server_active(self, i, active):
+        self.servers[i]['active'] = active
+        self.update_active_servers()
     
     def select_server(self, client_ip, client_port=None, protocol=None):
-        """Select a server for a new connection using weighted round-robin algorithm"""
+        """Select a server for a new client using the configured lb_algorithm"""
         # Check for session persistence
-        if client_ip in self.client_to_server:
-            server_index = self.client_to_server[client_ip]
-            # Verify server is still active
-            if self.servers[server_index]['active']:
-                return server_index
-        
-        # Filter only active servers
-        active_servers = [(i, server) for i, server in enumerate(self.servers) if server['active']]
-        if not active_servers:
+        server_index = self.update_session_table(self.client_to_server.get, client_ip)
+        # Verify server is still active
+        if server_index is not None and self.servers[server_index]['active']:
+            return server_index
+        
+        if not self.active_servers:
             self.logger.error("No active servers available")
             return None
         
-        # Use weighted selection based on server weights
-        total_weight = sum(server['weight'] for _, server in active_servers)
-        r = random.uniform(0, total_weight)
-        upto = 0
-        
-        for i, server in active_servers:
-            upto += server['weight']
-            if upto >= r:
-                # Store for session persistence
-                self.client_to_server[client_ip] = i
-                # Update statistics
-                self.stats[i]['connections'] += 1
-                self.stats[i]['last_seen'] = time.time()
-                return i
-        
-        # Fallback to first active server
-        i = active_servers[0][0]
-        self.client_to_server[client_ip] = i
+        if self.lb_algorithm != 'weighted_random':
+            i = self.load_tracker.choose(self.active_servers, self.server_weights, self.two_choices,
+                                         algorithm=self.lb_algorithm)
+        else:
+            # Weighted selection: binary search over the cumulative weights
+            r = random.uniform(0, self.active_cumulative_weights[-1])
+            position = bisect.bisect_left(self.active_cumulative_weights, r)
+            i = self.active_servers[min(position, len(self.active_servers) - 1)]
+        
+        # Store for session persistence and update statistics
+        self.update_session_table(self.client_to_server.__setitem__, client_ip, i)
         self.stats[i]['connections'] += 1
         self.stats[i]['last_seen'] = time.time()
         return i
     
+    def update_session_table(self, fn, *args):
+        # A shared table's flock waits for the other workers: keep it off the hub
+        if isinstance(self.client_to_server, sharding.SharedTable):
+            return self.work.run_blocking(fn, *args)
+        return fn(*args)
+    
+    @set_ev_cls(ofp_event.EventOFPStateChange, [MAIN_DISPATCHER, DEAD_DISPATCHER])
+    def _state_change_handler(self, ev):
+        datapath = ev.datapath
+        if ev.state == MAIN_DISPATCHER:
+            self.datapaths[datapath.id] = datapath
+        elif ev.state == DEAD_DISPATCHER:
+            self.datapaths.pop(datapath.id, None)
+            self.backend_flows.pop(datapath.id, None)
+            self.stats_round = {(dpid, xid) for dpid, xid in self.stats_round if dpid != datapath.id}
+            self.port_tx_bytes = {key: tx for key, tx in self.port_tx_bytes.items() if key[0] != datapath.id}
+    
+    def _monitor(self):
+        """Periodically request flow stats for backend load tracking, one poll round per interval"""
+        while True:
+            if self.lb_algorithm != 'weighted_random':
+                # Replies still missing from the last round are not waited for
+                self.finish_stats_round()
+                for datapath in list(self.datapaths.values()):
+                    self.request_stats(datapath)
+                self.stats_round_open = bool(self.stats_round)
+            hub.sleep(self.stats_interval)
+    
+    def finish_stats_round(self):
+        """Feed the load tracker once per poll round, with the counts summed over all switches"""
+        if not self.stats_round_open:
+            return
+        self.stats_round_open = False
+        self.stats_round.clear()
+        # Flows can live on several switches; the load is the total over all of them.
+        # A switch that did not answer this round counts with its last reply.
+        counts = [sum(flows[i] for flows in self.backend_flows.values()) for i in range(len(self.servers))]
+        self.load_tracker.update_flow_counts(counts)
+        for i, count in enumerate(counts):
+            self.stats[i]['connections'] = count
+        if self.lb_algorithm == 'least_bandwidth':
+            self.load_tracker.update_bytes([self.round_sent_bytes.get(i) if server['active'] else None
+                                            for i, server in enumerate(self.servers)],
+                                           self.server_weights)
+        self.round_sent_bytes = {}
+    
+    def request_stats(self, datapath):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        
+        # Only the load-balancer flows (priority 20, VIP as destination) are needed
+        match = parser.OFPMatch(eth_type=ether_types.ETH_TYPE_IP, ipv4_dst=self.virtual_ip)
+        req = parser.OFPFlowStatsRequest(datapath, 0, ofproto.OFPTT_ALL, ofproto.OFPP_ANY,
+                                         ofproto.OFPG_ANY, 0, 0, match)
+        datapath.set_xid(req)
+        self.stats_round.add((datapath.id, req.xid))
+        self.flow_stats_reply.pop(datapath.id, None)
+        datapath.send_msg(req)
+        
+        if self.lb_algorithm == 'least_bandwidth':
+            req = parser.OFPPortStatsRequest(datapath, 0, ofproto.OFPP_ANY)
+            datapath.set_xid(req)
+            self.stats_round.add((datapath.id, req.xid))
+            datapath.send_msg(req)
+    
+    def backend_ports(self, dpid):
+        """port -> backend index for the backends attached to this switch: the port a
+        backend's MAC was learned on, unless other hosts were learned there too (a
+        trunk carries other traffic, or none of the backend's)"""
+        ports = self.mac_to_port.get(dpid)
+        if not ports:
+            return {}
+        hosts_per_port = collections.Counter(ports.values())
+        backend_ports = {}
+        for i, server in enumerate(self.servers):
+            port = ports.get(server['mac'])
+            if port is not None and hosts_per_port[port] == 1:
+                backend_ports[port] = i
+        return backend_ports
+    
+    @set_ev_cls(ofp_event.EventOFPFlowStatsReply, MAIN_DISPATCHER)
+    def _flow_stats_reply_handler(self, ev):
+        # Other apps poll flow stats too; only our own (possibly multipart) reply counts
+        dpid = ev.msg.datapath.id
+        if (dpid, ev.msg.xid) not in self.stats_round:
+            return
+        self.flow_stats_reply.setdefault(dpid, []).extend(ev.msg.body)
+        if ev.msg.flags & ev.msg.datapath.ofproto.OFPMPF_REPLY_MORE:
+            return
+        
+        # Count the active forward flows steering traffic to each backend
+        mac_to_index = {server['mac']: i for i, server in enumerate(self.servers)}
+        active = [0] * len(self.servers)
+        for stat in self.flow_stats_reply.pop(dpid):
+            if stat.priority != 20 or stat.match.get('ipv4_dst') != self.virtual_ip:
+                continue
+            for inst in stat.instructions:
+                for action in getattr(inst, 'actions', []):
+                    if getattr(action, 'key', None) == 'eth_dst' and action.value in mac_to_index:
+                        active[mac_to_index[action.value]] += 1
+        
+        self.backend_flows[dpid] = active
+        self.stats_round.discard((dpid, ev.msg.xid))
+        if not self.stats_round:
+            self.finish_stats_round()
+    
+    @set_ev_cls(ofp_event.EventOFPPortStatsReply, MAIN_DISPATCHER)
+    def _port_stats_reply_handler(self, ev):
+        dpid = ev.msg.datapath.id
+        if (dpid, ev.msg.xid) not in self.stats_round:
+            return
+        backend_ports = self.backend_ports(dpid)
+        for stat in ev.msg.body:
+            key = (dpid, stat.port_no)
+            last = self.port_tx_bytes.get(key)
+            self.port_tx_bytes[key] = stat.tx_bytes
+            # Nothing to compare with on the first reply or after a counter reset
+            if stat.port_no in backend_ports and last is not None and stat.tx_bytes >= last:
+                i = backend_ports[stat.port_no]
+                self.round_sent_bytes[i] = self.round_sent_bytes.get(i, 0) + stat.tx_bytes - last
+        if ev.msg.flags & ev.msg.datapath.ofproto.OFPMPF_REPLY_MORE:
+            return
+        self.stats_round.discard((dpid, ev.msg.xid))
+        if not self.stats_round:
+            self.finish_stats_round()
+    
     def health_check(self):
         """Simulate health checks for backend servers"""
         current_time = time.time()
@@ -122,21 +403,29 @@ class LoadBalancerVNF(app_manager.RyuApp):
             if current_time - last_seen > 120:  # 2 minutes
                 if server['active']:
                     self.logger.warning("Server %s marked inactive due to inactivity", server['ip'])
-                    self.servers[i]['active'] = False
+                    self.set_server_active(i, False)
             else:
                 if not server['active']:
                     self.logger.info("Server %s marked active again", server['ip'])
-                    self.servers[i]['active'] = True
+                    self.set_server_active(i, True)
+    
+    def record_vip_packet(self, client_ip, server_index, length):
+        """Statistics and logging for a packet forwarded to a backend"""
+        self.logger.info("Load balancer: received packet for VIP: %s from %s", self.virtual_ip, client_ip)
+        self.logger.info("Load balancer: selected server %s for client %s",
+                         self.servers[server_index]['ip'], client_ip)
+        self.stats[server_index]['packets'] += 1
+        self.stats[server_index]['bytes'] += length
     
     @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
     def _packet_in_handler(self, ev):
         # Run periodic health check
-        self.health_check()
+        if time.time() - self.last_health_check >= self.health_check_interval:
+            self.work.submit(self.health_check, shed=False)
         
         msg = ev.msg
         datapath = msg.datapath
         ofproto = datapath.ofproto
-        parser = datapath.ofproto_parser
         in_port = msg.match['in_port']
         
         pkt = packet.Packet(msg.data)
@@ -151,14 +440,17 @@ class LoadBalancerVNF(app_manager.RyuApp):
         dpid = datapath.id
         
         # Learn MAC address to avoid FLOOD next time
-        self.mac_to_port.setdefault(dpid, {})
+        if dpid not in self.mac_to_port:
+            self.mac_to_port[dpid] = MacTable()
         self.mac_to_port[dpid][src_mac] = in_port
         
+        # Answer ARP (VIP -> virtual_mac, hosts from the learned cache)
+        if eth.ethertype == ether_types.ETH_TYPE_ARP and self.arp_proxy.handle_packet_in(msg, pkt, in_port):
+            return
+        
         # Check if this packet is destined for our virtual IP
         ip_pkt = pkt.get_protocol(ipv4.ipv4)
         if ip_pkt and ip_pkt.dst == self.virtual_ip:
-            self.logger.info("Load balancer: received packet for VIP: %s from %s", self.virtual_ip, ip_pkt.src)
-            
             # Get protocol-specific information
             tcp_pkt = pkt.get_protocol(tcp.tcp)
             udp_pkt = pkt.get_protocol(udp.udp)
@@ -176,94 +468,51 @@ class LoadBalancerVNF(app_manager.RyuApp):
                 src_port = udp_pkt.src_port
                 dst_port = udp_pkt.dst_port
             
-            # Select a server for this connection
-            server_index = self.select_server(ip_pkt.src, src_port, protocol)
+            # Select a server for this connection (persistence follows the flow granularity)
+            server_index = self.select_server(self.persistence_key(ip_pkt.src), src_port, protocol)
             if server_index is None:
                 self.logger.error("No server available - dropping packet")
                 return
             
             server = self.servers[server_index]
-            self.logger.info("Load balancer: selected server %s for client %s", server['ip'], ip_pkt.src)
             
-            # Set up actions to modify packet destination to selected server
+            # Backends own the VIP, so only the destination MAC is rewritten
+            server_port = self.mac_to_port[dpid].get(server['mac'])
             actions = [
-                parser.OFPActionSetField(eth_dst=server['mac']),
-                parser.OFPActionSetField(ipv4_dst=server['ip']),
-                parser.OFPActionOutput(self.mac_to_port[dpid].get(server['mac'], ofproto.OFPP_FLOOD))
+                ('eth_dst', server['mac']),
+                ('output', server_port if server_port is not None else ofproto.OFPP_FLOOD)
             ]
             
-            # Update statistics
-            self.stats[server_index]['packets'] += 1
-            self.stats[server_index]['bytes'] += len(msg.data)
-            
-            # Install flow rule for subsequent packets in this flow
-            if protocol == 'tcp':
-                match = parser.OFPMatch(
-                    eth_type=ether_types.ETH_TYPE_IP,
-                    ip_proto=6,  # TCP
-                    ipv4_src=ip_pkt.src,
-                    ipv4_dst=self.virtual_ip,
-                    tcp_src=src_port,
-                    tcp_dst=dst_port
-                )
-                self.add_flow(datapath, 20, match, actions, idle_timeout=300)
-                
-                # Install reverse flow (server -> client)
-                reverse_actions = [
-                    parser.OFPActionSetField(eth_src=self.virtual_mac),
-                    parser.OFPActionSetField(ipv4_src=self.virtual_ip),
-                    parser.OFPActionOutput(in_port)
-                ]
-                reverse_match = parser.OFPMatch(
-                    eth_type=ether_types.ETH_TYPE_IP,
-                    ip_proto=6,  # TCP
-                    ipv4_src=server['ip'],
-                    ipv4_dst=ip_pkt.src,
-                    tcp_src=dst_port,
-                    tcp_dst=src_port
-                )
-                self.add_flow(datapath, 20, reverse_match, reverse_actions, idle_timeout=300)
-                
-            elif protocol == 'udp':
-                match = parser.OFPMatch(
-                    eth_type=ether_types.ETH_TYPE_IP,
-                    ip_proto=17,  # UDP
-                    ipv4_src=ip_pkt.src,
-                    ipv4_dst=self.virtual_ip,
-                    udp_src=src_port,
-                    udp_dst=dst_port
-                )
-                self.add_flow(datapath, 20, match, actions, idle_timeout=300)
-                
-                # Install reverse flow (server -> client)
-                reverse_actions = [
-                    parser.OFPActionSetField(eth_src=self.virtual_mac),
-                    parser.OFPActionSetField(ipv4_src=self.virtual_ip),
-                    parser.OFPActionOutput(in_port)
-                ]
-                reverse_match = parser.OFPMatch(
-                    eth_type=ether_types.ETH_TYPE_IP,
-                    ip_proto=17,  # UDP
-                    ipv4_src=server['ip'],
-                    ipv4_dst=ip_pkt.src,
-                    udp_src=dst_port,
-                    udp_dst=src_port
-                )
-                self.add_flow(datapath, 20, reverse_match, reverse_actions, idle_timeout=300)
+            # Install flows for subsequent packets, unless the backend's port is still unknown
+            if server_port is not None:
+                match = self.build_forward_match(ip_pkt, protocol, src_port, dst_port)
+                self.templates.add_flow(datapath, 20, match, actions,
+                                        idle_timeout=self.timeouts.install(datapath, 'lb', 20, match),
+                                        flags=ofproto.OFPFF_SEND_FLOW_REM)
+                self.install_reverse_flow(datapath, ip_pkt.src, in_port, protocol, src_port, dst_port)
+                if self.flow_granularity == 'prefix':
+                    self.install_prefix_return_flow(datapath, match['ipv4_src'])
             
             # Send this packet to the selected server
             data = None
             if msg.buffer_id == ofproto.OFP_NO_BUFFER:
                 data = msg.data
             
-            out = parser.OFPPacketOut(
-                datapath=datapath,
-                buffer_id=msg.buffer_id,
-                in_port=in_port,
-                actions=actions,
-                data=data
-            )
-            datapath.send_msg(out)
+            self.templates.packet_out(datapath, msg.buffer_id, in_port, actions, data)
+            self.work.submit(self.record_vip_packet, ip_pkt.src, server_index, len(msg.data))
+            return
+        
+        # Reply from a backend to a client that reached it through an aggregated
+        # forward flow (per-prefix mode, sent up by the prefix return flow): set up
+        # the return path for that client
+        if ip_pkt and ip_pkt.src == self.virtual_ip and dst_mac in self.mac_to_port[dpid]:
+            client_port = self.mac_to_port[dpid][dst_mac]
+            self.install_reverse_flow(datapath, ip_pkt.dst, client_port)
+            actions = [('eth_src', self.virtual_mac), ('output', client_port)]
+            data = None
+            if msg.buffer_id == ofproto.OFP_NO_BUFFER:
+                data = msg.data
+            self.templates.packet_out(datapath, msg.buffer_id, in_port, actions, data)
             return
         
         # Regular L2 forwarding for non-load balanced traffic
@@ -272,23 +521,24 @@ class LoadBalancerVNF(app_manager.RyuApp):
         else:
             out_port = ofproto.OFPP_FLOOD
         
-        actions = [parser.OFPActionOutput(out_port)]
+        actions = [('output', out_port)]
         
         # Install a flow to avoid packet_in next time
         if out_port != ofproto.OFPP_FLOOD:
-            match = parser.OFPMatch(in_port=in_port, eth_dst=dst_mac)
+            match = {'in_port': in_port, 'eth_dst': dst_mac}
             # Verify if we have a valid buffer_id, if yes avoid sending both flow_mod & packet_out
+            idle_timeout = self.timeouts.install(datapath, 'l2', 1, match)
             if msg.buffer_id != ofproto.OFP_NO_BUFFER:
-                self.add_flow(datapath, 1, match, actions, msg.buffer_id, idle_timeout=300)
+                self.templates.add_flow(datapath, 1, match, actions, msg.buffer_id,
+                                        idle_timeout=idle_timeout, flags=ofproto.OFPFF_SEND_FLOW_REM)
                 return
             else:
-                self.add_flow(datapath, 1, match, actions, idle_timeout=300)
+                self.templates.add_flow(datapath, 1, match, actions, idle_timeout=idle_timeout,
+                                        flags=ofproto.OFPFF_SEND_FLOW_REM)
         
         # Forward the packet
         data = None
         if msg.buffer_id == ofproto.OFP_NO_BUFFER:
             data = msg.data
             
-        out = parser.OFPPacketOut(datapath=datapath, buffer_id=msg.buffer_id,
-                                  in_port=in_port, actions=actions, data=data)
-        datapath.send_msg(out)
\ No newline at end of file
+        self.templates.packet_out(datapath, msg.buffer_id, in_port, actions, data)
\ No newline at end of file
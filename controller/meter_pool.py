@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# Per-source rate limiting with OpenFlow meters allocated from a per-switch pool
+
+import struct
+
+from ryu.base import app_manager
+from ryu.controller import ofp_event
+from ryu.controller.handler import MAIN_DISPATCHER, DEAD_DISPATCHER, set_ev_cls
+from ryu.ofproto import ofproto_v1_3
+
+from flow_reconcile import match_key
+
+# Cookie of flows pointing at a pool meter: tag in the top 16 bits, meter id in the low 32
+METER_COOKIE = 0x4D45 << 48
+COOKIE_TAG_MASK = 0xFFFF << 48
+
+METER_ID = struct.Struct('!I')
+
+class MeterPool(app_manager.RyuApp):
+    """Rate-limit traffic sources in the switch with meters from a pool.
+
+    Used by the firewall as a Ryu context. limit() gives a source (any
+    hashable key, e.g. its IP) a meter with one drop band of `rate` packets/s
+    ('pktps') or kbit/s ('kbps') and returns the meter id. Flows carrying the
+    source's traffic are installed with add_flow(), which puts the meter in
+    front of their actions and tags them with it in the cookie.
+
+    A meter is reclaimed, deleted on the switch and its id returned to the
+    pool, when the last flow using it is removed: once the source has been
+    quiet long enough for its flows to idle out. The pool holds
+    min(max_meters, the switch's max_meter) ids. limit() returns None on
+    switches without meters or when the pool is exhausted, so the caller can
+    fall back to something blunter.
+    """
+
+    OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
+
+    def __init__(self, *args, **kwargs):
+        super(MeterPool, self).__init__(*args, **kwargs)
+        self.max_meters = 1024
+        self.pools = {}  # dpid -> free ids, meters by key and flows per meter
+        self.stats = {'allocated': 0, 'reclaimed': 0, 'exhausted': 0}
+
+    @set_ev_cls(ofp_event.EventOFPStateChange, [MAIN_DISPATCHER, DEAD_DISPATCHER])
+    def _state_change_handler(self, ev):
+        datapath = ev.datapath
+        if ev.state == MAIN_DISPATCHER:
+            ofproto = datapath.ofproto
+            parser = datapath.ofproto_parser
+            self.pools[datapath.id] = {'free': [], 'by_key': {}, 'meters': {}}
+            # Meters left from a previous controller run are not tracked: start clean
+            datapath.send_msg(parser.OFPMeterMod(datapath, command=ofproto.OFPMC_DELETE,
+                                                 flags=0, meter_id=ofproto.OFPM_ALL))
+            datapath.send_msg(parser.OFPMeterFeaturesStatsRequest(datapath, 0))
+        elif ev.state == DEAD_DISPATCHER and datapath.id in self.pools:
+            del self.pools[datapath.id]
+
+    @set_ev_cls(ofp_event.EventOFPMeterFeaturesStatsReply, MAIN_DISPATCHER)
+    def _meter_features_reply_handler(self, ev):
+        pool = self.pools.get(ev.msg.datapath.id)
+        if pool is None or not ev.msg.body:
+            return
+        size = min(self.max_meters, ev.msg.body[0].max_meter)
+        pool['free'] = list(range(size, 0, -1))
+        self.logger.info("Switch %s: %d meters available for rate limiting",
+                         ev.msg.datapath.id, size)
+
+    def meter_for(self, dpid, key):
+        """Meter id rate-limiting key on a switch, or None"""
+        pool = self.pools.get(dpid)
+        return pool['by_key'].get(key) if pool else None
+
+    def limit(self, datapath, key, rate, burst=0, unit='pktps'):
+        """Meter id for key, allocating and adding the meter if needed; None if unavailable"""
+        pool = self.pools.get(datapath.id)
+        if pool is None:
+            return None
+        meter_id = pool['by_key'].get(key)
+        if meter_id is not None:
+            return meter_id
+        if not pool['free']:
+            self.stats['exhausted'] += 1
+            return None
+
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        meter_id = pool['free'].pop()
+        flags = ofproto.OFPMF_PKTPS if unit == 'pktps' else ofproto.OFPMF_KBPS
+        if burst:
+            flags |= ofproto.OFPMF_BURST
+        datapath.send_msg(parser.OFPMeterMod(datapath, command=ofproto.OFPMC_ADD, flags=flags,
+                                             meter_id=meter_id,
+                                             bands=[parser.OFPMeterBandDrop(rate=rate, burst_size=burst)]))
+        pool['by_key'][key] = meter_id
+        pool['meters'][meter_id] = {'key': key, 'flows': set()}
+        self.stats['allocated'] += 1
+        return meter_id
+
+    def add_flow(self, datapath, meter_id, priority, match, actions, idle_timeout=0, hard_timeout=0):
+        """Install a flow whose packets go through meter_id before its actions"""
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        inst = [parser.OFPInstructionMeter(meter_id, ofproto.OFPIT_METER),
+                parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS, actions)]
+        mod = parser.OFPFlowMod(datapath=datapath, cookie=METER_COOKIE | meter_id,
+                                priority=priority, match=match, instructions=inst,
+                                idle_timeout=idle_timeout, hard_timeout=hard_timeout,
+                                flags=ofproto.OFPFF_SEND_FLOW_REM)
+        datapath.send_msg(mod)
+        self.pools[datapath.id]['meters'][meter_id]['flows'].add((priority, match_key(match)))
+
+    def reclaim(self, datapath, meter_id):
+        pool = self.pools[datapath.id]
+        meter = pool['meters'].pop(meter_id)
+        del pool['by_key'][meter['key']]
+        ofproto = datapath.ofproto
+        datapath.send_msg(datapath.ofproto_parser.OFPMeterMod(datapath, command=ofproto.OFPMC_DELETE,
+                                                              flags=0, meter_id=meter_id))
+        pool['free'].append(meter_id)
+        self.stats['reclaimed'] += 1
+        self.logger.info("Switch %s: meter %d for %s reclaimed", datapath.id, meter_id, meter['key'])
+
+    @set_ev_cls(ofp_event.EventOFPFlowRemoved, MAIN_DISPATCHER)
+    def _flow_removed_handler(self, ev):
+        msg = ev.msg
+        if msg.cookie & COOKIE_TAG_MASK != METER_COOKIE:
+            return
+        pool = self.pools.get(msg.datapath.id)
+        meter = pool['meters'].get(msg.cookie & 0xFFFFFFFF) if pool else None
+        if meter is None:
+            return
+        meter['flows'].discard((msg.priority, match_key(msg.match)))
+        if not meter['flows']:
+            self.reclaim(msg.datapath, msg.cookie & 0xFFFFFFFF)
+
+    @set_ev_cls(ofp_event.EventOFPErrorMsg, MAIN_DISPATCHER)
+    def _error_msg_handler(self, ev):
+        msg = ev.msg
+        pool = self.pools.get(msg.datapath.id)
+        if pool is None or msg.type != msg.datapath.ofproto.OFPET_METER_MOD_FAILED:
+            return
+        # The error carries the start of the rejected meter mod: header, command, flags, meter id
+        if len(msg.data) >= 16:
+            meter_id = METER_ID.unpack_from(msg.data, 12)[0]
+            meter = pool['meters'].pop(meter_id, None)
+            if meter is not None:
+                del pool['by_key'][meter['key']]
+        # Do not keep handing out meters the switch will not take; callers fall back
+        pool['free'] = []
+        self.logger.warning("Switch %s rejected a meter (code %d), rate limiting disabled",
+                            msg.datapath.id, msg.code)
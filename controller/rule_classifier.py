@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# Firewall rule classification with CIDR prefixes and port ranges
+
+import socket
+from socket import inet_aton
+import struct
+
+_IP = struct.Struct('!I')
+PORT_FIELDS = ('tcp_src_port', 'tcp_dst_port', 'udp_src_port', 'udp_dst_port')
+
+# Rule port field -> (ip_proto, OpenFlow match field)
+PORT_MATCH_FIELDS = {
+    'tcp_src_port': (6, 'tcp_src'),
+    'tcp_dst_port': (6, 'tcp_dst'),
+    'udp_src_port': (17, 'udp_src'),
+    'udp_dst_port': (17, 'udp_dst'),
+}
+
+def ip_to_int(ip):
+    return _IP.unpack(socket.inet_aton(ip))[0]
+
+def int_to_ip(value):
+    return socket.inet_ntoa(_IP.pack(value))
+
+def prefix_mask(length):
+    return (0xFFFFFFFF << (32 - length)) & 0xFFFFFFFF
+
+def parse_prefix(value):
+    """'10.0.0.0/24' or '10.0.0.1' -> (network as int, prefix length)"""
+    if '/' in value:
+        addr, length = value.split('/')
+        length = int(length)
+    else:
+        addr, length = value, 32
+    if not 0 <= length <= 32:
+        raise ValueError('invalid prefix length in %r' % value)
+    return ip_to_int(addr) & prefix_mask(length), length
+
+def parse_port_range(value):
+    """80, (1000, 2000) or '1000-2000' -> (low, high)"""
+    if isinstance(value, int):
+        low = high = value
+    elif isinstance(value, str):
+        low, _, high = value.partition('-')
+        low = int(low)
+        high = int(high) if high else low
+    else:
+        low, high = value
+    if not 0 <= low <= high <= 0xFFFF:
+        raise ValueError('invalid port range %r' % (value,))
+    return low, high
+
+def range_to_masks(low, high, bits=16):
+    """Minimal list of (value, mask) pairs covering [low, high] exactly.
+
+    Greedily takes the largest aligned power-of-two block starting at low,
+    which yields the minimal prefix cover (at most 2 * bits - 2 entries).
+    """
+    full = (1 << bits) - 1
+    result = []
+    while low <= high:
+        size = low & -low if low else 1 << bits
+        while size > high - low + 1:
+            size >>= 1
+        result.append((low, full & ~(size - 1)))
+        low += size
+    return result
+
+def rule_match_fields(rule):
+    """OFPMatch keyword arguments for a rule, one dict per masked port block.
+
+    Prefixes become masked ipv4_src/ipv4_dst, port ranges the cross product
+    of their masked port blocks. Exact values are passed unmasked.
+    """
+    fields = {}
+    if 'src_mac' in rule:
+        fields['eth_src'] = rule['src_mac']
+    if 'dst_mac' in rule:
+        fields['eth_dst'] = rule['dst_mac']
+    for key, field in (('src_ip', 'ipv4_src'), ('dst_ip', 'ipv4_dst')):
+        if key in rule:
+            net, length = parse_prefix(rule[key])
+            fields['eth_type'] = 0x0800
+            if length == 32:
+                fields[field] = int_to_ip(net)
+            elif length > 0:
+                fields[field] = (int_to_ip(net), int_to_ip(prefix_mask(length)))
+    if 'ip_proto' in rule:
+        fields['eth_type'] = 0x0800
+        fields['ip_proto'] = rule['ip_proto']
+
+    result = [fields]
+    for key in PORT_FIELDS:
+        if key not in rule:
+            continue
+        proto, field = PORT_MATCH_FIELDS[key]
+        blocks = range_to_masks(*parse_port_range(rule[key]))
+        expanded = []
+        for base in result:
+            for value, mask in blocks:
+                match = dict(base, eth_type=0x0800, ip_proto=proto)
+                match[field] = value if mask == 0xFFFF else (value, mask)
+                expanded.append(match)
+        result = expanded
+    return result
+
+class RuleClassifier(object):
+    """First-match classifier over the firewall rule list.
+
+    Every rule is indexed under its most specific address field, source or
+    destination prefix, in a multibit trie flattened into one hash table per
+    stride: prefixes are expanded to the next stride length (a /20 becomes
+    16 /24 entries), so a lookup probes at most one dict per stride and
+    address instead of one per prefix length. The rules found there are
+    checked on their remaining fields; rules with no address prefix live in
+    a short wildcard list. Rule order is priority: the lowest index wins.
+    """
+
+    STRIDES = (8, 16, 24, 32)
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self.src_tables = {}  # stride length -> {network: [compiled rules]}
+        self.dst_tables = {}
+        self.wildcard = []
+        for index, rule in enumerate(self.rules):
+            self._add(index, rule)
+        self._src_probes = [(prefix_mask(l), t.get) for l, t in sorted(self.src_tables.items())]
+        self._dst_probes = [(prefix_mask(l), t.get) for l, t in sorted(self.dst_tables.items())]
+
+    def _add(self, index, rule):
+        src_net, src_len = parse_prefix(rule['src_ip']) if 'src_ip' in rule else (0, 0)
+        dst_net, dst_len = parse_prefix(rule['dst_ip']) if 'dst_ip' in rule else (0, 0)
+        proto = None
+        sport = dport = (0, 0xFFFF)
+        for key in PORT_FIELDS:
+            if key in rule:
+                proto = PORT_MATCH_FIELDS[key][0]
+                if key.endswith('src_port'):
+                    sport = parse_port_range(rule[key])
+                else:
+                    dport = parse_port_range(rule[key])
+        if 'ip_proto' in rule:
+            proto = rule['ip_proto']
+        needs_ip = 'src_ip' in rule or 'dst_ip' in rule or proto is not None
+
+        compiled = (index, rule.get('src_mac'), rule.get('dst_mac'), needs_ip,
+                    src_net, prefix_mask(src_len), dst_net, prefix_mask(dst_len), proto,
+                    sport[0], sport[1], dport[0], dport[1])
+        if src_len and src_len >= dst_len:
+            self._insert(self.src_tables, src_net, src_len, compiled)
+        elif dst_len:
+            self._insert(self.dst_tables, dst_net, dst_len, compiled)
+        else:
+            self.wildcard.append(compiled)
+
+    def _insert(self, tables, net, length, compiled):
+        stride = next(s for s in self.STRIDES if s >= length)
+        table = tables.setdefault(stride, {})
+        for low_bits in range(1 << (stride - length)):
+            table.setdefault(net | (low_bits << (32 - stride)), []).append(compiled)
+
+    @staticmethod
+    def _scan(bucket, best, src_mac, dst_mac, src, dst, proto, sport, dport):
+        """Index of the first rule in bucket (sorted by index) matching, if lower than best"""
+        for (index, r_src_mac, r_dst_mac, needs_ip, src_net, src_mask, dst_net, dst_mask,
+             r_proto, slo, shi, dlo, dhi) in bucket:
+            if best is not None and index >= best:
+                break
+            if needs_ip:
+                if src is None or (src & src_mask) != src_net or (dst & dst_mask) != dst_net:
+                    continue
+                if r_proto is not None and (r_proto != proto or not slo <= sport <= shi
+                                            or not dlo <= dport <= dhi):
+                    continue
+            if r_src_mac is not None and r_src_mac != src_mac:
+                continue
+            if r_dst_mac is not None and r_dst_mac != dst_mac:
+                continue
+            return index
+        return best
+
+    def __len__(self):
+        return len(self.rules)
+
+    def classify(self, src_mac, dst_mac, src_ip=None, dst_ip=None, proto=None, sport=0, dport=0):
+        """Return the first rule matching the packet, or None.
+
+        src_ip/dst_ip are dotted strings (None for non-IP packets); sport/dport
+        only matter for TCP/UDP.
+        """
+        if src_ip is None:
+            return self.lookup(src_mac, dst_mac, None, None, proto, sport, dport)
+        return self.lookup(src_mac, dst_mac, _IP.unpack(inet_aton(src_ip))[0],
+                           _IP.unpack(inet_aton(dst_ip))[0], proto, sport, dport)
+
+    def lookup(self, src_mac, dst_mac, src, dst, proto=None, sport=0, dport=0):
+        """classify() with the addresses as 32-bit integers"""
+        scan = self._scan
+        best = scan(self.wildcard, None, src_mac, dst_mac, src, dst, proto, sport, dport) if self.wildcard else None
+        if src is None:
+            return None if best is None else self.rules[best]
+        for mask, get in self._src_probes:
+            bucket = get(src & mask)
+            if bucket is not None and (best is None or bucket[0][0] < best):
+                best = scan(bucket, best, src_mac, dst_mac, src, dst, proto, sport, dport)
+        for mask, get in self._dst_probes:
+            bucket = get(dst & mask)
+            if bucket is not None and (best is None or bucket[0][0] < best):
+                best = scan(bucket, best, src_mac, dst_mac, src, dst, proto, sport, dport)
+        return None if best is None else self.rules[best]
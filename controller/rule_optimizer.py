@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# Firewall rule-set optimization: shadowed, redundant and mergeable rules
+
+from collections import namedtuple
+from itertools import product
+
+from rule_classifier import (PORT_FIELDS, PORT_MATCH_FIELDS, int_to_ip, parse_port_range,
+                             parse_prefix, prefix_mask, rule_match_fields)
+
+FULL_RANGE = (0, 0xFFFF)
+PORT_KEYS = {(6, 'src'): 'tcp_src_port', (6, 'dst'): 'tcp_dst_port',
+             (17, 'src'): 'udp_src_port', (17, 'dst'): 'udp_dst_port'}
+
+# A rule as a box in header space. run numbers consecutive rules with the
+# same action: inside a run the order of the rules does not matter.
+_Rule = namedtuple('_Rule', 'index run action src_mac dst_mac ip proto src src_len '
+                            'dst dst_len sport dport names')
+
+def _normalize(index, run, rule):
+    src, src_len = parse_prefix(rule['src_ip']) if 'src_ip' in rule else (0, 0)
+    dst, dst_len = parse_prefix(rule['dst_ip']) if 'dst_ip' in rule else (0, 0)
+    proto = rule.get('ip_proto')
+    sport = dport = FULL_RANGE
+    for key in PORT_FIELDS:
+        if key in rule:
+            proto = PORT_MATCH_FIELDS[key][0]
+            if key.endswith('src_port'):
+                sport = parse_port_range(rule[key])
+            else:
+                dport = parse_port_range(rule[key])
+    ip = 'src_ip' in rule or 'dst_ip' in rule or proto is not None
+    return _Rule(index, run, rule['action'], rule.get('src_mac'), rule.get('dst_mac'), ip, proto,
+                 src, src_len, dst, dst_len, sport, dport, (rule.get('name', str(index)),))
+
+def _to_rule(r):
+    rule = {'name': '+'.join(r.names)}
+    if r.src_mac is not None:
+        rule['src_mac'] = r.src_mac
+    if r.dst_mac is not None:
+        rule['dst_mac'] = r.dst_mac
+    for key, net, length in (('src_ip', r.src, r.src_len), ('dst_ip', r.dst, r.dst_len)):
+        if length == 32:
+            rule[key] = int_to_ip(net)
+        elif length:
+            rule[key] = '%s/%d' % (int_to_ip(net), length)
+    ports = False
+    for side, (low, high) in (('src', r.sport), ('dst', r.dport)):
+        if (low, high) != FULL_RANGE and (r.proto, side) in PORT_KEYS:
+            rule[PORT_KEYS[(r.proto, side)]] = low if low == high else (low, high)
+            ports = True
+    if r.proto is not None and not ports:
+        rule['ip_proto'] = r.proto
+    if r.ip and 'src_ip' not in rule and 'dst_ip' not in rule and r.proto is None:
+        rule['src_ip'] = '0.0.0.0/0'
+    rule['action'] = r.action
+    return rule
+
+def _covers(a, b, b_src_mac=None, b_dst_mac=None):
+    """Whether every packet matching b also matches a.
+
+    b_src_mac/b_dst_mac stand in for b's MACs where b has none, e.g. the
+    MACs bound to b's host addresses.
+    """
+    b_src_mac = b.src_mac if b.src_mac is not None else b_src_mac
+    b_dst_mac = b.dst_mac if b.dst_mac is not None else b_dst_mac
+    return ((a.src_mac is None or a.src_mac == b_src_mac) and
+            (a.dst_mac is None or a.dst_mac == b_dst_mac) and
+            (b.ip or not a.ip) and
+            (a.proto is None or a.proto == b.proto) and
+            a.src_len <= b.src_len and (b.src & prefix_mask(a.src_len)) == a.src and
+            a.dst_len <= b.dst_len and (b.dst & prefix_mask(a.dst_len)) == a.dst and
+            a.sport[0] <= b.sport[0] and b.sport[1] <= a.sport[1] and
+            a.dport[0] <= b.dport[0] and b.dport[1] <= a.dport[1])
+
+def _single(port_range):
+    return port_range[0] if port_range[0] == port_range[1] else None
+
+class _CoverIndex(object):
+    """Rules indexed so that the candidates covering a rule are found by hashing.
+
+    Like RuleClassifier, each rule is filed under its most specific address
+    prefix (one table per prefix length), rules without a prefix in one
+    wildcard bucket. Inside a bucket rules are keyed by MACs, protocol and
+    single ports (None for any / a range). A rule's coverers can only sit
+    under a shorter or equal prefix containing its own, with each key field
+    either None or equal to its own, so a query costs one probe per prefix
+    length in use, times the key combinations where a bucket is large.
+    """
+
+    def __init__(self, rules):
+        self.src_tables = {}
+        self.dst_tables = {}
+        self.wildcard = {}
+        for r in rules:
+            if r.src_len and r.src_len >= r.dst_len:
+                bucket = self.src_tables.setdefault(r.src_len, {}).setdefault(r.src, {})
+            elif r.dst_len:
+                bucket = self.dst_tables.setdefault(r.dst_len, {}).setdefault(r.dst, {})
+            else:
+                bucket = self.wildcard
+            key = (r.src_mac, r.dst_mac, r.proto, _single(r.sport), _single(r.dport))
+            bucket.setdefault(key, []).append(r)
+
+    def _buckets(self, r):
+        if self.wildcard:
+            yield self.wildcard
+        for length, table in self.src_tables.items():
+            if length <= r.src_len:
+                bucket = table.get(r.src & prefix_mask(length))
+                if bucket:
+                    yield bucket
+        for length, table in self.dst_tables.items():
+            if length <= r.dst_len:
+                bucket = table.get(r.dst & prefix_mask(length))
+                if bucket:
+                    yield bucket
+
+    def candidates(self, r, src_mac, dst_mac):
+        """Rules that may cover r, taking src_mac/dst_mac as its MACs"""
+        keys = list(product(*[(None,) if value is None else (None, value) for value in
+                              (src_mac, dst_mac, r.proto, _single(r.sport), _single(r.dport))]))
+        for bucket in self._buckets(r):
+            if len(bucket) <= len(keys):
+                for rules in bucket.values():
+                    yield from rules
+            else:
+                for key in keys:
+                    yield from bucket.get(key, ())
+
+def _find_cover(index, b, src_mac, dst_mac):
+    """How b is covered by another rule ('shadowed' or 'redundant') and by which, or None"""
+    for a in index.candidates(b, src_mac, dst_mac):
+        if a is b or a.run > b.run or not _covers(a, b, src_mac, dst_mac):
+            continue
+        if a.run < b.run:
+            return ('shadowed' if a.action != b.action else 'redundant'), a
+        # Same run: drop the covered rule; of two equal rules, the later one
+        if a.index < b.index or not _covers(b, a):
+            return 'redundant', a
+    return None
+
+def _remove_covered(rules, bindings, report):
+    index = _CoverIndex(rules)
+    kept = []
+    for b in rules:
+        found = _find_cover(index, b, b.src_mac, b.dst_mac)
+        if found:
+            report[found[0]].append(b.names[0])
+            continue
+        kept.append(b)
+        # Under the host bindings, traffic between two bound host IPs carries
+        # their MACs - but only while hosts keep them, so such a rule is reported
+        # as overlapping, never removed
+        if bindings and b.ip:
+            src_mac = bindings.get(int_to_ip(b.src)) if b.src_mac is None and b.src_len == 32 else None
+            dst_mac = bindings.get(int_to_ip(b.dst)) if b.dst_mac is None and b.dst_len == 32 else None
+            if src_mac or dst_mac:
+                found = _find_cover(index, b, src_mac or b.src_mac, dst_mac or b.dst_mac)
+                if found:
+                    report['overlaps'].append((b.names[0], found[1].names[0]))
+    return kept
+
+def _merge_ranges(rules, field):
+    """Merge rules differing only in one overlapping or adjacent port range"""
+    groups = {}
+    for r in rules:
+        key = r._replace(index=0, names=(), **{field: None})
+        groups.setdefault(key, []).append(r)
+    result = []
+    for group in groups.values():
+        group.sort(key=lambda r: getattr(r, field))
+        current = group[0]
+        for r in group[1:]:
+            low, high = getattr(current, field)
+            if getattr(r, field)[0] <= high + 1:
+                current = current._replace(index=min(current.index, r.index), names=current.names + r.names,
+                                           **{field: (low, max(high, getattr(r, field)[1]))})
+            else:
+                result.append(current)
+                current = r
+        result.append(current)
+    return result
+
+def _merge_prefixes(rules, net_field, len_field):
+    """Merge rules differing only in two sibling prefixes into their parent"""
+    groups = {}
+    result = []
+    for r in rules:
+        if not getattr(r, len_field):
+            result.append(r)
+            continue
+        key = r._replace(index=0, names=(), **{net_field: None, len_field: None})
+        groups.setdefault(key, {})[(getattr(r, net_field), getattr(r, len_field))] = r
+    for members in groups.values():
+        if len(members) < 2:
+            result.extend(members.values())
+            continue
+        nets = {}  # prefix length -> networks of that length
+        for net, length in members:
+            nets.setdefault(length, set()).add(net)
+        for length in range(32, 0, -1):
+            level = nets.get(length)
+            if not level:
+                continue
+            for net in sorted(level):
+                sibling = net ^ (1 << (32 - length))
+                if net not in level or sibling not in level:
+                    continue
+                level.difference_update((net, sibling))
+                a, b = members.pop((net, length)), members.pop((sibling, length))
+                parent = (net & prefix_mask(length - 1), length - 1)
+                members[parent] = a._replace(index=min(a.index, b.index), names=a.names + b.names,
+                                             **{net_field: parent[0], len_field: parent[1]})
+                nets.setdefault(length - 1, set()).add(parent[0])
+        result.extend(members.values())
+    return result
+
+def optimize_rules(rules, bindings=None, base_priority=100):
+    """Reduce a first-match rule list to an equivalent minimal one.
+
+    Removes rules that can never match first (shadowed by an earlier rule
+    with another action) or that do not change the outcome (covered by an
+    earlier rule, or by any rule of the same run of equal-action rules),
+    merges rules of a run that differ only in sibling prefixes or adjacent
+    port ranges, and drops a trailing run of 'allow' rules (the default).
+    bindings ({ip: mac}) only adds to the report: a rule between two host
+    IPs that is covered by a rule on the hosts' MACs is kept (a host can
+    change its MAC) and listed in report['overlaps'] with the covering rule.
+
+    Returns (rules, report). Each returned rule carries a 'priority': one
+    level per run, highest first, starting at base_priority for the last.
+    The report counts the rules and OpenFlow entries before and after.
+    """
+    normalized = []
+    run = 0
+    for index, rule in enumerate(rules):
+        if normalized and rule['action'] != normalized[-1].action:
+            run += 1
+        normalized.append(_normalize(index, run, rule))
+
+    report = {'shadowed': [], 'redundant': [], 'overlaps': [], 'merged': 0}
+    kept = _remove_covered(normalized, bindings, report)
+
+    count = len(kept)
+    for _ in range(4):
+        for field in ('dport', 'sport'):
+            kept = _merge_ranges(kept, field)
+        kept = _merge_prefixes(kept, 'src', 'src_len')
+        kept = _merge_prefixes(kept, 'dst', 'dst_len')
+        if len(kept) == count:
+            break
+        count = len(kept)
+    report['merged'] = len(normalized) - len(report['shadowed']) - len(report['redundant']) - len(kept)
+
+    kept.sort(key=lambda r: r.index)
+    while kept and kept[-1].action == 'allow':
+        report['redundant'].append(kept.pop().names[0])
+
+    runs = sorted(set(r.run for r in kept))
+    priorities = {run: base_priority + len(runs) - 1 - i for i, run in enumerate(runs)}
+    optimized = []
+    for r in kept:
+        rule = _to_rule(r)
+        rule['priority'] = priorities[r.run]
+        optimized.append(rule)
+
+    report['rules_in'] = len(rules)
+    report['rules_out'] = len(optimized)
+    report['flows_in'] = sum(len(rule_match_fields(rule)) for rule in rules)
+    report['flows_out'] = sum(len(rule_match_fields(rule)) for rule in optimized)
+    return optimized, report
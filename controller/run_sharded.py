@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# Run the controller as several ryu-manager workers, one OpenFlow port per shard
+#
+# Worker i listens on base_port + i. A switch with datapath id D must connect to
+# sharding.shard_port(D, workers, base_port), so each datapath is handled by
+# exactly one worker (per-switch message ordering is kept by its TCP stream).
+# MAC tables and flow state are per datapath and stay local to the worker;
+# load-balancer sessions and firewall DoS counters live in shared-memory tables.
+#
+# Usage: python3 controller/run_sharded.py [--workers N] [--base-port 6653] [app.py ...]
+
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import sharding
+
+CONTROLLER_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_APPS = ['sdn_controller.py', 'firewall_vnf.py', 'load_balancer_vnf.py']
+
+# Tables shared by every worker (see sharding.shared_table callers)
+SHARED_TABLES = ['lb_sessions', 'fw_connection_track_0', 'fw_connection_track_1']
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a sharded Ryu controller')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--base-port', type=int, default=sharding.DEFAULT_BASE_PORT)
+    parser.add_argument('--listen-host', default='0.0.0.0')
+    parser.add_argument('--state-dir', default=sharding.DEFAULT_STATE_DIR)
+    parser.add_argument('--slots', type=int, default=sharding.DEFAULT_SLOTS,
+                        help='capacity of each shared state table')
+    parser.add_argument('--log-dir', default=None, help='write one log file per worker here')
+    parser.add_argument('apps', nargs='*', default=DEFAULT_APPS)
+    args = parser.parse_args()
+
+    os.makedirs(args.state_dir, exist_ok=True)
+    for name in SHARED_TABLES:
+        sharding.SharedTable.create(os.path.join(args.state_dir, name + '.tbl'), args.slots)
+
+    apps = [app if os.path.isabs(app) else os.path.join(CONTROLLER_DIR, app) for app in args.apps]
+    workers = []
+    for index in range(args.workers):
+        env = dict(os.environ)
+        env[sharding.SHARD_INDEX_ENV] = str(index)
+        env[sharding.SHARD_COUNT_ENV] = str(args.workers)
+        env[sharding.STATE_DIR_ENV] = args.state_dir
+        cmd = ['ryu-manager', '--ofp-listen-host=%s' % args.listen_host,
+               '--ofp-tcp-listen-port=%d' % (args.base_port + index)] + apps
+        log = None
+        if args.log_dir:
+            os.makedirs(args.log_dir, exist_ok=True)
+            log = open(os.path.join(args.log_dir, 'worker_%d.log' % index), 'w')
+        workers.append(subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT if log else None))
+        print("Started worker %d on port %d (pid %d)" % (index, args.base_port + index, workers[-1].pid))
+
+    def stop(signum, frame):
+        for worker in workers:
+            if worker.poll() is None:
+                worker.terminate()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    # Exit as soon as any worker dies, taking the others down with it
+    while all(worker.poll() is None for worker in workers):
+        time.sleep(0.5)
+    stop(None, None)
+    for worker in workers:
+        worker.wait()
+
+if __name__ == '__main__':
+    main()
@@ -6,14 +6,44 @@ from ryu.controller import ofp_event
 from ryu.controller.handler import CONFIG_DISPATCHER, MAIN_DISPATCHER, set_ev_cls
 from ryu.ofproto import ofproto_v1_3
 from ryu.lib.packet import packet, ethernet, ether_types
+from ryu.lib import hub
+
+from arp_proxy import ArpProxy
+from flow_reconcile import FlowReconciler
+from flow_table import FlowTableManager
+from flow_templates import MessageTemplates
+from flow_timeouts import AdaptiveTimeouts
+from state_snapshot import StateSnapshot, snapshot_path
+from state_table import MacTable
+from work_queue import WorkQueue
+import sharding
 
 class SimpleSwitch13(app_manager.RyuApp):
     OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
+    _CONTEXTS = {'arp_proxy': ArpProxy, 'reconciler': FlowReconciler,
+                 'timeouts': AdaptiveTimeouts, 'flow_table': FlowTableManager,
+                 'work_queue': WorkQueue}
     
     def __init__(self, *args, **kwargs):
         super(SimpleSwitch13, self).__init__(*args, **kwargs)
-        self.mac_to_port = {}
-        self.logger.info("Simple Switch 13 initialized")
+        self.mac_to_port = {}  # dpid -> MacTable
+        self.arp_proxy = kwargs['arp_proxy']
+        self.reconciler = kwargs['reconciler']
+        self.timeouts = kwargs['timeouts']
+        self.work = kwargs['work_queue']  # deferred packet-in logging
+        self.templates = MessageTemplates(self.logger)  # pre-serialized packet-in responses
+        self.shard = sharding.shard_config()
+        
+        # Warm restart: reload the last snapshot, then keep snapshotting
+        self.snapshot_interval = 10  # seconds
+        self.snapshot = StateSnapshot(snapshot_path('sdn_controller'))
+        self.restore_state(self.snapshot.load())
+        self.snapshot_thread = hub.spawn(self._snapshot_loop)
+        
+        if self.shard:
+            self.logger.info("Simple Switch 13 initialized as shard %d of %d", *self.shard)
+        else:
+            self.logger.info("Simple Switch 13 initialized")
     
     @set_ev_cls(ofp_event.EventOFPSwitchFeatures, CONFIG_DISPATCHER)
     def switch_features_handler(self, ev):
@@ -25,30 +55,39 @@ class SimpleSwitch13(app_manager.RyuApp):
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
         
+        if sharding.reject_foreign_datapath(datapath, self.logger):
+            return
+        
         # Install the table-miss flow entry
         # This entry will send packets to the controller if no match is found
+        # (flows the switch already has, e.g. after a controller restart, are not re-sent)
         match = parser.OFPMatch()
         actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER, ofproto.OFPCML_NO_BUFFER)]
-        self.add_flow(datapath, 0, match, actions)
+        self.reconciler.ensure_flow(datapath, ev.msg, 0, match, actions)
         self.logger.info("Table-miss flow entry installed on switch %s", datapath.id)
-    
-    def add_flow(self, datapath, priority, match, actions, buffer_id=None, idle_timeout=0, hard_timeout=0):
-        ofproto = datapath.ofproto
-        parser = datapath.ofproto_parser
-        
-        inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS, actions)]
         
-        if buffer_id:
-            mod = parser.OFPFlowMod(datapath=datapath, buffer_id=buffer_id,
-                                    priority=priority, match=match,
-                                    instructions=inst, idle_timeout=idle_timeout,
-                                    hard_timeout=hard_timeout)
-        else:
-            mod = parser.OFPFlowMod(datapath=datapath, priority=priority,
-                                    match=match, instructions=inst,
-                                    idle_timeout=idle_timeout, 
-                                    hard_timeout=hard_timeout)
-        datapath.send_msg(mod)
+        # ARP requests are answered by the controller instead of being flooded
+        self.reconciler.ensure_flow(datapath, ev.msg, *self.arp_proxy.punt_flow(datapath))
+    
+    def snapshot_state(self):
+        return {'mac_to_port': self.mac_to_port, 'arp_cache': self.arp_proxy.ip_to_mac}
+    
+    def restore_state(self, state):
+        if not state:
+            return
+        self.mac_to_port = {dpid: MacTable(ports) for dpid, ports in state.get('mac_to_port', {}).items()}
+        self.arp_proxy.ip_to_mac.update(state.get('arp_cache', {}))
+        self.logger.info("Restored state for %d switches from %s", len(self.mac_to_port), self.snapshot.path)
+    
+    def _snapshot_loop(self):
+        while True:
+            hub.sleep(self.snapshot_interval)
+            # Serializing copies the state on the hub; the file IO runs in a native thread
+            self.work.run_blocking(self.snapshot.write, self.snapshot.serialize(self.snapshot_state()))
+    
+    def stop(self):
+        self.snapshot.save(self.snapshot_state())
+        super(SimpleSwitch13, self).stop()
     
     @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
     def _packet_in_handler(self, ev):
@@ -56,7 +95,6 @@ class SimpleSwitch13(app_manager.RyuApp):
         msg = ev.msg
         datapath = msg.datapath
         ofproto = datapath.ofproto
-        parser = datapath.ofproto_parser
         in_port = msg.match['in_port']
         
         pkt = packet.Packet(msg.data)
@@ -70,12 +108,17 @@ class SimpleSwitch13(app_manager.RyuApp):
         src = eth.src
         dpid = datapath.id
         
-        self.logger.info("Packet in switch %s: src=%s dst=%s in_port=%s", dpid, src, dst, in_port)
+        self.work.log(self.logger.info, "Packet in switch %s: src=%s dst=%s in_port=%s", dpid, src, dst, in_port)
         
         # Learn MAC address to avoid FLOOD next time
-        self.mac_to_port.setdefault(dpid, {})
+        if dpid not in self.mac_to_port:
+            self.mac_to_port[dpid] = MacTable()
         self.mac_to_port[dpid][src] = in_port
         
+        # Answer ARP from the controller's cache instead of flooding it
+        if eth.ethertype == ether_types.ETH_TYPE_ARP and self.arp_proxy.handle_packet_in(msg, pkt, in_port):
+            return
+        
         # If the destination is known, forward to the specific port
         # Otherwise, flood to all ports
         if dst in self.mac_to_port[dpid]:
@@ -83,23 +126,24 @@ class SimpleSwitch13(app_manager.RyuApp):
         else:
             out_port = ofproto.OFPP_FLOOD
         
-        actions = [parser.OFPActionOutput(out_port)]
+        actions = [('output', out_port)]
         
         # Install a flow to avoid packet_in next time
         if out_port != ofproto.OFPP_FLOOD:
-            match = parser.OFPMatch(in_port=in_port, eth_dst=dst, eth_src=src)
+            match = {'in_port': in_port, 'eth_dst': dst, 'eth_src': src}
             # Verify if we have a valid buffer_id, if yes avoid sending both flow_mod & packet_out
+            idle_timeout = self.timeouts.install(datapath, 'l2', 1, match)
             if msg.buffer_id != ofproto.OFP_NO_BUFFER:
-                self.add_flow(datapath, 1, match, actions, msg.buffer_id, idle_timeout=300)
+                self.templates.add_flow(datapath, 1, match, actions, msg.buffer_id,
+                                        idle_timeout=idle_timeout, flags=ofproto.OFPFF_SEND_FLOW_REM)
                 return
             else:
-                self.add_flow(datapath, 1, match, actions, idle_timeout=300)
+                self.templates.add_flow(datapath, 1, match, actions, idle_timeout=idle_timeout,
+                                        flags=ofproto.OFPFF_SEND_FLOW_REM)
         
         # Forward the packet
         data = None
         if msg.buffer_id == ofproto.OFP_NO_BUFFER:
             data = msg.data
             
-        out = parser.OFPPacketOut(datapath=datapath, buffer_id=msg.buffer_id,
-                                  in_port=in_port, actions=actions, data=data)
-        datapath.send_msg(out)
\ No newline at end of file
+        self.templates.packet_out(datapath, msg.buffer_id, in_port, actions, data)
\ No newline at end of file
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# Sharded deployment support: datapath-to-worker mapping and cross-process state
+
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+# Set by run_sharded.py for every worker process
+SHARD_INDEX_ENV = 'SDN_SHARD_INDEX'
+SHARD_COUNT_ENV = 'SDN_SHARD_COUNT'
+STATE_DIR_ENV = 'SDN_SHARED_STATE_DIR'
+
+DEFAULT_BASE_PORT = 6653
+DEFAULT_STATE_DIR = '/dev/shm/sdn_controller'
+DEFAULT_SLOTS = 262144
+
+def shard_for_dpid(dpid, shard_count):
+    """Worker index that owns a datapath (stable across processes and restarts)"""
+    mixed = (dpid * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    return (mixed >> 32) % shard_count
+
+def shard_port(dpid, shard_count, base_port=DEFAULT_BASE_PORT):
+    """OpenFlow port a switch must connect to in a sharded deployment"""
+    return base_port + shard_for_dpid(dpid, shard_count)
+
+def reject_foreign_datapath(datapath, logger):
+    """Disconnect a switch that connected to the wrong shard; True if it was.
+
+    Its state (MAC tables, conntrack, flows) would be split from that of the
+    worker that owns it, so it must reconnect to shard_port() instead.
+    """
+    shard = shard_config()
+    if shard is None:
+        return False
+    owner = shard_for_dpid(datapath.id, shard[1])
+    if owner == shard[0]:
+        return False
+    logger.error("Switch %s belongs to shard %d but connected to shard %d, disconnecting",
+                 datapath.id, owner, shard[0])
+    datapath.close()
+    return True
+
+def shard_config():
+    """(shard_index, shard_count) of this process, or None when not sharded"""
+    if SHARD_COUNT_ENV not in os.environ:
+        return None
+    return int(os.environ[SHARD_INDEX_ENV]), int(os.environ[SHARD_COUNT_ENV])
+
+def shared_table(name, local_table=None):
+    """State table that must be global across workers.
+
+    Returns a SharedTable backed by the run's shared-memory directory when
+    running as a shard, and a process-local table otherwise: a local_table()
+    (e.g. state_table.IPv4Table) if given, else a LocalTable.
+    """
+    if shard_config() is None:
+        return (local_table or LocalTable)()
+    state_dir = os.environ.get(STATE_DIR_ENV, DEFAULT_STATE_DIR)
+    return SharedTable(os.path.join(state_dir, name + '.tbl'))
+
+class LocalTable(dict):
+    """Plain dict with the same increment() as SharedTable"""
+
+    def increment(self, key, delta=1):
+        value = self.get(key, 0) + delta
+        self[key] = value
+        return value
+
+class SharedTable(object):
+    """Fixed-capacity string -> int hash table in a memory-mapped file.
+
+    Meant for /dev/shm so every worker maps the same pages. Slots are
+    [state:1][key:15][value:8]; linear probing with a process-independent hash
+    (crc32). Every operation holds an flock on the file, so read-modify-write
+    updates (increment) are atomic across workers. flock does not exclude
+    threads sharing the open file (the first LOCK_UN would release it for
+    all of them), so a thread lock is held around it as well: operations may
+    run in native threads (WorkQueue.run_blocking). The capacity is fixed at
+    create() time. The header also holds a stamp (e.g. the time window the
+    table counts in) for clear_if_older().
+    """
+
+    HEADER = struct.Struct('<8sIq')  # magic, slot count, stamp
+    MAGIC = b'SDNSHTB2'
+    SLOT = struct.Struct('<B15sq')
+    KEY_SIZE = 15
+    EMPTY, USED, DELETED = 0, 1, 2
+
+    @classmethod
+    def create(cls, path, slots=DEFAULT_SLOTS):
+        """Create (or reset) an empty table file"""
+        size = cls.HEADER.size + slots * cls.SLOT.size
+        with open(path, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, slots, 0))
+            f.truncate(size)
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        magic, self.slots, _ = self.HEADER.unpack_from(self._map, 0)
+        if magic != self.MAGIC:
+            raise ValueError('%s is not a shared state table' % path)
+
+    def _key(self, key):
+        raw = str(key).encode()
+        if len(raw) > self.KEY_SIZE:
+            raise ValueError('key too long for shared table: %r' % key)
+        return raw.ljust(self.KEY_SIZE, b'\0')
+
+    def _offset(self, slot):
+        return self.HEADER.size + slot * self.SLOT.size
+
+    def _find(self, raw):
+        """(slot, found); slot is where raw lives or should be inserted (-1 if full)"""
+        slot = zlib.crc32(raw) % self.slots
+        first_free = -1
+        for _ in range(self.slots):
+            state, key, _ = self.SLOT.unpack_from(self._map, self._offset(slot))
+            if state == self.EMPTY:
+                return (first_free if first_free >= 0 else slot), False
+            if state == self.DELETED:
+                if first_free < 0:
+                    first_free = slot
+            elif key == raw:
+                return slot, True
+            slot = (slot + 1) % self.slots
+        return first_free, False
+
+    def _locked(self, exclusive):
+        self._lock.acquire()
+        try:
+            fcntl.flock(self._file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        except BaseException:
+            self._lock.release()
+            raise
+
+    def _unlock(self):
+        try:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+        finally:
+            self._lock.release()
+
+    def get(self, key, default=None):
+        raw = self._key(key)
+        self._locked(False)
+        try:
+            slot, found = self._find(raw)
+            if not found:
+                return default
+            return self.SLOT.unpack_from(self._map, self._offset(slot))[2]
+        finally:
+            self._unlock()
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __setitem__(self, key, value):
+        self._update(key, lambda old: value)
+
+    def increment(self, key, delta=1):
+        return self._update(key, lambda old: (old or 0) + delta)
+
+    def _update(self, key, fn):
+        raw = self._key(key)
+        self._locked(True)
+        try:
+            slot, found = self._find(raw)
+            if slot < 0:
+                raise RuntimeError('shared table %s is full' % self.path)
+            old = self.SLOT.unpack_from(self._map, self._offset(slot))[2] if found else None
+            value = fn(old)
+            self.SLOT.pack_into(self._map, self._offset(slot), self.USED, raw, value)
+            return value
+        finally:
+            self._unlock()
+
+    def __delitem__(self, key):
+        raw = self._key(key)
+        self._locked(True)
+        try:
+            slot, found = self._find(raw)
+            if not found:
+                raise KeyError(key)
+            self.SLOT.pack_into(self._map, self._offset(slot), self.DELETED, raw, 0)
+        finally:
+            self._unlock()
+
+    def pop(self, key, default=None):
+        try:
+            value = self[key]
+            del self[key]
+            return value
+        except KeyError:
+            return default
+
+    def items(self):
+        self._locked(False)
+        try:
+            result = []
+            for slot in range(self.slots):
+                state, key, value = self.SLOT.unpack_from(self._map, self._offset(slot))
+                if state == self.USED:
+                    result.append((key.rstrip(b'\0').decode(), value))
+            return result
+        finally:
+            self._unlock()
+
+    def clear(self):
+        self._locked(True)
+        try:
+            start = self.HEADER.size
+            self._map[start:] = bytes(len(self._map) - start)
+        finally:
+            self._unlock()
+
+    def clear_if_older(self, stamp):
+        """Empty the table and stamp it, unless it already carries stamp or a later one.
+
+        Only the first worker to get to a new stamp clears; True if it was this call.
+        """
+        self._locked(True)
+        try:
+            if self.HEADER.unpack_from(self._map, 0)[2] >= stamp:
+                return False
+            start = self.HEADER.size
+            self._map[start:] = bytes(len(self._map) - start)
+            self.HEADER.pack_into(self._map, 0, self.MAGIC, self.slots, stamp)
+            return True
+        finally:
+            self._unlock()
+
+    def __len__(self):
+        return len(self.items())
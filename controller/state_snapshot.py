@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# Periodic controller state snapshots in a memory-mapped file (warm restart)
+
+import mmap
+import os
+import pickle
+import stat
+import struct
+import threading
+import zlib
+
+import sharding
+
+SNAPSHOT_DIR_ENV = 'SDN_SNAPSHOT_DIR'
+DEFAULT_SNAPSHOT_DIR = '/var/tmp/sdn_controller-%d' % os.getuid()
+
+def private_directory(directory):
+    """Create directory (mode 0700) if needed and make sure only we can write to it.
+
+    Snapshots are unpickled, so a file another user could plant or replace
+    would run their code in the controller.
+    """
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o022:
+        raise PermissionError('snapshot directory %s must be a directory owned by uid %d and '
+                              'writable only by it' % (directory, os.getuid()))
+
+def snapshot_path(name):
+    """Snapshot file for an app (one per shard when running sharded)"""
+    directory = os.environ.get(SNAPSHOT_DIR_ENV, DEFAULT_SNAPSHOT_DIR)
+    shard = sharding.shard_config()
+    if shard:
+        name = '%s.shard%d' % (name, shard[0])
+    return os.path.join(directory, name + '.snap')
+
+class StateSnapshot(object):
+    """Double-buffered snapshot file.
+
+    The file holds two slots of equal capacity, each [magic][seq][len][crc][data].
+    save() writes into the slot holding the older snapshot and flushes the
+    data before its header, so a crash mid-write leaves the previous snapshot
+    intact. When a snapshot outgrows the slots, the file is rebuilt under a
+    temporary name, fsynced and renamed over the old one. load() returns the
+    newest slot whose checksum is valid. The file lives in a private_directory()
+    and is only read if we own it.
+
+    save() is serialize() then write(). The apps serialize on the hub, which
+    copies the state while nothing changes it, and hand the bytes to write()
+    in a native thread: the file IO releases the GIL and may be called from
+    several threads.
+    """
+
+    MAGIC = b'SDNSNAP1'
+    SLOT_HEADER = struct.Struct('<8sQQI')
+    MIN_CAPACITY = 64 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.seq = 0
+        self._file = None
+        self._map = None
+        self.capacity = 0  # bytes of data per slot
+        self._lock = threading.Lock()
+
+    def _slot_offset(self, slot):
+        return slot * (self.SLOT_HEADER.size + self.capacity)
+
+    def _open(self, capacity):
+        """Map the file, creating it if needed with slots of capacity bytes"""
+        self.close()
+        private_directory(os.path.dirname(self.path) or '.')
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        self._file = os.fdopen(fd, 'r+b')
+        if os.fstat(fd).st_uid != os.getuid():
+            self.close()
+            raise PermissionError('snapshot %s is not owned by uid %d' % (self.path, os.getuid()))
+        self.capacity = capacity
+        size = 2 * (self.SLOT_HEADER.size + capacity)
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+
+    def _write_slot(self, buf, slot, seq, data):
+        offset = self._slot_offset(slot)
+        start = offset + self.SLOT_HEADER.size
+        buf[start:start + len(data)] = data
+        self.SLOT_HEADER.pack_into(buf, offset, self.MAGIC, seq, len(data), zlib.crc32(data))
+
+    def _replace(self, capacity, seq, data):
+        """Atomically replace the file with a new layout holding only this snapshot"""
+        self.close()
+        private_directory(os.path.dirname(self.path) or '.')
+        self.capacity = capacity
+        buf = bytearray(2 * (self.SLOT_HEADER.size + capacity))
+        self._write_slot(buf, seq % 2, seq, data)
+        tmp = '%s.tmp%d' % (self.path, os.getpid())
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(buf)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        # Make the rename itself durable
+        dir_fd = os.open(os.path.dirname(self.path) or '.', os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        self._open(capacity)
+
+    def _read_slot(self, slot):
+        offset = self._slot_offset(slot)
+        magic, seq, length, crc = self.SLOT_HEADER.unpack_from(self._map, offset)
+        if magic != self.MAGIC or length > self.capacity:
+            return None
+        start = offset + self.SLOT_HEADER.size
+        data = self._map[start:start + length]
+        if zlib.crc32(data) != crc:
+            return None
+        return seq, data
+
+    def load(self):
+        """Return the newest valid snapshot, or None"""
+        if not os.path.exists(self.path):
+            return None
+        size = os.path.getsize(self.path)
+        if size < 2 * self.SLOT_HEADER.size:
+            return None
+        self._open(size // 2 - self.SLOT_HEADER.size)
+        slots = [s for s in (self._read_slot(0), self._read_slot(1)) if s is not None]
+        if not slots:
+            return None
+        self.seq, data = max(slots)
+        try:
+            return pickle.loads(data)
+        except Exception:
+            return None
+
+    def serialize(self, state):
+        return pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+
+    def write(self, data):
+        """Store serialized state as the newest snapshot"""
+        with self._lock:
+            self.seq += 1
+            if self._map is None or len(data) > self.capacity:
+                capacity = max(self.capacity, self.MIN_CAPACITY)
+                while capacity < len(data):
+                    capacity *= 2
+                # The old file keeps the previous snapshot until the new one replaces it
+                self._replace(capacity, self.seq, data)
+                return
+
+            # Written through the file rather than the map: pwrite and fdatasync
+            # release the GIL, slice assignment and msync do not
+            fd = self._file.fileno()
+            offset = self._slot_offset(self.seq % 2)
+            os.pwrite(fd, data, offset + self.SLOT_HEADER.size)
+            os.fdatasync(fd)
+            os.pwrite(fd, self.SLOT_HEADER.pack(self.MAGIC, self.seq, len(data), zlib.crc32(data)), offset)
+            os.fdatasync(fd)
+
+    def save(self, state):
+        self.write(self.serialize(state))
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
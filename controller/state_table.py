@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# Compact integer-keyed state tables (MAC -> port, IPv4 -> counter/index)
+
+from array import array
+
+from rule_classifier import int_to_ip, ip_to_int
+
+# Slot states
+EMPTY = 0
+USED = 1
+DELETED = 2  # tombstone left behind by a removed entry
+
+_HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+_MASK64 = 0xFFFFFFFFFFFFFFFF
+
+def mac_to_int(mac):
+    """'00:00:00:00:00:01' -> 1"""
+    return int(mac.replace(':', ''), 16)
+
+def int_to_mac(value):
+    text = '%012x' % value
+    return ':'.join(text[i:i + 2] for i in range(0, 12, 2))
+
+class IntTable(object):
+    """Open-addressing hash table of integer keys and values in flat arrays.
+
+    A dict replacement for controller state: each slot costs a key, a value
+    and one state byte (13 bytes for a MAC -> port slot) instead of a dict
+    entry plus key and value objects. No object is kept per entry. The table
+    doubles at max_load; linear probing with a Fibonacci hash; removed
+    entries leave tombstones that are purged on the next resize.
+
+    Keys may be given as ints or in their text form (subclasses define the
+    encoding); iteration returns the text form, so dict(table) gives the same
+    dict the apps used to keep and snapshots stay readable.
+    """
+
+    __slots__ = ('size', 'shift', 'count', 'tombstones', 'max_load',
+                 '_keys', '_values', '_states')
+
+    KEY_TYPE = 'Q'    # array typecodes
+    VALUE_TYPE = 'q'
+
+    def __init__(self, items=None, capacity=8, max_load=0.7):
+        size = 8
+        while size * max_load < capacity:
+            size *= 2
+        self.max_load = max_load
+        self.count = 0
+        self.tombstones = 0
+        self._allocate(size)
+        if items:
+            self.update(items)
+
+    def encode(self, key):
+        return key
+
+    def decode(self, key):
+        return key
+
+    def _allocate(self, size):
+        self.size = size
+        self.shift = 64 - (size.bit_length() - 1)
+        self._keys = array(self.KEY_TYPE, bytes(array(self.KEY_TYPE).itemsize * size))
+        self._values = array(self.VALUE_TYPE, bytes(array(self.VALUE_TYPE).itemsize * size))
+        self._states = bytearray(size)
+
+    def memory_bytes(self):
+        """Bytes used by the table storage"""
+        return (self._keys.itemsize + self._values.itemsize + 1) * self.size
+
+    def _find(self, key):
+        """Return (slot, found); slot is where key lives or should be inserted"""
+        slot = ((key * _HASH_MULTIPLIER) & _MASK64) >> self.shift
+        mask = self.size - 1
+        first_free = -1
+        keys = self._keys
+        states = self._states
+        while True:
+            state = states[slot]
+            if state == EMPTY:
+                return (first_free if first_free >= 0 else slot), False
+            if state == DELETED:
+                if first_free < 0:
+                    first_free = slot
+            elif keys[slot] == key:
+                return slot, True
+            slot = (slot + 1) & mask
+
+    def _resize(self, size):
+        old_keys, old_values, old_states = self._keys, self._values, self._states
+        self._allocate(size)
+        self.tombstones = 0
+        for slot in range(len(old_states)):
+            if old_states[slot] == USED:
+                new_slot, _ = self._find(old_keys[slot])
+                self._keys[new_slot] = old_keys[slot]
+                self._values[new_slot] = old_values[slot]
+                self._states[new_slot] = USED
+
+    def _insert(self, key, value):
+        if (self.count + self.tombstones + 1) > self.size * self.max_load:
+            # Grow if live entries are the problem, otherwise just purge tombstones
+            grow = (self.count + 1) > self.size * self.max_load / 2
+            self._resize(self.size * 2 if grow else self.size)
+        slot, _ = self._find(key)
+        if self._states[slot] == DELETED:
+            self.tombstones -= 1
+        self._keys[slot] = key
+        self._values[slot] = value
+        self._states[slot] = USED
+        self.count += 1
+
+    def get(self, key, default=None):
+        slot, found = self._find(key if key.__class__ is int else self.encode(key))
+        return self._values[slot] if found else default
+
+    def __getitem__(self, key):
+        slot, found = self._find(key if key.__class__ is int else self.encode(key))
+        if not found:
+            raise KeyError(key)
+        return self._values[slot]
+
+    def __contains__(self, key):
+        return self._find(key if key.__class__ is int else self.encode(key))[1]
+
+    def __setitem__(self, key, value):
+        key = key if key.__class__ is int else self.encode(key)
+        slot, found = self._find(key)
+        if found:
+            self._values[slot] = value
+        else:
+            self._insert(key, value)
+
+    def increment(self, key, delta=1):
+        """Add delta to the value of key (0 if absent); returns the new value"""
+        key = key if key.__class__ is int else self.encode(key)
+        slot, found = self._find(key)
+        if not found:
+            self._insert(key, delta)
+            return delta
+        value = self._values[slot] + delta
+        self._values[slot] = value
+        return value
+
+    def setdefault(self, key, default=0):
+        key = key if key.__class__ is int else self.encode(key)
+        slot, found = self._find(key)
+        if found:
+            return self._values[slot]
+        self._insert(key, default)
+        return default
+
+    def __delitem__(self, key):
+        slot, found = self._find(key if key.__class__ is int else self.encode(key))
+        if not found:
+            raise KeyError(key)
+        self._states[slot] = DELETED
+        self.count -= 1
+        self.tombstones += 1
+
+    def pop(self, key, default=None):
+        key = key if key.__class__ is int else self.encode(key)
+        slot, found = self._find(key)
+        if not found:
+            return default
+        self._states[slot] = DELETED
+        self.count -= 1
+        self.tombstones += 1
+        return self._values[slot]
+
+    def update(self, items):
+        for key, value in (items.items() if hasattr(items, 'items') else items):
+            self[key] = value
+
+    def clear(self):
+        self.count = 0
+        self.tombstones = 0
+        self._allocate(8)
+
+    def __len__(self):
+        return self.count
+
+    def items(self):
+        states, keys, values = self._states, self._keys, self._values
+        return [(self.decode(keys[slot]), values[slot])
+                for slot in range(self.size) if states[slot] == USED]
+
+    def keys(self):
+        return [self.decode(self._keys[slot]) for slot in range(self.size) if self._states[slot] == USED]
+
+    def values(self):
+        return [self._values[slot] for slot in range(self.size) if self._states[slot] == USED]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, dict(self.items()))
+
+class MacTable(IntTable):
+    """MAC address (48-bit int) -> switch port (32-bit), e.g. one switch's mac_to_port"""
+
+    __slots__ = ()
+
+    KEY_TYPE = 'Q'
+    VALUE_TYPE = 'I'
+
+    def encode(self, key):
+        return mac_to_int(key)
+
+    def decode(self, key):
+        return int_to_mac(key)
+
+class IPv4Table(IntTable):
+    """IPv4 address (32-bit int) -> signed 64-bit value (counters, server indexes)"""
+
+    __slots__ = ()
+
+    KEY_TYPE = 'I'
+    VALUE_TYPE = 'q'
+
+    def encode(self, key):
+        return ip_to_int(key)
+
+    def decode(self, key):
+        return int_to_ip(key)
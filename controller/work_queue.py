@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# Deferred packet-in work: a bounded queue drained by worker green threads
+
+from eventlet import tpool
+from ryu.base import app_manager
+from ryu.ofproto import ofproto_v1_3
+from ryu.lib import hub
+
+class WorkQueue(app_manager.RyuApp):
+    """Run the slow part of packet-in handling after the reply is sent.
+
+    Shared by the apps as a Ryu context. A packet-in handler does the
+    forwarding decision and sends its FlowMod/PacketOut, then submit()s the
+    rest (logging, statistics, accounting). Workers are green threads on the
+    same hub: deferred work runs between OpenFlow messages instead of inside
+    them. Each worker yields after every item, but while an item runs nothing
+    else does, so an item must not block or run long: calls that block in the
+    kernel (e.g. the flock of a shared table) go through run_blocking(), and
+    long loops yield with hub.sleep(0) every so often.
+
+    The queue holds at most maxsize items. When it is full:
+    - sheddable work (logs, statistics, analytics) is dropped and counted,
+      oldest first with shed_policy 'oldest', the new item with 'newest';
+    - work that must not be lost (shed=False, e.g. DoS accounting) runs
+      inline on the hub. This is the back-pressure: the handler slows down,
+      Ryu stops reading from the switches meanwhile and TCP flow control
+      pushes back on them.
+    """
+
+    OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
+
+    def __init__(self, *args, **kwargs):
+        super(WorkQueue, self).__init__(*args, **kwargs)
+        self.maxsize = 10000
+        self.workers = 4
+        self.shed_policy = 'oldest'   # or 'newest'
+        self.report_interval = 10     # seconds
+        self.queue = hub.Queue()      # bounded by submit(); items are (fn, args, shed)
+        self.stats = {'submitted': 0, 'completed': 0, 'shed': 0, 'inline': 0,
+                      'errors': 0, 'max_depth': 0, 'blocking': 0}
+        self._reported = (0, 0)
+        self.threads = [hub.spawn(self._worker) for _ in range(self.workers)]
+        self.threads.append(hub.spawn(self._report_loop))
+
+    def submit(self, fn, *args, shed=True):
+        """Run fn(*args) later on a worker; returns False if the work was shed"""
+        self.stats['submitted'] += 1
+        if self.queue.qsize() >= self.maxsize:
+            if not shed:
+                self._run(fn, args)
+                self.stats['inline'] += 1
+                return True
+            if self.shed_policy == 'newest':
+                self.stats['shed'] += 1
+                return False
+            self._make_room()
+        self.queue.put((fn, args, shed))
+        self.stats['max_depth'] = max(self.stats['max_depth'], self.queue.qsize())
+        return True
+
+    def run_blocking(self, fn, *args):
+        """fn(*args) in a native thread (eventlet.tpool); only the calling green
+        thread waits for it. fn must not touch Ryu or eventlet objects."""
+        self.stats['blocking'] += 1
+        return tpool.execute(fn, *args)
+
+    def log(self, log_fn, fmt, *args):
+        """Defer a log call, e.g. log(self.logger.info, "...", a, b); always sheddable"""
+        return self.submit(log_fn, fmt, *args)
+
+    def _make_room(self):
+        # Drop the oldest sheddable item; items that must run are run now
+        while self.queue.qsize() >= self.maxsize:
+            fn, args, shed = self.queue.get_nowait()
+            if shed:
+                self.stats['shed'] += 1
+                return
+            self._run(fn, args)
+            self.stats['inline'] += 1
+
+    def _run(self, fn, args):
+        try:
+            fn(*args)
+        except Exception:
+            self.stats['errors'] += 1
+            self.logger.exception("Deferred packet-in work failed: %r", fn)
+
+    def _worker(self):
+        while True:
+            fn, args, _ = self.queue.get()
+            self._run(fn, args)
+            self.stats['completed'] += 1
+            hub.sleep(0)
+
+    def _report_loop(self):
+        while True:
+            hub.sleep(self.report_interval)
+            shed = self.stats['shed'] - self._reported[0]
+            inline = self.stats['inline'] - self._reported[1]
+            self._reported = (self.stats['shed'], self.stats['inline'])
+            if shed or inline:
+                self.logger.warning("Packet-in work queue full (%d/%d): shed %d items, ran %d inline "
+                                    "in the last %ds", self.queue.qsize(), self.maxsize, shed, inline,
+                                    self.report_interval)
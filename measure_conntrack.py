@@ -0,0 +1,53 @@
+# Measure memory and update rate of the firewall's connection tracking table
+import csv
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'controller'))
+from conntrack import ConnTrack, TCP_SYN, TCP_ACK
+
+def client_ip(i):
+    return f"10.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}"
+
+def measure(num_connections):
+    """Open num_connections TCP connections through a full handshake"""
+    clients = [client_ip(i) for i in range(num_connections)]
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    table = ConnTrack()
+    start = time.time()
+    for i, ip in enumerate(clients):
+        sport = 1024 + i % 60000
+        table.update(ip, '10.0.0.2', sport, 80, TCP_SYN)
+        table.update('10.0.0.2', ip, 80, sport, TCP_SYN | TCP_ACK)
+        table.update(ip, '10.0.0.2', sport, 80, TCP_ACK)
+    elapsed = time.time() - start
+    traced = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    return {
+        'connections': len(table),
+        'table_bytes_per_conn': table.memory_bytes() / len(table),
+        'traced_bytes_per_conn': traced / len(table),
+        'updates_per_sec': 3 * num_connections / elapsed,
+    }
+
+results = []
+for size in [10000, 100000, 1000000]:
+    print(f"Tracking {size} connections")
+    results.append(measure(size))
+
+with open('conntrack_results.csv', 'w', newline='') as csvfile:
+    fieldnames = ['connections', 'table_bytes_per_conn', 'traced_bytes_per_conn', 'updates_per_sec']
+    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+    writer.writeheader()
+    for result in results:
+        writer.writerow(result)
+
+for r in results:
+    print(f"{r['connections']:>8} connections: {r['table_bytes_per_conn']:.1f} B/conn (table), "
+          f"{r['traced_bytes_per_conn']:.1f} B/conn (traced), {r['updates_per_sec']:.0f} updates/s")
+print("Results saved to conntrack_results.csv")
@@ -0,0 +1,108 @@
+# Simulate load-balancer backend selection with heterogeneous backend capacities
+import collections
+import csv
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'controller'))
+from backend_load import BackendLoadTracker
+
+# Backends are FIFO servers; capacities are in units of work per second.
+# Policies either run with the VNF's default weights (all 1) or with weights
+# set to the backend capacities by the operator.
+CAPACITIES = [1.0, 1.0, 2.0, 4.0]
+UTILISATION = 0.85
+NUM_REQUESTS = 200000
+STATS_INTERVAL = 0.5  # seconds between (simulated) port/flow stats replies
+SEED = 42
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+def simulate(algorithm, two_choices, weights, seed=SEED):
+    """Return per-request latencies for one selection policy"""
+    rng = random.Random(seed)
+    pick_rng = random.Random(seed + 1)
+    n = len(CAPACITIES)
+    tracker = BackendLoadTracker(n)
+    arrival_rate = UTILISATION * sum(CAPACITIES)
+
+    in_system = [collections.deque() for _ in range(n)]  # (completion_time, work)
+    free_at = [0.0] * n
+    sent_work = [0.0] * n  # what the switch port facing the backend counts as tx_bytes
+    polled_work = [0.0] * n
+    latencies = []
+    now = 0.0
+    next_poll = STATS_INTERVAL
+
+    for _ in range(NUM_REQUESTS):
+        now += rng.expovariate(arrival_rate)
+        work = rng.expovariate(1.0)
+
+        # Deliver every stats reply that would have arrived before this request
+        while next_poll <= now:
+            counts = []
+            for i in range(n):
+                queue = in_system[i]
+                while queue and queue[0][0] <= next_poll:
+                    queue.popleft()
+                counts.append(len(queue))
+            tracker.update_flow_counts(counts)
+            tracker.update_bytes([int((sent - polled) * 1000) for sent, polled in zip(sent_work, polled_work)],
+                                 weights)
+            polled_work = list(sent_work)
+            next_poll += STATS_INTERVAL
+
+        if algorithm == 'weighted_random':
+            i = pick_rng.choices(range(n), weights)[0]
+        else:
+            i = tracker.choose(list(range(n)), weights, two_choices, pick_rng, algorithm)
+        sent_work[i] += work
+
+        start = max(now, free_at[i])
+        free_at[i] = start + work / CAPACITIES[i]
+        in_system[i].append((free_at[i], work))
+        latencies.append(free_at[i] - now)
+
+    return latencies
+
+EQUAL = [1] * len(CAPACITIES)
+
+policies = [
+    ('weighted_random', False, EQUAL),
+    ('weighted_random', False, CAPACITIES),
+    ('least_connections', False, EQUAL),
+    ('least_connections', True, EQUAL),
+    ('least_connections', True, CAPACITIES),
+    ('least_bandwidth', False, CAPACITIES),
+    ('least_bandwidth', True, CAPACITIES),
+]
+
+results = []
+for algorithm, two_choices, weights in policies:
+    name = algorithm
+    if algorithm != 'weighted_random':
+        name += ' (power of two)' if two_choices else ' (full scan)'
+    name += ', capacity weights' if weights is CAPACITIES else ', equal weights'
+    print(f"Simulating {name}")
+    latencies = simulate(algorithm, two_choices, weights)
+    results.append({
+        'policy': name,
+        'mean_latency': sum(latencies) / len(latencies),
+        'p50_latency': percentile(latencies, 50),
+        'p99_latency': percentile(latencies, 99),
+    })
+
+with open('lb_selection_results.csv', 'w', newline='') as csvfile:
+    fieldnames = ['policy', 'mean_latency', 'p50_latency', 'p99_latency']
+    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+    writer.writeheader()
+    for result in results:
+        writer.writerow(result)
+
+print(f"\n{'Policy':55} {'mean':>8} {'p50':>8} {'p99':>8}")
+for r in results:
+    print(f"{r['policy']:55} {r['mean_latency']:8.2f} {r['p50_latency']:8.2f} {r['p99_latency']:8.2f}")
+print("\nLatencies in units of mean request work. Results saved to lb_selection_results.csv")
@@ -0,0 +1,179 @@
+# Measure controller scaling with parallel ns-3 OFSwitch13 simulations
+#
+# Runs a sweep of ns3/topology.cc scenarios (hosts, switches, link rates,
+# traffic mix) as independent simulations, by default one per two cores: each
+# run is a simulator and a ryu-manager busy at the same time, and CPU and
+# latency are only comparable across runs when they do not compete for cores.
+# Every run gets its own ryu-manager (own OpenFlow port, own snapshot
+# directory), TAP device and controller subnet, so runs do not see each
+# other. The controller's CPU and peak memory are sampled with psutil while
+# the simulation runs; flow setup time (first ping reply) and latency (later
+# replies) come from the RESULT line the scenario prints.
+#
+# Results go to the same files and columns as the Mininet measurements
+# (overhead_results.csv: switches,hosts,cpu_percent,memory_mb,flow_setup_time;
+# latency_results.csv: scenario,latency), prefixed ns3_, plus every metric per
+# run in ns3_sweep_results.csv.
+#
+# Needs ns-3.38 with OFSwitch13 built with --enable-sudo (the TAP helper is
+# then setuid, so runs need no root) and topology.cc in its scratch/ folder.
+import argparse
+import csv
+import itertools
+import os
+import queue
+import socket
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import psutil
+
+NS3_DIR = os.environ.get('NS3_DIR', os.path.expanduser('~/workspace/bake/source/ns-3.38'))
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+# Controller setups and the first ping flow's target, as in measure_latency.py
+CONTROLLER_APPS = {
+    'basic': ['controller/sdn_controller.py'],
+    'firewall': ['controller/sdn_controller.py', 'controller/firewall_vnf.py'],
+    'loadbalancer': ['controller/sdn_controller.py', 'controller/load_balancer_vnf.py'],
+    'both': ['controller/sdn_controller.py', 'controller/firewall_vnf.py',
+             'controller/load_balancer_vnf.py'],
+}
+DESTINATIONS = {'basic': '10.0.0.3', 'firewall': '10.0.0.3',
+                'loadbalancer': '10.0.0.100', 'both': '10.0.0.100'}
+BASE_PORT = 16653
+
+# Default sweep: the Mininet network sizes, under the four controller setups
+SWEEP = {
+    'controller': ['basic', 'firewall', 'loadbalancer', 'both'],
+    'size': [(1, 3), (3, 9), (5, 15), (10, 30)],   # (switches, hosts)
+    'host_rate': ['100Mbps'],
+    'traffic': [{'pings': 10, 'tcpFlows': 0, 'udpFlows': 0}],
+}
+
+def scenarios(sweep, duration, seeds):
+    for controller, (switches, hosts), rate, traffic, seed in itertools.product(
+            sweep['controller'], sweep['size'], sweep['host_rate'], sweep['traffic'], seeds):
+        yield {'controller': controller, 'switches': switches, 'hosts': hosts,
+               'hostRate': rate, 'duration': duration, 'seed': seed,
+               'destination': DESTINATIONS[controller], **traffic}
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with socket.socket() as s:
+            if s.connect_ex(('127.0.0.1', port)) == 0:
+                return True
+        time.sleep(0.2)
+    return False
+
+def parse_result(output):
+    for line in output.splitlines():
+        if line.startswith('RESULT '):
+            return {key: float(value) for key, value in
+                    (field.split('=', 1) for field in line.split()[1:])}
+    return None
+
+def run_scenario(scenario, slot, ns3_dir):
+    """Run one simulation with its own controller; returns the scenario with its metrics"""
+    port = BASE_PORT + slot
+    state_dir = tempfile.mkdtemp(prefix='sdn_ns3_%d_' % slot)
+    env = dict(os.environ, SDN_SNAPSHOT_DIR=state_dir)
+    log = open(os.path.join(state_dir, 'controller.log'), 'w')
+    controller = subprocess.Popen(['ryu-manager', '--ofp-tcp-listen-port', str(port)] +
+                                  CONTROLLER_APPS[scenario['controller']],
+                                  stdout=log, stderr=subprocess.STDOUT, env=env, cwd=REPO_DIR)
+    result = dict(scenario, error='')
+    try:
+        if not wait_for_port(port):
+            result['error'] = 'controller did not start'
+            return result
+        args = ['--%s=%s' % (key, value) for key, value in scenario.items() if key != 'controller']
+        args += ['--ctrlPort=%d' % port, '--ctrlNetwork=10.100.%d.0' % slot,
+                 '--tapName=ctrl%d' % slot, '--verbose=0']
+        sim = subprocess.Popen(['./ns3', 'run', '--no-build', 'scratch/topology ' + ' '.join(args)],
+                               cwd=ns3_dir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+
+        # Sample the controller while the simulation runs
+        proc = psutil.Process(controller.pid)
+        cpu_start, wall_start = sum(proc.cpu_times()[:2]), time.time()
+        peak_rss = 0
+        while sim.poll() is None:
+            peak_rss = max(peak_rss, proc.memory_info().rss)
+            time.sleep(0.5)
+        output = sim.stdout.read()
+        elapsed = time.time() - wall_start
+        cpu = sum(proc.cpu_times()[:2]) - cpu_start
+
+        metrics = parse_result(output)
+        if metrics is None:
+            result['error'] = 'no RESULT line (exit code %s)' % sim.returncode
+            return result
+        result.update(metrics)
+        result.update(cpu_percent=100.0 * cpu / elapsed, memory_mb=peak_rss / 1024 / 1024,
+                      flow_setup_time=metrics['first_rtt_ms'], latency=metrics['rtt_ms'],
+                      ping_loss=1 - metrics['ping_received'] / max(metrics['ping_sent'], 1))
+        return result
+    finally:
+        controller.terminate()
+        controller.wait()
+        log.close()
+
+def run_sweep(all_scenarios, jobs, ns3_dir):
+    slots = queue.Queue()
+    for slot in range(jobs):
+        slots.put(slot)
+
+    def run(scenario):
+        slot = slots.get()
+        try:
+            result = run_scenario(scenario, slot, ns3_dir)
+        finally:
+            slots.put(slot)
+        print(f"{scenario['controller']}: {scenario['switches']} switches, {scenario['hosts']} hosts -> "
+              + (result['error'] or f"setup {result['flow_setup_time']:.1f} ms, "
+                                    f"CPU {result['cpu_percent']:.1f}%"))
+        return result
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(run, all_scenarios))
+
+def write_csv(path, fieldnames, rows):
+    with open(path, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames, extrasaction='ignore')
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--ns3-dir', default=NS3_DIR)
+    parser.add_argument('--jobs', type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help='simulations run in parallel, each a simulator and a controller '
+                             '(default: cores / 2, max 254)')
+    parser.add_argument('--duration', type=float, default=20.0, help='simulated seconds per run')
+    parser.add_argument('--seeds', type=int, default=1, help='repetitions with different host pairs')
+    options = parser.parse_args()
+
+    subprocess.run(['./ns3', 'build', 'scratch/topology'], cwd=options.ns3_dir, check=True)
+    results = run_sweep(list(scenarios(SWEEP, options.duration, range(1, options.seeds + 1))),
+                        min(options.jobs, 254), options.ns3_dir)
+    ok = [r for r in results if not r['error']]
+
+    write_csv('ns3_sweep_results.csv',
+              ['controller', 'switches', 'hosts', 'hostRate', 'pings', 'tcpFlows', 'udpFlows',
+               'duration', 'seed', 'cpu_percent', 'memory_mb', 'flow_setup_time', 'latency',
+               'ping_loss', 'tcp_rx_bytes', 'udp_rx_bytes', 'error'], results)
+    # Mininet formats: overhead for the full controller, latency per controller setup
+    write_csv('ns3_overhead_results.csv',
+              ['switches', 'hosts', 'cpu_percent', 'memory_mb', 'flow_setup_time'],
+              [r for r in ok if r['controller'] == 'both'])
+    names = {'basic': 'Direct Forwarding (no VNFs)', 'firewall': 'With Firewall VNF',
+             'loadbalancer': 'With Load Balancer VNF', 'both': 'With Both VNFs'}
+    write_csv('ns3_latency_results.csv', ['scenario', 'latency'],
+              [{'scenario': names[r['controller']], 'latency': r['latency']}
+               for r in ok if (r['switches'], r['hosts']) == SWEEP['size'][0]])
+
+    print("NS-3 sweep completed. Results saved to ns3_overhead_results.csv, "
+          "ns3_latency_results.csv and ns3_sweep_results.csv")
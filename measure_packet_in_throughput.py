@@ -0,0 +1,185 @@
+# Measure controller packet-in throughput with a local OpenFlow 1.3 load generator
+#
+# Emulated switches connect to the (sharded) controller, complete the OpenFlow
+# handshake and then keep a window of PACKET_INs outstanding. Each PACKET_IN
+# carries a UDP frame to an unknown unicast MAC, so every app answers it with
+# exactly one PACKET_OUT (flood) and no FlowMods - the number of PACKET_OUTs
+# per PACKET_IN is measured up front and used to count completed packet-ins.
+import csv
+import multiprocessing
+import os
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'controller'))
+import sharding
+
+OFP_VERSION = 0x04
+OFPT_HELLO, OFPT_ECHO_REQUEST, OFPT_ECHO_REPLY = 0, 2, 3
+OFPT_FEATURES_REQUEST, OFPT_FEATURES_REPLY = 5, 6
+OFPT_GET_CONFIG_REQUEST, OFPT_GET_CONFIG_REPLY = 7, 8
+OFPT_PACKET_IN, OFPT_PACKET_OUT = 10, 13
+OFPT_MULTIPART_REQUEST, OFPT_MULTIPART_REPLY = 18, 19
+OFPT_BARRIER_REQUEST, OFPT_BARRIER_REPLY = 20, 21
+
+HEADER = struct.Struct('!BBHI')
+BASE_PORT = 16653
+DURATION = 10       # seconds of measurement per configuration
+WINDOW = 64         # outstanding packet-ins per emulated switch
+SWITCHES = 16       # emulated switches (spread over the workers by dpid)
+
+def message(msg_type, xid, body=b''):
+    return HEADER.pack(OFP_VERSION, msg_type, HEADER.size + len(body), xid) + body
+
+def ip_checksum(header):
+    total = sum(struct.unpack('!10H', header))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+def udp_frame(src_host):
+    """Ethernet/IPv4/UDP frame from host src_host to a MAC nobody has learned"""
+    src_mac = struct.pack('!HI', 0x0200, src_host)
+    dst_mac = bytes.fromhex('0e0000000001')
+    payload = b'x' * 18
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + 8 + len(payload), 0, 0, 64, 17, 0,
+                     socket.inet_aton('10.1.%d.%d' % ((src_host >> 8) & 255, src_host & 255)),
+                     socket.inet_aton('10.0.0.250'))
+    ip = ip[:10] + struct.pack('!H', ip_checksum(ip)) + ip[12:]
+    udp = struct.pack('!HHHH', 5001, 5001, 8 + len(payload), 0)
+    return dst_mac + src_mac + struct.pack('!H', 0x0800) + ip + udp + payload
+
+def packet_in(xid, in_port, frame):
+    # ofp_match with a single OXM in_port field, padded to 8 bytes
+    oxm = struct.pack('!II', 0x80000004, in_port)
+    match = struct.pack('!HH', 1, 4 + len(oxm)) + oxm + b'\0' * 4
+    body = struct.pack('!IHBBQ', 0xFFFFFFFF, len(frame), 0, 0, 0) + match + b'\0\0' + frame
+    return message(OFPT_PACKET_IN, xid, body)
+
+class EmulatedSwitch(object):
+    def __init__(self, dpid, port):
+        self.dpid = dpid
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buf = b''
+        self.packet_outs = 0
+        self.sock.sendall(message(OFPT_HELLO, 1))
+
+    def poll(self, timeout):
+        """Read and answer controller messages; returns False on disconnect"""
+        self.sock.settimeout(timeout)
+        try:
+            data = self.sock.recv(65536)
+        except socket.timeout:
+            return True
+        if not data:
+            return False
+        self.buf += data
+        while len(self.buf) >= HEADER.size:
+            _, msg_type, length, xid = HEADER.unpack_from(self.buf)
+            if len(self.buf) < length:
+                break
+            body = self.buf[HEADER.size:length]
+            self.buf = self.buf[length:]
+            self.handle(msg_type, xid, body)
+        return True
+
+    def handle(self, msg_type, xid, body):
+        if msg_type == OFPT_PACKET_OUT:
+            self.packet_outs += 1
+        elif msg_type == OFPT_FEATURES_REQUEST:
+            reply = struct.pack('!QIBBHII', self.dpid, 0, 1, 0, 0, 0x4F, 0)
+            self.sock.sendall(message(OFPT_FEATURES_REPLY, xid, reply))
+        elif msg_type == OFPT_ECHO_REQUEST:
+            self.sock.sendall(message(OFPT_ECHO_REPLY, xid, body))
+        elif msg_type == OFPT_BARRIER_REQUEST:
+            self.sock.sendall(message(OFPT_BARRIER_REPLY, xid))
+        elif msg_type == OFPT_GET_CONFIG_REQUEST:
+            self.sock.sendall(message(OFPT_GET_CONFIG_REPLY, xid, struct.pack('!HH', 0, 0xFFFF)))
+        elif msg_type == OFPT_MULTIPART_REQUEST:
+            # Empty reply of the requested type (port description, flow/port stats)
+            mp_type = struct.unpack_from('!H', body)[0]
+            self.sock.sendall(message(OFPT_MULTIPART_REPLY, xid, struct.pack('!HH4x', mp_type, 0)))
+
+def run_switch(dpid, port, outs_per_packet_in, duration, result_queue):
+    switch = EmulatedSwitch(dpid, port)
+    # Handshake and table setup
+    deadline = time.time() + 3
+    while time.time() < deadline:
+        switch.poll(0.1)
+    switch.packet_outs = 0
+
+    frames = [udp_frame(dpid * 1000 + i) for i in range(256)]
+    sent = 0
+    xid = 100
+    start = time.time()
+    while time.time() - start < duration:
+        completed = switch.packet_outs // outs_per_packet_in
+        while sent - completed < WINDOW:
+            xid += 1
+            switch.sock.sendall(packet_in(xid, 1 + sent % 4, frames[sent % len(frames)]))
+            sent += 1
+        if not switch.poll(0.05):
+            break
+    elapsed = time.time() - start
+    result_queue.put(switch.packet_outs / outs_per_packet_in / elapsed)
+
+def packet_outs_per_packet_in(port):
+    """Calibrate: how many PACKET_OUTs the app stack sends for one PACKET_IN"""
+    switch = EmulatedSwitch(0xCA1, port)
+    deadline = time.time() + 3
+    while time.time() < deadline:
+        switch.poll(0.1)
+    switch.packet_outs = 0
+    switch.sock.sendall(packet_in(7, 1, udp_frame(1)))
+    deadline = time.time() + 2
+    while time.time() < deadline:
+        switch.poll(0.1)
+    switch.sock.close()
+    return max(switch.packet_outs, 1)
+
+def measure(workers):
+    controller = subprocess.Popen([sys.executable, 'controller/run_sharded.py',
+                                   '--workers', str(workers), '--base-port', str(BASE_PORT),
+                                   '--listen-host', '127.0.0.1', '--log-dir', '/tmp/sharded_logs'])
+    time.sleep(5)  # Wait for the workers to start listening
+    try:
+        outs = packet_outs_per_packet_in(sharding.shard_port(0xCA1, workers, BASE_PORT))
+        queue = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=run_switch,
+                                         args=(dpid, sharding.shard_port(dpid, workers, BASE_PORT),
+                                               outs, DURATION, queue))
+                 for dpid in range(1, SWITCHES + 1)]
+        for proc in procs:
+            proc.start()
+        rates = [queue.get(timeout=DURATION + 30) for _ in procs]
+        for proc in procs:
+            proc.join()
+        return sum(rates)
+    finally:
+        controller.terminate()
+        controller.wait()
+        time.sleep(2)
+
+if __name__ == '__main__':
+    results = []
+    worker_counts = [1, 2, 4, 8]
+    worker_counts = [n for n in worker_counts if n <= (os.cpu_count() or 1)]
+    for workers in worker_counts:
+        print(f"Measuring packet-in throughput with {workers} worker(s)")
+        rate = measure(workers)
+        results.append({'workers': workers, 'packet_ins_per_sec': rate,
+                        'speedup': rate / results[0]['packet_ins_per_sec'] if results else 1.0})
+        print(f"  {rate:.0f} packet-ins/s")
+
+    with open('packet_in_throughput_results.csv', 'w', newline='') as csvfile:
+        fieldnames = ['workers', 'packet_ins_per_sec', 'speedup']
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer.writeheader()
+        for result in results:
+            writer.writerow(result)
+
+    print("Throughput testing completed. Results saved to packet_in_throughput_results.csv")
@@ -0,0 +1,189 @@
+# Measure time to steady state after a controller restart (cold vs warm)
+#
+# An emulated switch keeps its flow table across the restart, as a real switch
+# in fail-secure mode does. The controller is killed (no clean shutdown, so
+# only the periodic snapshot survives) and started again, either with its
+# snapshots (warm) or without them (cold). After reconnecting, every emulated
+# host sends one packet per round to its neighbour; steady state is the first
+# round in which no packet has to be flooded because of forgotten MACs.
+import csv
+import os
+import shutil
+import signal
+import struct
+import subprocess
+import time
+
+from measure_packet_in_throughput import (EmulatedSwitch, message, packet_in,
+                                          OFPT_MULTIPART_REPLY, OFPT_MULTIPART_REQUEST,
+                                          OFPT_PACKET_OUT)
+
+OFPT_FLOW_MOD = 14
+OFPMP_FLOW = 1
+OFPP_FLOOD = 0xFFFFFFFB
+FLOW_MOD = struct.Struct('!QQBBHHHIIIH2x')
+FLOW_STATS = struct.Struct('!HBxIIHHHH4xQQQ')
+
+PORT = 16700
+HOSTS = 20
+SNAPSHOT_DIR = '/tmp/sdn_restart_snapshots'
+SNAPSHOT_INTERVAL_WAIT = 12  # controller snapshots every 10 seconds
+APPS = ['controller/sdn_controller.py', 'controller/firewall_vnf.py', 'controller/load_balancer_vnf.py']
+
+def host_frame(src, dst):
+    """Ethernet/IPv4/UDP frame between two emulated hosts"""
+    src_mac = struct.pack('!HI', 0x0200, src)
+    dst_mac = struct.pack('!HI', 0x0200, dst)
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 36, 0, 0, 64, 17, 0,
+                     bytes([10, 2, 0, src]), bytes([10, 2, 0, dst]))
+    udp = struct.pack('!HHHH', 5001, 5001, 16, 0)
+    return dst_mac + src_mac + struct.pack('!H', 0x0800) + ip + udp + b'y' * 8
+
+class FlowTableSwitch(EmulatedSwitch):
+    """Emulated switch that stores FlowMods and answers flow stats from them"""
+
+    def __init__(self, dpid, port, flows=None):
+        self.flows = flows if flows is not None else {}  # (priority, match) -> (idle, hard, cookie, insts)
+        self.flow_mods = 0
+        self.floods = 0
+        super(FlowTableSwitch, self).__init__(dpid, port)
+
+    def handle(self, msg_type, xid, body):
+        if msg_type == OFPT_FLOW_MOD:
+            self.flow_mods += 1
+            self.store_flow_mod(body)
+        elif msg_type == OFPT_PACKET_OUT:
+            # buffer_id, in_port, actions_len, pad; then the first action
+            if len(body) >= 24 and struct.unpack_from('!HHI', body, 16)[2] == OFPP_FLOOD:
+                self.floods += 1
+            super(FlowTableSwitch, self).handle(msg_type, xid, body)
+        elif msg_type == OFPT_MULTIPART_REQUEST and struct.unpack_from('!H', body)[0] == OFPMP_FLOW:
+            self.send_flow_stats(xid)
+        else:
+            super(FlowTableSwitch, self).handle(msg_type, xid, body)
+
+    def store_flow_mod(self, body):
+        cookie, _, _, command, idle, hard, priority = FLOW_MOD.unpack_from(body)[:7]
+        match_len = struct.unpack_from('!H', body, FLOW_MOD.size + 2)[0]
+        match_end = FLOW_MOD.size + (match_len + 7) // 8 * 8
+        match = body[FLOW_MOD.size:match_end]
+        if command in (0, 1, 2):      # add / modify
+            self.flows[(priority, match)] = (idle, hard, cookie, body[match_end:])
+        elif command == 4:            # delete strict
+            self.flows.pop((priority, match), None)
+        elif command == 3:            # delete (only "everything" and exact matches)
+            if match_len <= 4:
+                self.flows.clear()
+            for key in [k for k in self.flows if k[1] == match]:
+                del self.flows[key]
+
+    def send_flow_stats(self, xid):
+        entries = []
+        for (priority, match), (idle, hard, cookie, insts) in self.flows.items():
+            length = FLOW_STATS.size + len(match) + len(insts)
+            entries.append(FLOW_STATS.pack(length, 0, 1, 0, priority, idle, hard, 0, cookie, 0, 0) +
+                           match + insts)
+        # Split into messages that fit the 16-bit OpenFlow length
+        chunks, chunk = [], b''
+        for entry in entries:
+            if len(chunk) + len(entry) > 60000:
+                chunks.append(chunk)
+                chunk = b''
+            chunk += entry
+        chunks.append(chunk)
+        for i, chunk in enumerate(chunks):
+            more = 1 if i < len(chunks) - 1 else 0
+            body = struct.pack('!HH4x', OFPMP_FLOW, more) + chunk
+            self.sock.sendall(message(OFPT_MULTIPART_REPLY, xid, body))
+
+def settle(switch, quiet=0.3, limit=5.0):
+    """Answer controller messages until it has been quiet for a while"""
+    deadline = time.time() + limit
+    while time.time() < deadline:
+        before = (switch.flow_mods, switch.packet_outs)
+        switch.poll(quiet)
+        if (switch.flow_mods, switch.packet_outs) == before:
+            return
+
+def send_round(switch):
+    """Every host sends one packet to its neighbour; returns flooded packet-outs"""
+    floods = switch.floods
+    for host in range(1, HOSTS + 1):
+        dst = host % HOSTS + 1
+        switch.sock.sendall(packet_in(1000 + host, host, host_frame(host, dst)))
+    settle(switch)
+    return switch.floods - floods
+
+def start_controller():
+    env = dict(os.environ, SDN_SNAPSHOT_DIR=SNAPSHOT_DIR)
+    return subprocess.Popen(['ryu-manager', '--ofp-listen-host=127.0.0.1',
+                             '--ofp-tcp-listen-port=%d' % PORT] + APPS,
+                            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def connect(flows):
+    """Connect the emulated switch once the controller listens"""
+    while True:
+        try:
+            return FlowTableSwitch(1, PORT, flows)
+        except OSError:
+            time.sleep(0.05)
+
+def measure(warm):
+    shutil.rmtree(SNAPSHOT_DIR, ignore_errors=True)
+
+    # Bring the network to steady state and let the controller snapshot it
+    controller = start_controller()
+    switch = connect(None)
+    settle(switch, limit=5)
+    send_round(switch)
+    send_round(switch)
+    time.sleep(SNAPSHOT_INTERVAL_WAIT)
+    flows = switch.flows
+    switch.sock.close()
+    controller.send_signal(signal.SIGKILL)
+    controller.wait()
+
+    if not warm:
+        shutil.rmtree(SNAPSHOT_DIR, ignore_errors=True)
+
+    # Restart and measure
+    start = time.time()
+    controller = start_controller()
+    switch = connect(flows)
+    settle(switch, limit=5)
+    proactive_flow_mods = switch.flow_mods
+    rounds = 0
+    while rounds < 10:
+        rounds += 1
+        if send_round(switch) == 0:
+            break
+    elapsed = time.time() - start
+    result = {
+        'restart': 'warm' if warm else 'cold',
+        'time_to_steady_state_s': elapsed,
+        'rounds_to_steady_state': rounds,
+        'proactive_flow_mods': proactive_flow_mods,
+        'total_flow_mods': switch.flow_mods,
+        'packet_ins': rounds * HOSTS,
+    }
+    switch.sock.close()
+    controller.terminate()
+    controller.wait()
+    return result
+
+if __name__ == '__main__':
+    results = []
+    for warm in (False, True):
+        print(f"Measuring {'warm' if warm else 'cold'} restart")
+        results.append(measure(warm))
+        print(f"  {results[-1]}")
+
+    with open('restart_results.csv', 'w', newline='') as csvfile:
+        fieldnames = ['restart', 'time_to_steady_state_s', 'rounds_to_steady_state',
+                      'proactive_flow_mods', 'total_flow_mods', 'packet_ins']
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer.writeheader()
+        for result in results:
+            writer.writerow(result)
+
+    print("Restart testing completed. Results saved to restart_results.csv")
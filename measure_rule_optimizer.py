@@ -0,0 +1,154 @@
+# Measure firewall rule-set optimization: reduction and running time
+#
+# Random policies of growing size mix block rules on prefixes and port ranges
+# with some allow exceptions, plus the overlaps large policies accumulate:
+# duplicated rules, rules inside broader ones, subnets split into sibling
+# halves and ranges split into adjacent pieces. The optimized rule set is
+# checked against the original on random packets (same first-match outcome)
+# and the time per rule shows whether the pass stays near-linear. A second
+# family of policies has no addresses at all, only destination MACs and
+# ports (per-host service blocks), which all land in the index's wildcard
+# bucket.
+import csv
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'controller'))
+from rule_classifier import RuleClassifier, int_to_ip, parse_prefix, prefix_mask
+from rule_optimizer import optimize_rules
+from state_table import int_to_mac
+
+RULE_COUNTS = [1000, 10000, 100000]
+CHECKED_PACKETS = 20000
+
+def random_prefix(rng, lengths=(16, 20, 24, 24, 28, 32, 32)):
+    length = rng.choice(lengths)
+    return '%s/%d' % (int_to_ip(rng.getrandbits(32) & prefix_mask(length)), length)
+
+def random_rule(rng, i):
+    rule = {'name': 'rule-%d' % i, 'action': 'allow' if rng.random() < 0.05 else 'block'}
+    if rng.random() < 0.7:
+        rule['src_ip'] = random_prefix(rng)
+    if rng.random() < 0.5 or 'src_ip' not in rule:
+        rule['dst_ip'] = random_prefix(rng)
+    if rng.random() < 0.4:
+        low = rng.randrange(1, 60000)
+        rule[rng.choice(['tcp_dst_port', 'udp_dst_port'])] = (low, low + rng.randrange(0, 2000))
+    return rule
+
+def overlapping_rule(rng, rule, i):
+    """A rule overlapping an existing one the way policies accumulate them"""
+    new = dict(rule, name='rule-%d' % i)
+    kind = rng.randrange(4)
+    if kind == 0:
+        return new                                        # duplicate
+    key = 'src_ip' if 'src_ip' in rule else 'dst_ip'
+    net, length = parse_prefix(rule[key])
+    if kind == 1 and length < 32:                         # inside the original
+        host = rng.getrandbits(32) & ~prefix_mask(length) & 0xFFFFFFFF
+        new[key] = int_to_ip(net | host)
+    elif kind == 2 and length < 32:                       # sibling half
+        new[key] = '%s/%d' % (int_to_ip(net ^ (1 << (32 - length))), length)
+    else:                                                 # adjacent port range
+        for port_key in ('tcp_dst_port', 'udp_dst_port'):
+            if port_key in rule and rule[port_key][1] < 65000:
+                high = rule[port_key][1]
+                new[port_key] = (high + 1, high + 1 + rng.randrange(0, 500))
+    return new
+
+def random_policy(count, rng):
+    rules = []
+    for i in range(count):
+        if rules and rng.random() < 0.4:
+            rules.append(overlapping_rule(rng, rng.choice(rules[-200:]), i))
+        else:
+            rules.append(random_rule(rng, i))
+    return rules
+
+def mac_port_policy(count, rng):
+    hosts = [int_to_mac(0x020000000000 + i) for i in range(max(count // 20, 1))]
+    rules = []
+    for i in range(count):
+        rule = {'name': 'rule-%d' % i, 'dst_mac': rng.choice(hosts),
+                'action': 'allow' if rng.random() < 0.05 else 'block'}
+        kind = rng.randrange(4)
+        if kind < 2:
+            rule[rng.choice(['tcp_dst_port', 'udp_dst_port'])] = rng.randrange(1, 1024)
+        elif kind == 2:
+            low = rng.randrange(1024, 60000)
+            rule['tcp_dst_port'] = (low, low + rng.randrange(0, 100))
+        else:
+            rule['src_mac'] = rng.choice(hosts)
+        rules.append(rule)
+    return rules
+
+POLICIES = {'prefix': random_policy, 'mac_port': mac_port_policy}
+
+def random_packet(rules, rng):
+    src, dst = rng.getrandbits(32), rng.getrandbits(32)
+    rule = rng.choice(rules)
+    for key in ('src_ip', 'dst_ip'):
+        if key in rule:
+            net, length = parse_prefix(rule[key])
+            addr = net | (rng.getrandbits(32) & ~prefix_mask(length) & 0xFFFFFFFF)
+            if key == 'src_ip':
+                src = addr
+            else:
+                dst = addr
+    port = rng.randrange(1, 65536)
+    for key in ('tcp_dst_port', 'udp_dst_port'):
+        if key in rule and rng.random() < 0.8:
+            port = rule[key] if isinstance(rule[key], int) else rng.randint(*rule[key])
+    return (rule.get('src_mac', '00:00:00:00:00:01'), rule.get('dst_mac', '00:00:00:00:00:02'),
+            int_to_ip(src), int_to_ip(dst), rng.choice([6, 17]), rng.randrange(1024, 65536), port)
+
+def outcome(classifier, packet):
+    rule = classifier.classify(*packet)
+    return rule['action'] if rule else 'allow'
+
+def measure(policy, count, rng):
+    rules = POLICIES[policy](count, rng)
+    start = time.perf_counter()
+    optimized, report = optimize_rules(rules)
+    elapsed = time.perf_counter() - start
+
+    original, reduced = RuleClassifier(rules), RuleClassifier(optimized)
+    for _ in range(CHECKED_PACKETS):
+        packet = random_packet(rules, rng)
+        assert outcome(original, packet) == outcome(reduced, packet), packet
+
+    return {
+        'policy': policy,
+        'rules': count,
+        'rules_out': report['rules_out'],
+        'shadowed': len(report['shadowed']),
+        'redundant': len(report['redundant']),
+        'merged': report['merged'],
+        'flows_in': report['flows_in'],
+        'flows_out': report['flows_out'],
+        'flow_reduction': 1 - report['flows_out'] / report['flows_in'],
+        'time_s': elapsed,
+        'us_per_rule': elapsed / count * 1e6,
+    }
+
+if __name__ == '__main__':
+    rng = random.Random(1)
+    results = []
+    for policy in POLICIES:
+        for count in RULE_COUNTS:
+            print(f"Optimizing {count} rules ({policy} policy)")
+            results.append(measure(policy, count, rng))
+            print(f"  {results[-1]['rules_out']} rules, {results[-1]['flows_in']} -> "
+                  f"{results[-1]['flows_out']} flow entries in {results[-1]['time_s']:.2f} s")
+
+    with open('rule_optimizer_results.csv', 'w', newline='') as csvfile:
+        fieldnames = ['policy', 'rules', 'rules_out', 'shadowed', 'redundant', 'merged', 'flows_in',
+                      'flows_out', 'flow_reduction', 'time_s', 'us_per_rule']
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer.writeheader()
+        for result in results:
+            writer.writerow(result)
+
+    print("Optimizer testing completed. Results saved to rule_optimizer_results.csv")
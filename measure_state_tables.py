@@ -0,0 +1,104 @@
+# Measure controller state memory: string-keyed dicts vs compact state tables
+#
+# Fills the two kinds of table the apps keep with 1M entries each: a switch's
+# mac_to_port (MAC text -> port) and an IPv4-keyed table like
+# connection_track / client_to_server (address text -> counter). The dicts
+# are built the way the apps used to build them; the tables are
+# state_table.MacTable / IPv4Table. Memory is what tracemalloc sees
+# allocated while the table is filled, so it includes the key strings a dict
+# keeps alive. Lookup time (text keys, and int keys for the tables) and
+# snapshot (pickle) size are reported as well.
+import csv
+import os
+import pickle
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'controller'))
+from state_table import IPv4Table, MacTable, int_to_mac, mac_to_int
+from rule_classifier import int_to_ip, ip_to_int
+
+ENTRIES = 1000000
+LOOKUPS = 200000
+
+KINDS = {
+    # name: (table class, key text from an int, int from key text, value for entry i)
+    'mac_to_port': (MacTable, int_to_mac, mac_to_int, lambda i: 1 + i % 48),
+    'ipv4_counter': (IPv4Table, int_to_ip, ip_to_int, lambda i: 1 + i % 100),
+}
+
+def fill(table, keys, to_text, value):
+    for i, key in enumerate(keys):
+        table[to_text(key)] = value(i)
+    return table
+
+def measure_memory(make, keys, to_text, value):
+    tracemalloc.start()
+    table = fill(make(), keys, to_text, value)
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return table, allocated
+
+def lookup_ns(table, keys):
+    get = table.get
+    start = time.perf_counter()
+    for key in keys:
+        get(key)
+    return (time.perf_counter() - start) / len(keys) * 1e9
+
+def measure(kind, rng):
+    cls, to_text, to_int, value = KINDS[kind]
+    bits = 48 if cls is MacTable else 32
+    keys = rng.sample(range(1 << bits), ENTRIES) if bits == 32 else \
+        [rng.getrandbits(48) for _ in range(ENTRIES)]
+
+    plain, dict_bytes = measure_memory(dict, keys, to_text, value)
+    compact, table_bytes = measure_memory(cls, keys, to_text, value)
+    assert len(compact) == len(plain)
+
+    probe = rng.sample(keys, LOOKUPS)
+    text_probe = [to_text(key) for key in probe]
+    for key in text_probe[:1000]:
+        assert compact[key] == plain[key]
+    assert all(to_int(key) == k for key, k in zip(text_probe[:1000], probe))
+
+    return {
+        'table': kind,
+        'entries': ENTRIES,
+        'dict_mb': dict_bytes / 1e6,
+        'table_mb': table_bytes / 1e6,
+        'dict_bytes_per_entry': dict_bytes / ENTRIES,
+        'table_bytes_per_entry': table_bytes / ENTRIES,
+        'memory_reduction': 1 - table_bytes / dict_bytes,
+        'dict_lookup_ns': lookup_ns(plain, text_probe),
+        'table_lookup_ns': lookup_ns(compact, text_probe),
+        'table_int_lookup_ns': lookup_ns(compact, probe),
+        'dict_snapshot_mb': len(pickle.dumps(plain, pickle.HIGHEST_PROTOCOL)) / 1e6,
+        'table_snapshot_mb': len(pickle.dumps(compact, pickle.HIGHEST_PROTOCOL)) / 1e6,
+    }
+
+if __name__ == '__main__':
+    rng = random.Random(1)
+    results = []
+    for kind in KINDS:
+        print(f"Measuring {kind} with {ENTRIES} entries")
+        results.append(measure(kind, rng))
+        r = results[-1]
+        print(f"  dict {r['dict_mb']:.1f} MB ({r['dict_bytes_per_entry']:.0f} B/entry), "
+              f"table {r['table_mb']:.1f} MB ({r['table_bytes_per_entry']:.0f} B/entry), "
+              f"{r['memory_reduction']:.0%} less; lookups {r['dict_lookup_ns']:.0f} ns (dict) vs "
+              f"{r['table_lookup_ns']:.0f} ns (table, text key), {r['table_int_lookup_ns']:.0f} ns (int key)")
+
+    with open('state_table_results.csv', 'w', newline='') as csvfile:
+        fieldnames = ['table', 'entries', 'dict_mb', 'table_mb', 'dict_bytes_per_entry',
+                      'table_bytes_per_entry', 'memory_reduction', 'dict_lookup_ns',
+                      'table_lookup_ns', 'table_int_lookup_ns', 'dict_snapshot_mb',
+                      'table_snapshot_mb']
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer.writeheader()
+        for result in results:
+            writer.writerow(result)
+
+    print("State table testing completed. Results saved to state_table_results.csv")
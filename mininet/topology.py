@@ -1,5 +1,13 @@
 #!/usr/bin/env python3
 # Mininet topology with 3 hosts and OpenFlow switch
+#
+# Usage: sudo python3 mininet/topology.py [--shards N]
+# With --shards the switch connects to the controller worker that owns its
+# datapath id (controller/run_sharded.py --workers N).
+
+import argparse
+import os
+import sys
 
 from mininet.net import Mininet
 from mininet.node import Controller, RemoteController
@@ -8,16 +16,22 @@ from mininet.log import setLogLevel, info
 from mininet.link import TCLink
 from mininet.clean import cleanup
 
-def createNet():
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'controller'))
+import sharding
+
+S1_DPID = 1
+
+def createNet(shards=1, base_port=sharding.DEFAULT_BASE_PORT):
     # Clean up any previous Mininet runs
     cleanup()
     
     # Create a network with a remote controller
     net = Mininet(controller=RemoteController, link=TCLink)
     
-    # Add controller
+    # Add controller (the shard owning s1 when the controller is sharded)
     info('*** Adding controller\n')
-    c0 = net.addController('c0', controller=RemoteController, ip='127.0.0.1', port=6653)
+    c0 = net.addController('c0', controller=RemoteController, ip='127.0.0.1',
+                           port=sharding.shard_port(S1_DPID, shards, base_port))
     
     # Add three hosts
     info('*** Adding hosts\n')
@@ -26,13 +40,15 @@ def createNet():
     h3 = net.addHost('h3', mac='00:00:00:00:00:03', ip='10.0.0.3/24')
     
     # Add load balancer virtual IP to h2 and h3 (server side)
+    # ARP requests never reach the hosts: the controller answers ARP for the
+    # VIP with the load balancer's virtual MAC (see controller/arp_proxy.py)
     info('*** Configuring virtual IP on backend servers\n')
     h2.cmd('ip addr add 10.0.0.100/24 dev h2-eth0')
     h3.cmd('ip addr add 10.0.0.100/24 dev h3-eth0')
     
     # Add one switch
     info('*** Adding switch\n')
-    s1 = net.addSwitch('s1', protocols='OpenFlow13')
+    s1 = net.addSwitch('s1', protocols='OpenFlow13', dpid='%x' % S1_DPID)
     
     # Connect hosts to switch
     info('*** Creating links\n')
@@ -68,5 +84,9 @@ def createNet():
     net.stop()
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mininet topology for the SDN controller')
+    parser.add_argument('--shards', type=int, default=1, help='workers of controller/run_sharded.py')
+    parser.add_argument('--base-port', type=int, default=sharding.DEFAULT_BASE_PORT)
+    args = parser.parse_args()
     setLogLevel('info')
-    createNet()
\ No newline at end of file
+    createNet(args.shards, args.base_port)
\ No newline at end of file
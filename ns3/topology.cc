@@ -3,110 +3,305 @@
 #include "ns3/csma-module.h"
 #include "ns3/internet-module.h"
 #include "ns3/internet-apps-module.h"
+#include "ns3/applications-module.h"
 #include "ns3/ofswitch13-module.h"
 #include "ns3/tap-bridge-module.h"
 
+#include <algorithm>
+#include <cstdio>
+#include <map>
+#include <vector>
+
 using namespace ns3;
 
+// Ping round-trip times, first reply of each ping flow kept apart (flow setup)
+static std::map<Ptr<Application>, uint32_t> g_pingReplies;
+static std::vector<double> g_firstRtts;
+static std::vector<double> g_rtts;
+
+static void
+RttTrace (Ptr<Application> app, uint16_t seq, Time rtt)
+{
+    if (g_pingReplies[app]++ == 0)
+        g_firstRtts.push_back (rtt.GetSeconds () * 1000.0);
+    else
+        g_rtts.push_back (rtt.GetSeconds () * 1000.0);
+}
+
+static double
+Mean (const std::vector<double> &values)
+{
+    if (values.empty ())
+        return -1.0;
+    double sum = 0;
+    for (double v : values)
+        sum += v;
+    return sum / values.size ();
+}
+
+// Host i (0-based) gets the Mininet addressing: 10.0.0.(i+1), MAC 00:00:00:00:00:(i+1).
+// Addresses skip the load balancer VIP (10.0.0.100) and continue into 10.0.1.0
+// and up (a /16) for more than 253 hosts.
+static Ipv4Address
+HostAddress (uint32_t i)
+{
+    uint32_t n = i + 1;
+    if (n >= 100)
+        n++;
+    return Ipv4Address ((10u << 24) | n);
+}
+
+static Mac48Address
+HostMac (uint32_t i)
+{
+    char buf[18];
+    std::snprintf (buf, sizeof (buf), "00:00:00:00:%02x:%02x", ((i + 1) >> 8) & 0xff, (i + 1) & 0xff);
+    return Mac48Address (buf);
+}
+
+static Mac48Address
+SwitchPortMac (uint32_t n)
+{
+    char buf[18];
+    std::snprintf (buf, sizeof (buf), "02:00:00:00:%02x:%02x", (n >> 8) & 0xff, n & 0xff);
+    return Mac48Address (buf);
+}
+
 int
 main (int argc, char *argv[])
 {
     // Default ping destination (can be overridden via command line)
     std::string pingDestination = "10.0.0.2";
-    
+
+    // Scenario: defaults are the original 3-host, 1-switch network with one ping
+    uint32_t nHosts = 3;
+    uint32_t nSwitches = 1;
+    std::string hostRate = "100Mbps";
+    std::string hostDelay = "2ms";
+    std::string trunkRate = "1Gbps";
+    std::string trunkDelay = "1ms";
+    uint32_t pingFlows = 1;
+    uint32_t pingCount = 5;
+    uint32_t tcpFlows = 0;
+    uint32_t tcpBytes = 1000000;
+    uint32_t udpFlows = 0;
+    std::string udpRate = "1Mbps";
+    double duration = 10.0;
+    uint32_t seed = 1;
+    uint16_t ctrlPort = 6653;
+    std::string ctrlNetwork = "10.100.0.0";
+    std::string tapName = "ctrl";
+    bool verbose = true;
+
     // Parse command-line arguments
     CommandLine cmd;
     cmd.AddValue("destination", "IP address to ping", pingDestination);
+    cmd.AddValue("hosts", "Number of hosts", nHosts);
+    cmd.AddValue("switches", "Number of OpenFlow switches, connected in a line", nSwitches);
+    cmd.AddValue("hostRate", "Data rate of host-switch links", hostRate);
+    cmd.AddValue("hostDelay", "Delay of host-switch links", hostDelay);
+    cmd.AddValue("trunkRate", "Data rate of switch-switch links", trunkRate);
+    cmd.AddValue("trunkDelay", "Delay of switch-switch links", trunkDelay);
+    cmd.AddValue("pings", "Ping flows: h1 -> destination, then random host pairs", pingFlows);
+    cmd.AddValue("pingCount", "Echo requests per ping flow", pingCount);
+    cmd.AddValue("tcpFlows", "TCP bulk transfers between random host pairs", tcpFlows);
+    cmd.AddValue("tcpBytes", "Bytes per TCP transfer", tcpBytes);
+    cmd.AddValue("udpFlows", "Constant-rate UDP flows between random host pairs", udpFlows);
+    cmd.AddValue("udpRate", "Data rate of each UDP flow", udpRate);
+    cmd.AddValue("duration", "Simulated seconds", duration);
+    cmd.AddValue("seed", "Run number for the random host pairs", seed);
+    cmd.AddValue("ctrlPort", "TCP port the external controller listens on", ctrlPort);
+    cmd.AddValue("ctrlNetwork", "/24 network of the controller channel", ctrlNetwork);
+    cmd.AddValue("tapName", "Name of the TAP device towards the controller", tapName);
+    cmd.AddValue("verbose", "Enable OFSwitch13 and TapBridge logging", verbose);
     cmd.Parse(argc, argv);
-    
+
     // Enable checksum computations (required by OFSwitch13 module)
     GlobalValue::Bind("ChecksumEnabled", BooleanValue(true));
-    
+
     // Use real-time simulation for external controller
     GlobalValue::Bind("SimulatorImplementationType", StringValue("ns3::RealtimeSimulatorImpl"));
+    RngSeedManager::SetRun (seed);
 
-    // 1) Create nodes: 3 hosts, 1 switch, 1 "controller" node
-    NodeContainer hosts;    hosts.Create (3);
-    NodeContainer switches; switches.Create (1);
+    // 1) Create nodes: hosts, switches, 1 "controller" node
+    NodeContainer hosts;    hosts.Create (nHosts);
+    NodeContainer switches; switches.Create (nSwitches);
     Ptr<Node> ctrlNode = CreateObject<Node> ();
 
-    // 2) Set up CSMA channel for host↔switch links
+    // 2) Set up CSMA channels for host↔switch and switch↔switch links
     CsmaHelper csma;
-    csma.SetChannelAttribute ("DataRate", DataRateValue (DataRate ("100Mbps")));
-    csma.SetChannelAttribute ("Delay", TimeValue (MilliSeconds (2)));
+    csma.SetChannelAttribute ("DataRate", DataRateValue (DataRate (hostRate)));
+    csma.SetChannelAttribute ("Delay", TimeValue (Time (hostDelay)));
+    CsmaHelper trunk;
+    trunk.SetChannelAttribute ("DataRate", DataRateValue (DataRate (trunkRate)));
+    trunk.SetChannelAttribute ("Delay", TimeValue (Time (trunkDelay)));
 
-    // 3) Install devices: track host‑side vs switch‑side ports
-    NetDeviceContainer hostDevices, switchPorts;
+    // 3) Install devices: track host‑side vs switch‑side ports. Hosts are spread
+    // round-robin over the switches, which form a line (no loops to break).
+    NetDeviceContainer hostDevices;
+    std::vector<NetDeviceContainer> switchPorts (nSwitches);
+    uint32_t portMacs = 0;
     for (uint32_t i = 0; i < hosts.GetN (); ++i)
     {
-        NodeContainer pair (hosts.Get (i), switches.Get (0));
+        uint32_t s = i % nSwitches;
+        NodeContainer pair (hosts.Get (i), switches.Get (s));
         NetDeviceContainer link = csma.Install (pair);
+        link.Get (0)->SetAddress (HostMac (i));
+        link.Get (1)->SetAddress (SwitchPortMac (++portMacs));
         hostDevices.Add (link.Get (0));  // host port
-        switchPorts.Add (link.Get (1));  // switch port
+        switchPorts[s].Add (link.Get (1));  // switch port
+    }
+    for (uint32_t s = 0; s + 1 < nSwitches; ++s)
+    {
+        NetDeviceContainer link = trunk.Install (NodeContainer (switches.Get (s), switches.Get (s + 1)));
+        link.Get (0)->SetAddress (SwitchPortMac (++portMacs));
+        link.Get (1)->SetAddress (SwitchPortMac (++portMacs));
+        switchPorts[s].Add (link.Get (0));
+        switchPorts[s + 1].Add (link.Get (1));
     }
 
     // 4) Give each host an IP address
     InternetStackHelper internet;
     internet.Install (hosts);
-    Ipv4AddressHelper ipv4;
-    ipv4.SetBase ("10.0.0.0", "255.255.255.0");
-    Ipv4InterfaceContainer interfaces = ipv4.Assign (hostDevices);
-    
+    Ipv4Mask hostMask (nHosts < 254 ? "255.255.255.0" : "255.255.0.0");
+    for (uint32_t i = 0; i < hosts.GetN (); ++i)
+    {
+        Ptr<Ipv4> ip = hosts.Get (i)->GetObject<Ipv4> ();
+        int32_t interface = ip->AddInterface (hostDevices.Get (i));
+        ip->AddAddress (interface, Ipv4InterfaceAddress (HostAddress (i), hostMask));
+        ip->SetUp (interface);
+    }
+
     // Add VIP (10.0.0.100) as secondary address on backend servers (h2 and h3)
     // This allows the load balancer to distribute traffic to these servers
-    Ptr<Ipv4> ipv4_h2 = hosts.Get(1)->GetObject<Ipv4>();
-    Ptr<Ipv4> ipv4_h3 = hosts.Get(2)->GetObject<Ipv4>();
-    
-    ipv4_h2->AddAddress(1, Ipv4InterfaceAddress(Ipv4Address("10.0.0.100"), Ipv4Mask("255.255.255.0")));
-    ipv4_h3->AddAddress(1, Ipv4InterfaceAddress(Ipv4Address("10.0.0.100"), Ipv4Mask("255.255.255.0")));
-    
+    for (uint32_t i = 1; i < std::min (nHosts, 3u); ++i)
+    {
+        Ptr<Ipv4> ip = hosts.Get (i)->GetObject<Ipv4> ();
+        ip->AddAddress (1, Ipv4InterfaceAddress (Ipv4Address ("10.0.0.100"), hostMask));
+    }
+
     std::cout << "VIP 10.0.0.100 configured on h2 and h3 (backend servers)" << std::endl;
 
     // 5) Configure the OFSwitch13 helper for an external controller
+    OFSwitch13Helper::SetAddressBase (Ipv4Address (ctrlNetwork.c_str ()), Ipv4Mask ("255.255.255.0"));
     Ptr<OFSwitch13ExternalHelper> of13 = CreateObject<OFSwitch13ExternalHelper> ();
-    
-    // a) Install the switch datapath with its ports
-    of13->InstallSwitch (switches.Get (0), switchPorts);
-    
+    of13->SetAttribute ("Port", UintegerValue (ctrlPort));
+
+    // a) Install the switch datapaths with their ports
+    for (uint32_t s = 0; s < nSwitches; ++s)
+        of13->InstallSwitch (switches.Get (s), switchPorts[s]);
+
     // b) Install the external controller
     Ptr<NetDevice> ctrlDev = of13->InstallExternalController (ctrlNode);
-    
+
     // c) Set up TapBridge to connect controller
     TapBridgeHelper tap;
     tap.SetAttribute ("Mode", StringValue ("ConfigureLocal"));
-    tap.SetAttribute ("DeviceName", StringValue ("ctrl"));
-    tap.SetAttribute ("Gateway", Ipv4AddressValue ("10.100.0.1"));        
-    tap.SetAttribute ("Netmask", Ipv4MaskValue ("255.255.255.0"));       
+    tap.SetAttribute ("DeviceName", StringValue (tapName));
+    tap.SetAttribute ("Gateway", Ipv4AddressValue (Ipv4Address (Ipv4Address (ctrlNetwork.c_str ()).Get () + 1)));
+    tap.SetAttribute ("Netmask", Ipv4MaskValue ("255.255.255.0"));
     tap.Install (ctrlNode, ctrlDev);
-    
+
     // d) Create OpenFlow channels
     of13->CreateOpenFlowChannels ();
 
     // 6) Turn on OFSwitch13 logging
-    LogComponentEnable ("OFSwitch13Helper", LOG_LEVEL_INFO);
-    LogComponentEnable ("OFSwitch13Device", LOG_LEVEL_INFO);
-    LogComponentEnable ("OFSwitch13Port", LOG_LEVEL_INFO);
-    LogComponentEnable ("OFSwitch13SocketHandler", LOG_LEVEL_ALL);
-    LogComponentEnable ("TapBridge", LOG_LEVEL_INFO);
-
-    // Add ping application between hosts
-    PingHelper ping (Ipv4Address (pingDestination.c_str())); 
-    ping.SetAttribute ("Count", UintegerValue (5));                      
-    ApplicationContainer apps = ping.Install (hosts.Get (0));
-    apps.Start (Seconds (2.0)); 
-    apps.Stop (Seconds (8.0));   
-
-    // 7) Run for 10 seconds
-    Simulator::Stop (Seconds (10.0));
-    
+    if (verbose)
+    {
+        LogComponentEnable ("OFSwitch13Helper", LOG_LEVEL_INFO);
+        LogComponentEnable ("OFSwitch13Device", LOG_LEVEL_INFO);
+        LogComponentEnable ("OFSwitch13Port", LOG_LEVEL_INFO);
+        LogComponentEnable ("OFSwitch13SocketHandler", LOG_LEVEL_ALL);
+        LogComponentEnable ("TapBridge", LOG_LEVEL_INFO);
+    }
+
+    // 7) Traffic mix, starting once the switches have connected
+    Ptr<UniformRandomVariable> pick = CreateObject<UniformRandomVariable> ();
+    auto randomPair = [&] (uint32_t &src, uint32_t &dst) {
+        src = pick->GetInteger (0, nHosts - 1);
+        dst = (src + pick->GetInteger (1, nHosts - 1)) % nHosts;
+    };
+    Time stop = Seconds (std::max (duration - 2.0, 3.0));
+
+    // Add ping applications between hosts
+    ApplicationContainer pings;
+    for (uint32_t f = 0; f < pingFlows && nHosts > 1; ++f)
+    {
+        uint32_t src = 0, dst = 0;
+        Ipv4Address target (pingDestination.c_str ());
+        if (f > 0)
+        {
+            randomPair (src, dst);
+            target = HostAddress (dst);
+        }
+        PingHelper ping (target);
+        ping.SetAttribute ("Count", UintegerValue (pingCount));
+        ApplicationContainer apps = ping.Install (hosts.Get (src));
+        apps.Start (Seconds (2.0));
+        apps.Stop (stop);
+        apps.Get (0)->TraceConnectWithoutContext ("Rtt", MakeBoundCallback (&RttTrace, apps.Get (0)));
+        pings.Add (apps);
+    }
+
+    ApplicationContainer sinks;
+    for (uint32_t f = 0; f < tcpFlows + udpFlows && nHosts > 1; ++f)
+    {
+        bool tcp = f < tcpFlows;
+        std::string factory = tcp ? "ns3::TcpSocketFactory" : "ns3::UdpSocketFactory";
+        uint16_t port = 5000 + f;
+        uint32_t src, dst;
+        randomPair (src, dst);
+        PacketSinkHelper sink (factory, InetSocketAddress (Ipv4Address::GetAny (), port));
+        ApplicationContainer sinkApp = sink.Install (hosts.Get (dst));
+        sinkApp.Start (Seconds (1.0));
+        sinks.Add (sinkApp);
+
+        ApplicationContainer source;
+        if (tcp)
+        {
+            BulkSendHelper bulk (factory, InetSocketAddress (HostAddress (dst), port));
+            bulk.SetAttribute ("MaxBytes", UintegerValue (tcpBytes));
+            source = bulk.Install (hosts.Get (src));
+        }
+        else
+        {
+            OnOffHelper onoff (factory, InetSocketAddress (HostAddress (dst), port));
+            onoff.SetConstantRate (DataRate (udpRate));
+            source = onoff.Install (hosts.Get (src));
+        }
+        source.Start (Seconds (2.0 + pick->GetValue (0.0, 1.0)));
+        source.Stop (stop);
+    }
+
+    // 8) Run for the requested time
+    Simulator::Stop (Seconds (duration));
+
     std::cout << "=== Starting NS-3 SDN Simulation ===" << std::endl;
-    std::cout << "Controller should connect to: 127.0.0.1:6653" << std::endl;
-    std::cout << "TAP interface: ctrl (10.100.0.1/24)" << std::endl;
+    std::cout << "Controller should connect to: 127.0.0.1:" << ctrlPort << std::endl;
+    std::cout << "TAP interface: " << tapName << " (" << ctrlNetwork << "/24)" << std::endl;
+    std::cout << "Topology: " << nHosts << " hosts, " << nSwitches << " switches; traffic: "
+              << pingFlows << " ping, " << tcpFlows << " TCP, " << udpFlows << " UDP flows" << std::endl;
     std::cout << "Ping destination: " << pingDestination << std::endl;
-    
+
     Simulator::Run ();
+
+    // One machine-readable summary line for the batch runner (measure_ns3_scaling.py)
+    uint64_t tcpRx = 0, udpRx = 0;
+    for (uint32_t f = 0; f < sinks.GetN (); ++f)
+    {
+        uint64_t rx = DynamicCast<PacketSink> (sinks.Get (f))->GetTotalRx ();
+        (f < tcpFlows ? tcpRx : udpRx) += rx;
+    }
+    std::cout << "RESULT hosts=" << nHosts << " switches=" << nSwitches
+              << " ping_flows=" << pings.GetN () << " ping_sent=" << pings.GetN () * pingCount
+              << " ping_received=" << g_firstRtts.size () + g_rtts.size ()
+              << " first_rtt_ms=" << Mean (g_firstRtts) << " rtt_ms=" << Mean (g_rtts)
+              << " tcp_flows=" << tcpFlows << " tcp_rx_bytes=" << tcpRx
+              << " udp_flows=" << udpFlows << " udp_rx_bytes=" << udpRx
+              << " duration_s=" << duration << std::endl;
+
     Simulator::Destroy ();
-    
+
     std::cout << "=== Simulation Complete ===" << std::endl;
     return 0;
 }
\ No newline at end of file
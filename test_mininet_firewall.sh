@@ -39,11 +39,16 @@ setup_ovs() {
 # Cleanup function
 cleanup() {
     echo "Performing cleanup..."
+    sudo pkill -9 -f run_sharded.py 2>/dev/null
     sudo pkill -9 -f ryu-manager 2>/dev/null
     sudo mn -c 2>/dev/null
     sleep 2
 }
 
+# Number of controller shards (controller/run_sharded.py); 1 runs a single ryu-manager
+SHARDS=${SHARDS:-1}
+CONTROLLER_PORT=$(python3 -c "import sys; sys.path.insert(0, 'controller'); import sharding; print(sharding.shard_port(1, $SHARDS))")
+
 # Setup OVS before cleanup
 setup_ovs
 
@@ -55,12 +60,17 @@ sleep 1
 
 # Start controller with firewall VNF
 echo "Starting controller with Firewall VNF..."
-ryu-manager controller/sdn_controller.py controller/firewall_vnf.py > ~/controller_firewall.log 2>&1 &
+if [ "$SHARDS" -gt 1 ]; then
+    # One ryu-manager worker per shard; s1 (dpid 1) connects to the one that owns it
+    python3 controller/run_sharded.py --workers $SHARDS sdn_controller.py firewall_vnf.py > ~/controller_firewall.log 2>&1 &
+else
+    ryu-manager controller/sdn_controller.py controller/firewall_vnf.py > ~/controller_firewall.log 2>&1 &
+fi
 CONTROLLER_PID=$!
 sleep 5
 
 # Verify controller
-if ! netstat -tln | grep -q ":6653"; then
+if ! netstat -tln | grep -q ":$CONTROLLER_PORT"; then
     echo "❌ ERROR: Controller failed to start!"
     if [ -f ~/controller_firewall.log ]; then
         cat ~/controller_firewall.log
@@ -75,11 +85,20 @@ echo "Starting Mininet network..."
 echo "Running firewall tests..."
 echo ""
 
-sudo python3 - <<'PYTHON_SCRIPT'
+sudo SHARDS=$SHARDS python3 - <<'PYTHON_SCRIPT'
 from mininet.net import Mininet
 from mininet.node import RemoteController
 from mininet.cli import CLI
 from mininet.log import setLogLevel, info
+import os
+import sys
+
+sys.path.insert(0, 'controller')
+import sharding
+
+# The switch must connect to the controller shard that owns its datapath id
+S1_DPID = 1
+CONTROLLER_PORT = sharding.shard_port(S1_DPID, int(os.environ.get('SHARDS', '1')))
 
 def test_firewall():
     # Don't call cleanup() here - it kills the controller!
@@ -88,7 +107,7 @@ def test_firewall():
     net = Mininet(controller=RemoteController)
     
     info('*** Adding controller\n')
-    c0 = net.addController('c0', controller=RemoteController, ip='127.0.0.1', port=6653)
+    c0 = net.addController('c0', controller=RemoteController, ip='127.0.0.1', port=CONTROLLER_PORT)
     
     info('*** Adding hosts\n')
     h1 = net.addHost('h1', mac='00:00:00:00:00:01', ip='10.0.0.1/24')
@@ -96,7 +115,7 @@ def test_firewall():
     h3 = net.addHost('h3', mac='00:00:00:00:00:03', ip='10.0.0.3/24')
     
     info('*** Adding switch\n')
-    s1 = net.addSwitch('s1', protocols='OpenFlow13')
+    s1 = net.addSwitch('s1', protocols='OpenFlow13', dpid='%x' % S1_DPID)
     
     info('*** Creating links\n')
     net.addLink(h1, s1)